@@ -16,18 +16,40 @@
 from Acquisition import aq_base
 from Acquisition import aq_inner
 from Acquisition import aq_parent
+from BTrees.OOBTree import OOBTree
 from OFS.Folder import Folder
 from zExceptions import BadRequest
 
+from .utils import CompiledSource
+from .utils import invalidateCompiledWorkflow
+
 
 _marker = []  # Create a new marker object.
 
 
 class ContainerTab(Folder):
 
-    def __init__(self, id):
+    def __init__(self, id, btree=False):
         self.id = id
-        self._mapping = {}
+        if btree:
+            self._mapping = OOBTree()
+        else:
+            self._mapping = {}
+
+    def isBTreeBased(self):
+        """ Are the items kept in an OOBTree instead of a dict?
+        """
+        return isinstance(self._mapping, OOBTree)
+
+    def _migrateToBTree(self):
+        """ Move the items into an OOBTree, in place.
+
+        o Return False if they already were in one.
+        """
+        if self.isBTreeBased():
+            return False
+        self._mapping = OOBTree(self._mapping)
+        return True
 
     def getId(self):
         return self.id
@@ -75,14 +97,23 @@ class ContainerTab(Folder):
         raise AttributeError(name)
 
     def _setOb(self, name, value):
+        value = aq_base(value)
         mapping = self._mapping
-        mapping[name] = aq_base(value)
-        self._mapping = mapping  # Trigger persistence.
+        mapping[name] = value
+        if not isinstance(mapping, OOBTree):
+            self._mapping = mapping  # Trigger persistence.
+        if isinstance(value, CompiledSource):
+            workflow = aq_base(aq_parent(aq_inner(self)))
+            if getattr(workflow, '_invalidateCompiled', None) is not None:
+                value._setCompiledOwner(workflow)
+        invalidateCompiledWorkflow(self)
 
     def _delOb(self, name):
         mapping = self._mapping
         del mapping[name]
-        self._mapping = mapping  # Trigger persistence.
+        if not isinstance(mapping, OOBTree):
+            self._mapping = mapping  # Trigger persistence.
+        invalidateCompiledWorkflow(self)
 
     def get(self, name, default=None):
         if name in self._mapping:
@@ -106,6 +137,20 @@ class ContainerTab(Folder):
     def values(self):
         return [self._getOb(id) for id in self._mapping.keys()]
 
+    def rawItems(self):
+        """ Return the (id, item) pairs without acquisition wrappers.
+
+        o For read-only use by the workflow engine.
+        """
+        return self._mapping.items()
+
+    def rawValues(self):
+        """ Return the items without acquisition wrappers.
+
+        o For read-only use by the workflow engine.
+        """
+        return self._mapping.values()
+
     def manage_renameObjects(self, ids=[], new_ids=[], REQUEST=None):
         """Rename several sub-objects"""
         if len(ids) != len(new_ids):
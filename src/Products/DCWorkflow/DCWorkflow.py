@@ -13,6 +13,10 @@
 """ Web-configurable workflow.
 """
 
+import threading
+import time
+
+import transaction
 from AccessControl.class_init import InitializeClass
 from AccessControl.SecurityInfo import ClassSecurityInfo
 from AccessControl.SecurityManagement import getSecurityManager
@@ -22,6 +26,7 @@ from Acquisition import aq_parent
 from DocumentTemplate.DT_Util import TemplateDict
 from OFS.Folder import Folder
 from OFS.ObjectManager import bad_id
+from ZODB.POSException import ConflictError
 from zope.event import notify
 from zope.interface import implementer
 
@@ -31,12 +36,16 @@ from Products.CMFCore.WorkflowCore import ObjectDeleted
 from Products.CMFCore.WorkflowCore import ObjectMoved
 from Products.CMFCore.WorkflowCore import WorkflowException
 
+from .compiled import CompiledTransition
+from .compiled import CompiledWorkflow
+from .events import AfterBulkTransitionEvent
 from .events import AfterTransitionEvent
 from .events import BeforeTransitionEvent
 from .Expression import StateChangeInfo
 from .Expression import createExprContext
+from .Guard import clearGuardCache
 from .interfaces import IDCWorkflowDefinition
-from .Transitions import TRIGGER_AUTOMATIC
+from .Transitions import TRIGGER_AUTOMATIC  # NOQA: F401
 from .Transitions import TRIGGER_USER_ACTION
 from .utils import Message as _
 from .utils import modifyRolesForGroup
@@ -44,6 +53,35 @@ from .utils import modifyRolesForPermission
 from .WorkflowUIMixin import WorkflowUIMixin
 
 
+_chain_stats_lock = threading.Lock()
+_chain_stats = {'chains': 0, 'transitions': 0, 'seconds': 0.0}
+
+
+def _recordAutomaticChain(transitions, seconds):
+    with _chain_stats_lock:
+        _chain_stats['chains'] += 1
+        _chain_stats['transitions'] += transitions
+        _chain_stats['seconds'] += seconds
+
+
+def getAutomaticChainStats():
+    """Return statistics about the chains of automatic transitions.
+
+    Returns a mapping with the number of 'chains' which ran, the total
+    number of automatic 'transitions' they executed, and the 'seconds'
+    spent in them, since the process started or the last reset.
+    """
+    with _chain_stats_lock:
+        return dict(_chain_stats)
+
+
+def resetAutomaticChainStats():
+    """Reset the statistics about the chains of automatic transitions.
+    """
+    with _chain_stats_lock:
+        _chain_stats.update(chains=0, transitions=0, seconds=0.0)
+
+
 def checkId(id):
     res = bad_id(id)
     if res != -1 and res is not None:
@@ -81,6 +119,12 @@ class DCWorkflowDefinition(WorkflowUIMixin, Folder):
 
     manager_bypass = 0  # Boolean: 'Manager' role bypasses guards
 
+    history_format = ''  # One of history.HISTORY_FORMATS
+    keep_current_status = 0  # Boolean: see history.DCWorkflowStatus
+
+    _compiled_serial = 0  # Incremented whenever the definition changes.
+    _v_compiled = None  # CompiledWorkflow snapshot, see _getCompiled().
+
     manage_options = (
         {'label': 'Properties', 'action': 'manage_properties'},
         {'label': 'States', 'action': 'states/manage_main'},
@@ -94,18 +138,18 @@ class DCWorkflowDefinition(WorkflowUIMixin, Folder):
     security = ClassSecurityInfo()
     security.declareObjectProtected(ManagePortal)
 
-    def __init__(self, id):
+    def __init__(self, id, btree=False):
         self.id = id
         from .States import States
-        self._addObject(States('states'))
+        self._addObject(States('states', btree))
         from .Transitions import Transitions
-        self._addObject(Transitions('transitions'))
+        self._addObject(Transitions('transitions', btree))
         from .Variables import Variables
-        self._addObject(Variables('variables'))
+        self._addObject(Variables('variables', btree))
         from .Worklists import Worklists
-        self._addObject(Worklists('worklists'))
+        self._addObject(Worklists('worklists', btree))
         from .Scripts import Scripts
-        self._addObject(Scripts('scripts'))
+        self._addObject(Scripts('scripts', btree))
 
     def _addObject(self, ob):
         id = ob.getId()
@@ -113,6 +157,38 @@ class DCWorkflowDefinition(WorkflowUIMixin, Folder):
         self._objects = self._objects + (
             {'id': id, 'meta_type': ob.meta_type},)
 
+    @security.protected(ManagePortal)
+    def migrateToBTrees(self):
+        '''
+        Moves the states, transitions, variables, worklists and scripts
+        into OOBTrees, so that editing one of them does not rewrite the
+        whole container.  Returns the ids of the containers migrated.
+        '''
+        migrated = []
+        for id in ('states', 'transitions', 'variables', 'worklists',
+                   'scripts'):
+            if getattr(self, id)._migrateToBTree():
+                migrated.append(id)
+        return migrated
+
+    def _getCompiled(self):
+        '''
+        Returns the compiled snapshot of this definition, building it
+        if it is missing or out of date.
+        '''
+        compiled = self._v_compiled
+        if compiled is None or compiled.serial != self._compiled_serial:
+            compiled = self._v_compiled = CompiledWorkflow(self)
+        return compiled
+
+    def _invalidateCompiled(self):
+        '''
+        Discards the compiled snapshot.  Bumping the serial makes other
+        ZODB connections drop their snapshot once this change commits.
+        '''
+        self._compiled_serial = self._compiled_serial + 1
+        self._v_compiled = None
+
     #
     # Workflow engine.
     #
@@ -153,15 +229,15 @@ class DCWorkflowDefinition(WorkflowUIMixin, Folder):
         '''
         res = {}
         status = self._getStatusOf(ob)
-        for id, vdef in self.variables.items():
+        for id, vdef in self._getCompiled().variables.items():
             if vdef.for_catalog:
                 if id in status:
                     value = status[id]
 
                 # Not set yet.  Use a default.
                 elif vdef.default_expr is not None:
-                    ec = createExprContext(StateChangeInfo(ob, self, status))
-                    value = vdef.default_expr(ec)
+                    value = self._evaluateDefault(vdef.default_expr, ob,
+                                                  status)
                 else:
                     value = vdef.default_value
 
@@ -181,15 +257,16 @@ class DCWorkflowDefinition(WorkflowUIMixin, Folder):
         Returns the actions to be displayed to the user.
         '''
         ob = info.object
-        sdef = self._getWorkflowStateOf(ob)
+        sdef = self._getCompiled().states.get(
+            self._getWorkflowStateOf(ob, 1), None)
         if sdef is None:
             return None
         res = []
-        for tid in sdef.transitions:
-            tdef = self.transitions.get(tid, None)
-            if tdef is not None and tdef.trigger_type == TRIGGER_USER_ACTION:
+        for tdef in sdef.transitions:
+            if tdef.trigger_type == TRIGGER_USER_ACTION:
                 if tdef.actbox_name:
                     if self._checkTransitionGuard(tdef, ob):
+                        tid = tdef.id
                         res.append((tid, {
                             'id': tid,
                             'name': tdef.actbox_name % info,
@@ -197,7 +274,7 @@ class DCWorkflowDefinition(WorkflowUIMixin, Folder):
                             'icon': tdef.actbox_icon % info,
                             'permissions': (),  # Predetermined.
                             'category': tdef.actbox_category,
-                            'transition': tdef}))
+                            'transition': self.transitions[tid]}))
         res.sort()
         return [result[1] for result in res]
 
@@ -215,21 +292,23 @@ class DCWorkflowDefinition(WorkflowUIMixin, Folder):
         portal = self._getPortalRoot()
         res = []
         fmt_data = None
-        for id, qdef in self.worklists.items():
+        worklists = self.worklists
+        for id, qdef in worklists.rawItems():
             if qdef.actbox_name:
+                qdef = qdef.__of__(worklists)
                 guard = qdef.guard
                 if guard is None or guard.check(sm, self, portal):
-                    searchres = None
+                    count = None
                     var_match_keys = qdef.getVarMatchKeys()
                     if var_match_keys:
-                        # Check the catalog for items in the worklist.
-                        searchres = qdef.search(info)
-                        if not searchres:
+                        # Count the catalog entries in the worklist.
+                        count = qdef.countResults(info)
+                        if not count:
                             continue
                     if fmt_data is None:
                         fmt_data = TemplateDict()
                         fmt_data._push(info)
-                    fmt_data._push({'count': len(searchres)})
+                    fmt_data._push({'count': count})
                     res.append((id, {'id': id,
                                      'name': qdef.actbox_name % fmt_data,
                                      'url': qdef.actbox_url % fmt_data,
@@ -246,11 +325,12 @@ class DCWorkflowDefinition(WorkflowUIMixin, Folder):
         Returns a true value if the given action name
         is possible in the current state.
         '''
-        sdef = self._getWorkflowStateOf(ob)
+        compiled = self._getCompiled()
+        sdef = compiled.states.get(self._getWorkflowStateOf(ob, 1), None)
         if sdef is None:
             return 0
-        if action in sdef.transitions:
-            tdef = self.transitions.get(action, None)
+        if action in sdef.transition_ids:
+            tdef = compiled.transitions.get(action, None)
             if tdef is not None and \
                tdef.trigger_type == TRIGGER_USER_ACTION and \
                self._checkTransitionGuard(tdef, ob, **kw):
@@ -264,19 +344,80 @@ class DCWorkflowDefinition(WorkflowUIMixin, Folder):
         must perform its own security checks.
         '''
         kw['comment'] = comment
-        sdef = self._getWorkflowStateOf(ob)
+        self._doActionFor(ob, action, kw, self._getCompiled(),
+                          getSecurityManager())
+
+    @security.private
+    def doActionForMany(self, objects, action, comment='', **kw):
+        '''
+        Performs the workflow action 'action' on each of 'objects'.
+
+        The workflow snapshot and the security manager are shared
+        across the batch.  Each object goes through the workflow tool as
+        with its doActionFor, which notifies the workflows of the object
+        and reindexes it, and is processed within its own savepoint, so
+        that a failure is rolled back without affecting the other
+        objects.  Returns a list of (ob, exc) tuples, where 'exc' is None
+        on success or the exception which prevented the transition; an
+        object moved by a script is reported as its new object.  The
+        usual transition events are fired for each object; an
+        IAfterBulkTransitionEvent is fired once at the end.
+        '''
+        compiled = self._getCompiled()
+        sm = getSecurityManager()
+        tool = aq_parent(aq_inner(self))
+        kw['comment'] = comment
+        results = []
+        done = []
+
+        def doAction(ob, kwargs, outcome):
+            try:
+                return self._doActionFor(ob, action, kwargs, compiled, sm)
+            except ObjectMoved as exc:
+                outcome['ob'] = exc.getNewObject()
+                raise
+            except ObjectDeleted:
+                raise
+            except Exception as exc:
+                # The tool raises a copy; report the original.
+                outcome['exc'] = exc
+                raise
+
+        for ob in objects:
+            outcome = {}
+            wfs = tool.getWorkflowsFor(ob) or ()
+            savepoint = transaction.savepoint(optimistic=True)
+            try:
+                tool._invokeWithNotification(wfs, ob, action, doAction,
+                                             (ob, dict(kw), outcome), {})
+            except ConflictError:
+                raise
+            except Exception as exc:
+                savepoint.rollback()
+                results.append((ob, outcome.get('exc', exc)))
+                continue
+            ob = outcome.get('ob', ob)
+            results.append((ob, None))
+            done.append(ob)
+        notify(AfterBulkTransitionEvent(self, self.transitions.get(action),
+                                        done, kw))
+        return results
+
+    def _doActionFor(self, ob, action, kw, compiled, sm):
+        sdef = compiled.states.get(self._getWorkflowStateOf(ob, 1), None)
         if sdef is None:
             raise WorkflowException(_('Object is in an undefined state.'))
-        if action not in sdef.transitions:
+        if action not in sdef.transition_ids:
             raise Unauthorized(action)
-        tdef = self.transitions.get(action, None)
+        tdef = compiled.transitions.get(action, None)
         if tdef is None or tdef.trigger_type != TRIGGER_USER_ACTION:
             msg = _("Transition '${action_id}' is not triggered by a user "
                     "action.", mapping={'action_id': action})
             raise WorkflowException(msg)
-        if not self._checkTransitionGuard(tdef, ob, **kw):
+        if tdef.guard is not None and \
+                not tdef.guard.check(sm, self, ob, **kw):
             raise Unauthorized(action)
-        self._changeStateOf(ob, tdef, kw)
+        self._changeStateOf(ob, self.transitions[action], kw)
 
     @security.private
     def isInfoSupported(self, ob, name):
@@ -285,8 +426,7 @@ class DCWorkflowDefinition(WorkflowUIMixin, Folder):
         '''
         if name == self.state_var:
             return 1
-        vdef = self.variables.get(name, None)
-        if vdef is None:
+        if name not in self._getCompiled().variables:
             return 0
         return 1
 
@@ -298,7 +438,7 @@ class DCWorkflowDefinition(WorkflowUIMixin, Folder):
         '''
         if name == self.state_var:
             return self._getWorkflowStateOf(ob, 1)
-        vdef = self.variables[name]
+        vdef = self._getCompiled().variables[name]
         if vdef.info_guard is not None and \
            not vdef.info_guard.check(getSecurityManager(), self, ob):
             return default
@@ -308,13 +448,18 @@ class DCWorkflowDefinition(WorkflowUIMixin, Folder):
 
         # Not set yet.  Use a default.
         elif vdef.default_expr is not None:
-            ec = createExprContext(StateChangeInfo(ob, self, status))
-            value = vdef.default_expr(ec)
+            value = self._evaluateDefault(vdef.default_expr, ob, status)
         else:
             value = vdef.default_value
 
         return value
 
+    def _evaluateDefault(self, expr, ob, status):
+        # Evaluate the default expression of a variable.
+        if expr.is_constant:
+            return expr.value
+        return expr(createExprContext(StateChangeInfo(ob, self, status)))
+
     @security.private
     def allowCreate(self, container, type_name):
         """Returns true if the user is allowed to create a workflow instance.
@@ -365,25 +510,35 @@ class DCWorkflowDefinition(WorkflowUIMixin, Folder):
         """Changes the object permissions according to the current state.
         """
         changed = 0
-        sdef = self._getWorkflowStateOf(ob)
+        sdef = self._getCompiled().states.get(
+            self._getWorkflowStateOf(ob, 1), None)
         if sdef is None:
             return 0
         # Update the role -> permission map.
         if self.permissions:
             for p in self.permissions:
-                roles = []
-                if sdef.permission_roles is not None:
-                    roles = sdef.permission_roles.get(p, roles)
+                roles = sdef.permission_roles.get(p, None)
+                if roles is None:
+                    roles = []
+                elif isinstance(roles, list):
+                    # Don't share the snapshot's list with the object.
+                    roles = list(roles)
                 if modifyRolesForPermission(ob, p, roles):
                     changed = 1
+        if self._updateGroupRolesFor(ob, sdef):
+            changed = 1
+        if changed:
+            clearGuardCache()
+        return changed
+
+    def _updateGroupRolesFor(self, ob, sdef):
         # Update the group -> role map.
+        changed = 0
         groups = self.getGroups()
         managed_roles = self.getRoles()
         if groups and managed_roles:
             for group in groups:
-                roles = ()
-                if sdef.group_roles is not None:
-                    roles = sdef.group_roles.get(group, ())
+                roles = sdef.group_roles.get(group, ())
                 if modifyRolesForGroup(ob, group, roles, managed_roles):
                     changed = 1
         return changed
@@ -398,12 +553,13 @@ class DCWorkflowDefinition(WorkflowUIMixin, Folder):
 
     def _findAutomaticTransition(self, ob, sdef):
         tdef = None
-        for tid in sdef.transitions:
-            t = self.transitions.get(tid, None)
-            if t is not None and t.trigger_type == TRIGGER_AUTOMATIC:
-                if self._checkTransitionGuard(t, ob):
-                    tdef = t
-                    break
+        compiled_sdef = self._getCompiled().states.get(sdef.getId(), None)
+        if compiled_sdef is None:
+            return None
+        for t in compiled_sdef.automatic_transitions:
+            if self._checkTransitionGuard(t, ob):
+                tdef = self.transitions[t.id]
+                break
         return tdef
 
     def _changeStateOf(self, ob, tdef=None, kwargs=None):
@@ -413,10 +569,16 @@ class DCWorkflowDefinition(WorkflowUIMixin, Folder):
         was just created.
         '''
         moved_exc = None
+        # One StateChangeInfo serves all transitions of the chain.
+        sci = StateChangeInfo(ob, self)
+        automatic = 0
+        started = None
         while 1:
             try:
-                sdef = self._executeTransition(ob, tdef, kwargs)
-            except ObjectMoved as moved_exc:
+                sdef = self._executeTransition(ob, tdef, kwargs, sci)
+            except ObjectMoved as exc:
+                # The name bound by 'except' does not outlive the clause.
+                moved_exc = exc
                 ob = moved_exc.getNewObject()
                 sdef = self._getWorkflowStateOf(ob)
                 # Re-raise after all transitions.
@@ -427,32 +589,56 @@ class DCWorkflowDefinition(WorkflowUIMixin, Folder):
                 # No more automatic transitions.
                 break
             # Else continue.
+            if started is None:
+                started = time.time()
+            automatic += 1
+        if started is not None:
+            _recordAutomaticChain(automatic, time.time() - started)
         if moved_exc is not None:
             # Re-raise.
             raise moved_exc
 
-    def _executeTransition(self, ob, tdef=None, kwargs=None):
+    def _getStateChangeInfo(self, sci, ob, status, tdef, old_sdef, new_sdef,
+                            kwargs):
+        # Return sci set up for a transition, or a new StateChangeInfo.
+        if sci is None:
+            return StateChangeInfo(
+                ob, self, status, tdef, old_sdef, new_sdef, kwargs)
+        sci._reset(ob, self, status, tdef, old_sdef, new_sdef, kwargs)
+        return sci
+
+    def _executeTransition(self, ob, tdef=None, kwargs=None, sci=None):
         '''
         Private method.
-        Puts object in a new state.
+        Puts object in a new state.  'sci' is an optional StateChangeInfo
+        to reuse for the scripts and expressions of the transition.
         '''
-        sci = None
+        former_sci = None
         econtext = None
         moved_exc = None
+        compiled = self._getCompiled()
 
         # Figure out the old and new states.
         old_sdef = self._getWorkflowStateOf(ob)
         old_state = old_sdef.getId()
         if tdef is None:
+            compiled_tdef = None
             new_state = self.initial_state
             former_status = {}
         else:
-            new_state = tdef.new_state_id
+            compiled_tdef = compiled.transitions.get(tdef.getId(), None)
+            if compiled_tdef is None:
+                # Not one of our transitions.
+                compiled_tdef = CompiledTransition(tdef)
+            new_state = compiled_tdef.new_state_id
             if not new_state:
                 # Stay in same state.
                 new_state = old_state
             former_status = self._getStatusOf(ob)
-        new_sdef = self.states.get(new_state, None)
+        compiled_new_sdef = compiled.states.get(new_state, None)
+        new_sdef = None
+        if compiled_new_sdef is not None:
+            new_sdef = self.states.get(new_state, None)
         if new_sdef is None:
             msg = _('Destination state undefined: ${state_id}',
                     mapping={'state_id': new_state})
@@ -463,28 +649,25 @@ class DCWorkflowDefinition(WorkflowUIMixin, Folder):
                                      former_status, kwargs))
 
         # Execute the "before" script.
-        if tdef is not None and tdef.script_name:
-            script = self.scripts[tdef.script_name]
+        if compiled_tdef is not None and compiled_tdef.script_name:
+            script = self.scripts[compiled_tdef.script_name]
             # Pass lots of info to the script in a single parameter.
-            sci = StateChangeInfo(
-                ob, self, former_status, tdef, old_sdef, new_sdef, kwargs)
+            former_sci = sci = self._getStateChangeInfo(
+                sci, ob, former_status, tdef, old_sdef, new_sdef, kwargs)
             try:
                 script(sci)  # May throw an exception.
-            except ObjectMoved as moved_exc:
+            except ObjectMoved as exc:
+                moved_exc = exc
                 ob = moved_exc.getNewObject()
                 # Re-raise after transition
 
         # Update variables.
-        state_values = new_sdef.var_values
-        if state_values is None:
-            state_values = {}
-        tdef_exprs = None
-        if tdef is not None:
-            tdef_exprs = tdef.var_exprs
-        if tdef_exprs is None:
-            tdef_exprs = {}
+        state_values = compiled_new_sdef.var_values
+        tdef_exprs = {}
+        if compiled_tdef is not None:
+            tdef_exprs = compiled_tdef.var_exprs
         status = {}
-        for id, vdef in self.variables.items():
+        for id, vdef in compiled.variables.items():
             if not vdef.for_status:
                 continue
             expr = None
@@ -500,15 +683,17 @@ class DCWorkflowDefinition(WorkflowUIMixin, Folder):
                     expr = vdef.default_expr
                 else:
                     value = vdef.default_value
-            if expr is not None:
+            if expr is not None and expr.is_constant:
+                value = expr.value
+            elif expr is not None:
                 # Evaluate an expression.
                 if econtext is None:
                     # Lazily create the expression context.
-                    if sci is None:
-                        sci = StateChangeInfo(
-                            ob, self, former_status, tdef,
+                    if former_sci is None:
+                        former_sci = sci = self._getStateChangeInfo(
+                            sci, ob, former_status, tdef,
                             old_sdef, new_sdef, kwargs)
-                    econtext = createExprContext(sci)
+                    econtext = createExprContext(former_sci)
                 value = expr(econtext)
             status[id] = value
 
@@ -517,15 +702,21 @@ class DCWorkflowDefinition(WorkflowUIMixin, Folder):
         tool = aq_parent(aq_inner(self))
         tool.setStatusOf(self.id, ob, status)
 
-        # Update role to permission assignments.
-        self.updateRoleMappingsFor(ob)
+        # Update role to permission assignments, unless the object had a
+        # status in a state with the same settings as the new one.
+        if former_status.get(self.state_var) != old_state or \
+                not compiled.hasSameRoleMappings(old_state, new_state):
+            self.updateRoleMappingsFor(ob)
+
+        # Guard results computed before the state change are stale now.
+        clearGuardCache()
 
         # Execute the "after" script.
-        if tdef is not None and tdef.after_script_name:
-            script = self.scripts[tdef.after_script_name]
+        if compiled_tdef is not None and compiled_tdef.after_script_name:
+            script = self.scripts[compiled_tdef.after_script_name]
             # Pass lots of info to the script in a single parameter.
-            sci = StateChangeInfo(
-                ob, self, status, tdef, old_sdef, new_sdef, kwargs)
+            sci = self._getStateChangeInfo(
+                sci, ob, status, tdef, old_sdef, new_sdef, kwargs)
             script(sci)  # May throw an exception.
 
         # Fire "after" event
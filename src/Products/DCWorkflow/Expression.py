@@ -13,6 +13,8 @@
 """ Expressions in a web-configurable workflow.
 """
 
+import ast
+
 from AccessControl.class_init import InitializeClass
 from AccessControl.SecurityInfo import ClassSecurityInfo
 from AccessControl.SecurityManagement import getSecurityManager
@@ -44,12 +46,103 @@ class SafeMapping(MultiMapping):
     _pop = MultiMapping.pop
 
 
+_marker = object()
+
+
+class _HistoryIterator:
+
+    # Iterates over copies of history entries.  Restricted code checks
+    # each item against the iterated object, so unlike a generator this
+    # has to declare its access.
+    __slots__ = ('_history', '_indexes', '_action')
+
+    security = ClassSecurityInfo()
+    security.setDefaultAccess('allow')
+
+    def __init__(self, history, reverse=False, action=_marker):
+        self._history = history
+        if reverse:
+            self._indexes = iter(range(len(history) - 1, -1, -1))
+        else:
+            self._indexes = iter(range(len(history)))
+        self._action = action
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        history = self._history
+        action = self._action
+        for i in self._indexes:
+            d = history[i]
+            if action is _marker or d.get('action') == action:
+                return d.copy()  # Don't allow mutation
+        raise StopIteration
+
+
+InitializeClass(_HistoryIterator)
+
+
+class HistoryView:
+
+    '''
+    A lazy, read-only view of a workflow history.
+
+    Only the entries which are read are copied, so that looking at the
+    last few entries does not depend on the length of the history.
+    '''
+    __slots__ = ('_history',)
+
+    security = ClassSecurityInfo()
+    security.setDefaultAccess('allow')
+
+    def __init__(self, history):
+        self._history = history
+
+    def __len__(self):
+        return len(self._history)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [d.copy() for d in self._history[index]]
+        return self._history[index].copy()  # Don't allow mutation
+
+    def __iter__(self):
+        return _HistoryIterator(self._history)
+
+    def __reversed__(self):
+        return _HistoryIterator(self._history, reverse=True)
+
+    def last(self, n=1):
+        '''
+        Returns the last n entries, oldest first.
+        '''
+        if n <= 0:
+            return []
+        return self[-n:]
+
+    def filter(self, action, reverse=False):
+        '''
+        Iterates over the entries of the given action, newest first if
+        reverse is true.
+        '''
+        return _HistoryIterator(self._history, reverse, action)
+
+
+InitializeClass(HistoryView)
+
+
 class StateChangeInfo:
 
     '''
     Provides information for expressions and scripts.
+
+    The status and the keyword arguments are wrapped in a SafeMapping,
+    and the status is looked up if not given, only when they are used.
     '''
-    _date = None
+    __slots__ = ('object', 'workflow', 'old_state', 'new_state',
+                 'transition', '_status', '_kwargs', '_safe_status',
+                 '_safe_kwargs', '_date')
 
     ObjectDeleted = ObjectDeleted
     ObjectMoved = ObjectMoved
@@ -59,26 +152,51 @@ class StateChangeInfo:
 
     def __init__(self, object, workflow, status=None, transition=None,
                  old_state=None, new_state=None, kwargs=None):
-        if kwargs is None:
-            kwargs = {}
-        else:
-            # Don't allow mutation
-            kwargs = SafeMapping(kwargs)
-        if status is None:
-            tool = aq_parent(aq_inner(workflow))
-            status = tool.getStatusOf(workflow.id, object)
-            if status is None:
-                status = {}
-        if status:
-            # Don't allow mutation
-            status = SafeMapping(status)
+        self._reset(object, workflow, status, transition, old_state,
+                    new_state, kwargs)
+
+    def _reset(self, object, workflow, status=None, transition=None,
+               old_state=None, new_state=None, kwargs=None):
+        # Reinitialize, so that one instance can be reused for the
+        # transitions of an automatic chain.
         self.object = object
         self.workflow = workflow
         self.old_state = old_state
         self.new_state = new_state
         self.transition = transition
-        self.status = status
-        self.kwargs = kwargs
+        self._status = status
+        self._kwargs = kwargs
+        self._safe_status = self._safe_kwargs = _marker
+        self._date = None
+
+    @property
+    def status(self):
+        status = self._safe_status
+        if status is _marker:
+            status = self._status
+            if status is None:
+                wf = self.workflow
+                tool = aq_parent(aq_inner(wf))
+                status = tool.getStatusOf(wf.id, self.object)
+                if status is None:
+                    status = {}
+            if status:
+                # Don't allow mutation
+                status = SafeMapping(status)
+            self._safe_status = status
+        return status
+
+    @property
+    def kwargs(self):
+        kwargs = self._safe_kwargs
+        if kwargs is _marker:
+            if self._kwargs is None:
+                kwargs = {}
+            else:
+                # Don't allow mutation
+                kwargs = SafeMapping(self._kwargs)
+            self._safe_kwargs = kwargs
+        return kwargs
 
     def __getitem__(self, name):
         if name[:1] != '_' and hasattr(self, name):
@@ -90,10 +208,7 @@ class StateChangeInfo:
         tool = aq_parent(aq_inner(wf))
         wf_id = wf.id
         h = tool.getHistoryOf(wf_id, self.object)
-        if h:
-            return [d.copy() for d in h]  # Don't allow mutation
-        else:
-            return ()
+        return HistoryView(h or ())
 
     def getPortal(self):
         ob = aq_inner(self.object)
@@ -113,28 +228,158 @@ class StateChangeInfo:
 InitializeClass(StateChangeInfo)
 
 
+# Compiled expressions shared across workflows, keyed by expression text.
+_compiled_expressions = {}
+_MAX_COMPILED_EXPRESSIONS = 10000
+
+_CONSTANT_TYPES = (bool, int, float, str, type(None))
+_NOT_CONSTANT = object()
+
+
+def _getConstant(text):
+    # Return the value of a trivial expression, or _NOT_CONSTANT.
+    if not text.strip():
+        return ''
+    if text.startswith('string:'):
+        value = text[len('string:'):]
+        if '$' not in value:
+            return value
+    elif text.startswith('python:'):
+        try:
+            value = ast.literal_eval(text[len('python:'):].strip())
+        except Exception:
+            pass
+        else:
+            if type(value) in _CONSTANT_TYPES:
+                return value
+    elif text.strip() in ('nothing', 'path:nothing'):
+        return None
+    return _NOT_CONSTANT
+
+
+class CompiledExpression:
+
+    """A TALES expression, compiled once per expression text.
+
+    Trivial expressions such as 'python:True', 'string:foo' without
+    substitutions or 'nothing' are recognized: 'is_constant' is true and
+    'value' holds their value, so they need no expression context.
+    """
+
+    __slots__ = ('text', 'is_constant', 'value', '_compiled')
+
+    def __init__(self, text):
+        self.text = text
+        self._compiled = None
+        value = _getConstant(text)
+        if value is _NOT_CONSTANT:
+            self.is_constant = False
+            self.value = None
+        else:
+            self.is_constant = True
+            self.value = value
+
+    def __call__(self, econtext):
+        if self.is_constant:
+            return self.value
+        compiled = self._compiled
+        if compiled is None:
+            compiled = self._compiled = getEngine().compile(self.text)
+        res = compiled(econtext)
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+
+def getCompiledExpression(expr):
+    '''
+    Returns the shared CompiledExpression for 'expr', which may be an
+    Expression, a CompiledExpression or an expression text.
+    '''
+    if isinstance(expr, CompiledExpression):
+        return expr
+    if not isinstance(expr, str):
+        expr = expr.text
+    compiled = _compiled_expressions.get(expr)
+    if compiled is None:
+        if len(_compiled_expressions) >= _MAX_COMPILED_EXPRESSIONS:
+            _compiled_expressions.clear()
+        compiled = _compiled_expressions[expr] = CompiledExpression(expr)
+    return compiled
+
+
+def _getContainer(sci):
+    return aq_parent(aq_inner(sci.object))
+
+
+# Names of an expression context which are only computed when used.
+_lazy_names = {
+    'container': _getContainer,
+    'folder': _getContainer,
+    'root': lambda sci: sci.object.getPhysicalRoot(),
+    'request': lambda sci: getattr(sci.object, 'REQUEST', None),
+    'user': lambda sci: getSecurityManager().getUser(),
+    'scripts': lambda sci: sci.workflow.scripts,
+}
+
+
+class LazyContextMapping(dict):
+
+    """Names of an expression context, some computed on first access.
+
+    The TALES engine copies the mapping for every scope; the copies
+    share the values computed so far.  Lazy names which were not
+    computed yet do not show up when iterating over the mapping.
+    """
+
+    __slots__ = ('_sci', '_resolved')
+
+    def __init__(self, data, sci, resolved=None):
+        dict.__init__(self, data)
+        self._sci = sci
+        if resolved is None:
+            resolved = {}
+        self._resolved = resolved
+
+    def __missing__(self, name):
+        resolved = self._resolved
+        if name in resolved:
+            value = resolved[name]
+        else:
+            factory = _lazy_names.get(name)
+            if factory is None:
+                raise KeyError(name)
+            value = resolved[name] = factory(self._sci)
+        self[name] = value
+        return value
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name) or name in _lazy_names
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def copy(self):
+        return self.__class__(self, self._sci, self._resolved)
+
+
 def createExprContext(sci):
     '''
     An expression context provides names for TALES expressions.
     '''
     ob = sci.object
-    wf = sci.workflow
-    container = aq_parent(aq_inner(ob))
-    data = {
+    data = LazyContextMapping({
         'here': ob,
         'object': ob,
-        'container': container,
-        'folder': container,
         'nothing': None,
-        'root': ob.getPhysicalRoot(),
-        'request': getattr(ob, 'REQUEST', None),
         'modules': SecureModuleImporter,
-        'user': getSecurityManager().getUser(),
         'state_change': sci,
         'transition': sci.transition,
         'status': sci.status,
         'kwargs': sci.kwargs,
-        'workflow': wf,
-        'scripts': wf.scripts,
-    }
+        'workflow': sci.workflow,
+    }, sci)
     return getEngine().getContext(data)
@@ -15,6 +15,7 @@
 
 from html import escape
 
+import transaction
 from AccessControl.class_init import InitializeClass
 from AccessControl.SecurityInfo import ClassSecurityInfo
 from Acquisition import Explicit
@@ -28,15 +29,23 @@ from Products.CMFCore.utils import _checkPermission
 
 from .Expression import StateChangeInfo
 from .Expression import createExprContext
+from .Expression import getCompiledExpression
+from .utils import CompiledSource
 from .utils import _dtmldir
+from .utils import invalidateCompiledWorkflow
 
 
-class Guard(Persistent, Explicit):
+class Guard(CompiledSource, Persistent, Explicit):
 
     permissions = ()
     roles = ()
     groups = ()
     expr = None
+    # Whether results of this guard may be cached (see checkGuard).  If
+    # None, only guards without an expression are cached; set it to True
+    # for guards whose expression is a pure function of the user, the
+    # object and the keyword arguments.
+    cacheable = None
 
     security = ClassSecurityInfo()
     security.declareObjectProtected(ManagePortal)
@@ -46,50 +55,7 @@ class Guard(Persistent, Explicit):
     def check(self, sm, wf_def, ob, **kw):
         """Checks conditions in this guard.
         """
-        u_roles = None
-        if wf_def.manager_bypass:
-            # Possibly bypass.
-            u_roles = sm.getUser().getRolesInContext(ob)
-            if 'Manager' in u_roles:
-                return 1
-        if self.permissions:
-            for p in self.permissions:
-                if _checkPermission(p, ob):
-                    break
-            else:
-                return 0
-        if self.roles:
-            # Require at least one of the given roles.
-            if u_roles is None:
-                u_roles = sm.getUser().getRolesInContext(ob)
-            for role in self.roles:
-                if role in u_roles:
-                    break
-            else:
-                return 0
-        if self.groups:
-            # Require at least one of the specified groups.
-            u = sm.getUser()
-            b = aq_base(u)
-            if hasattr(b, 'getGroupsInContext'):
-                u_groups = u.getGroupsInContext(ob)
-            elif hasattr(b, 'getGroups'):
-                u_groups = u.getGroups()
-            else:
-                u_groups = ()
-            for group in self.groups:
-                if group in u_groups:
-                    break
-            else:
-                return 0
-        expr = self.expr
-        if expr is not None:
-            econtext = createExprContext(
-                StateChangeInfo(ob, wf_def, kwargs=kw))
-            res = expr(econtext)
-            if not res:
-                return 0
-        return 1
+        return checkGuard(self, sm, wf_def, ob, **kw)
 
     @security.protected(ManagePortal)
     def getSummary(self):
@@ -141,6 +107,16 @@ class Guard(Persistent, Explicit):
         if s:
             res = 1
             self.expr = Expression(s)
+        s = props.get('guard_cacheable', None)
+        if s is not None:
+            cacheable = _parseCacheable(s)
+            if cacheable != self.cacheable:
+                self.cacheable = cacheable
+                invalidateCompiledWorkflow(self)
+                clearGuardCache()
+        if res:
+            invalidateCompiledWorkflow(self)
+            clearGuardCache()
         return res
 
     @security.protected(ManagePortal)
@@ -167,10 +143,168 @@ class Guard(Persistent, Explicit):
             return ''
         return str(self.expr.text)
 
+    @security.protected(ManagePortal)
+    def getCacheableText(self):
+        if self.cacheable is None:
+            return ''
+        return str(bool(self.cacheable))
+
 
 InitializeClass(Guard)
 
 
+def _parseCacheable(value):
+    # 'True' and 'False' as in exports, anything empty means automatic.
+    if isinstance(value, str):
+        value = value.strip()
+        if not value:
+            return None
+        return value.lower() in ('true', 'yes', '1', 'on')
+    return bool(value)
+
+
+def isGuardCacheable(guard):
+    """Return whether results of 'guard' may be cached.
+    """
+    cacheable = getattr(guard, 'cacheable', None)
+    if cacheable is None:
+        return guard.expr is None
+    return bool(cacheable)
+
+
+class _GuardCacheKey:
+
+    """Key of the guard result cache in the transaction's data.
+    """
+
+
+_guard_cache_key = _GuardCacheKey()
+
+
+def _getGuardCache():
+    """Return the guard result cache of the current transaction.
+
+    The cache lives in the transaction's data, so it is dropped when the
+    transaction is committed or aborted.
+    """
+    txn = transaction.get()
+    try:
+        return txn.data(_guard_cache_key)
+    except KeyError:
+        cache = {}
+        txn.set_data(_guard_cache_key, cache)
+        return cache
+
+
+def clearGuardCache():
+    """Forget all guard results cached in the current transaction.
+
+    Call this after changing anything a guard depends on, e.g. local
+    roles, in the middle of a transaction.
+    """
+    try:
+        transaction.get().data(_guard_cache_key).clear()
+    except KeyError:
+        pass
+
+
+def _getCacheKey(guard, sm, wf_def, ob, kw):
+    """Return the cache key of a guard check, or None if not cacheable.
+    """
+    getPhysicalPath = getattr(ob, 'getPhysicalPath', None)
+    if getPhysicalPath is None:
+        return None
+    # Proxy roles of the executing code take part in permission checks.
+    stack = getattr(getattr(sm, '_context', None), 'stack', None)
+    proxy_roles = stack and getattr(stack[-1], '_proxy_roles', None) or ()
+    # Key on the very security manager and user, and on the user's roles,
+    # so that a user with the same id but other roles is checked afresh.
+    user = sm.getUser()
+    key = (aq_base(guard), aq_base(wf_def), sm, aq_base(user),
+           tuple(sorted(user.getRolesInContext(ob))), tuple(proxy_roles),
+           getPhysicalPath(), tuple(sorted(kw.items())))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def checkGuard(guard, sm, wf_def, ob, **kw):
+    """Checks the conditions of 'guard' for 'ob'.
+
+    'guard' may be a Guard or any object providing the same
+    'permissions', 'roles', 'groups' and 'expr' attributes.
+
+    Results are cached for the rest of the transaction, keyed on the
+    guard, the workflow, the security manager, the user and its roles,
+    the object's path and the keyword arguments, if the guard is
+    cacheable (see isGuardCacheable).
+    Executing a transition clears the cache.
+    """
+    if not isGuardCacheable(guard):
+        return _checkGuard(guard, sm, wf_def, ob, kw)
+    key = _getCacheKey(guard, sm, wf_def, ob, kw)
+    if key is None:
+        return _checkGuard(guard, sm, wf_def, ob, kw)
+    cache = _getGuardCache()
+    try:
+        return cache[key]
+    except KeyError:
+        res = cache[key] = _checkGuard(guard, sm, wf_def, ob, kw)
+        return res
+
+
+def _checkGuard(guard, sm, wf_def, ob, kw):
+    u_roles = None
+    if wf_def.manager_bypass:
+        # Possibly bypass.
+        u_roles = sm.getUser().getRolesInContext(ob)
+        if 'Manager' in u_roles:
+            return 1
+    if guard.permissions:
+        for p in guard.permissions:
+            if _checkPermission(p, ob):
+                break
+        else:
+            return 0
+    if guard.roles:
+        # Require at least one of the given roles.
+        if u_roles is None:
+            u_roles = sm.getUser().getRolesInContext(ob)
+        for role in guard.roles:
+            if role in u_roles:
+                break
+        else:
+            return 0
+    if guard.groups:
+        # Require at least one of the specified groups.
+        u = sm.getUser()
+        b = aq_base(u)
+        if hasattr(b, 'getGroupsInContext'):
+            u_groups = u.getGroupsInContext(ob)
+        elif hasattr(b, 'getGroups'):
+            u_groups = u.getGroups()
+        else:
+            u_groups = ()
+        for group in guard.groups:
+            if group in u_groups:
+                break
+        else:
+            return 0
+    expr = guard.expr
+    if expr is not None:
+        expr = getCompiledExpression(expr)
+        if expr.is_constant:
+            res = expr.value
+        else:
+            res = expr(createExprContext(
+                StateChangeInfo(ob, wf_def, kwargs=kw)))
+        if not res:
+            return 0
+    return 1
+
+
 def formatNameUnion(names):
     escaped = ['<code>' + escape(name) + '</code>' for name in names]
     if len(escaped) == 2:
@@ -26,10 +26,12 @@ from Products.PageTemplates.PageTemplateFile import PageTemplateFile
 from Products.CMFCore.permissions import ManagePortal
 
 from .ContainerTab import ContainerTab
+from .utils import CompiledSource
 from .utils import _dtmldir
+from .utils import invalidateCompiledWorkflow
 
 
-class StateDefinition(SimpleItem):
+class StateDefinition(CompiledSource, SimpleItem):
 
     """State definition"""
 
@@ -119,6 +121,7 @@ class StateDefinition(SimpleItem):
         self.title = str(title)
         self.description = str(description)
         self.transitions = tuple(str(t) for t in transitions)
+        invalidateCompiledWorkflow(self)
         if REQUEST is not None:
             return self.manage_properties(REQUEST, 'Properties changed.')
 
@@ -157,6 +160,7 @@ class StateDefinition(SimpleItem):
             self.var_values = PersistentMapping()
 
         self.var_values[id] = value
+        invalidateCompiledWorkflow(self)
 
         if REQUEST is not None:
             return self.manage_variables(REQUEST, 'Variable added.')
@@ -167,6 +171,7 @@ class StateDefinition(SimpleItem):
         for id in ids:
             if id in vv:
                 del vv[id]
+        invalidateCompiledWorkflow(self)
 
         if REQUEST is not None:
             return self.manage_variables(REQUEST, 'Variables deleted.')
@@ -182,6 +187,7 @@ class StateDefinition(SimpleItem):
             for id in vv.keys():
                 fname = 'varval_%s' % id
                 vv[id] = str(REQUEST[fname])
+            invalidateCompiledWorkflow(self)
             return self.manage_variables(REQUEST, 'Variables changed.')
 
     _permissions_form = DTMLFile('state_permissions', _dtmldir)
@@ -209,6 +215,7 @@ class StateDefinition(SimpleItem):
             if not acquired:
                 roles = tuple(roles)
             pr[p] = roles
+        invalidateCompiledWorkflow(self)
         return self.manage_permissions(REQUEST, 'Permissions changed.')
 
     @postonly
@@ -222,6 +229,7 @@ class StateDefinition(SimpleItem):
         else:
             roles = tuple(roles)
         pr[permission] = roles
+        invalidateCompiledWorkflow(self)
 
     manage_groups = PageTemplateFile('state_groups.pt', _dtmldir)
 
@@ -242,6 +250,7 @@ class StateDefinition(SimpleItem):
             roles.sort()
             roles = tuple(roles)
             map[group] = roles
+        invalidateCompiledWorkflow(self)
         if RESPONSE is not None:
             RESPONSE.redirect(
                 "%s/manage_groups?manage_tabs_message=Groups+changed."
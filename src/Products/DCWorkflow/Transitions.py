@@ -26,14 +26,16 @@ from Products.CMFCore.permissions import ManagePortal
 
 from .ContainerTab import ContainerTab
 from .Guard import Guard
+from .utils import CompiledSource
 from .utils import _dtmldir
+from .utils import invalidateCompiledWorkflow
 
 
 TRIGGER_AUTOMATIC = 0
 TRIGGER_USER_ACTION = 1
 
 
-class TransitionDefinition(SimpleItem):
+class TransitionDefinition(CompiledSource, SimpleItem):
 
     """Transition definition"""
 
@@ -132,6 +134,7 @@ class TransitionDefinition(SimpleItem):
         self.actbox_url = str(actbox_url)
         self.actbox_icon = str(actbox_icon)
         self.actbox_category = str(actbox_category)
+        invalidateCompiledWorkflow(self)
         if REQUEST is not None:
             return self.manage_properties(REQUEST, 'Properties changed.')
 
@@ -180,6 +183,7 @@ class TransitionDefinition(SimpleItem):
         if text:
             expr = Expression(str(text))
         self.var_exprs[id] = expr
+        invalidateCompiledWorkflow(self)
 
         if REQUEST is not None:
             return self.manage_variables(REQUEST, 'Variable added.')
@@ -191,6 +195,7 @@ class TransitionDefinition(SimpleItem):
         for id in ids:
             if id in ve:
                 del ve[id]
+        invalidateCompiledWorkflow(self)
 
         if REQUEST is not None:
             return self.manage_variables(REQUEST, 'Variables deleted.')
@@ -212,6 +217,7 @@ class TransitionDefinition(SimpleItem):
                 if val:
                     expr = Expression(str(REQUEST[fname]))
                 ve[id] = expr
+            invalidateCompiledWorkflow(self)
 
             return self.manage_variables(REQUEST, 'Variables changed.')
 
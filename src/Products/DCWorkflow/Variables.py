@@ -26,10 +26,12 @@ from Products.CMFCore.permissions import ManagePortal
 
 from .ContainerTab import ContainerTab
 from .Guard import Guard
+from .utils import CompiledSource
 from .utils import _dtmldir
+from .utils import invalidateCompiledWorkflow
 
 
-class VariableDefinition(SimpleItem):
+class VariableDefinition(CompiledSource, SimpleItem):
     """Variable definition"""
 
     meta_type = 'Workflow Variable'
@@ -102,6 +104,7 @@ class VariableDefinition(SimpleItem):
         self.for_catalog = bool(for_catalog)
         self.for_status = bool(for_status)
         self.update_always = bool(update_always)
+        invalidateCompiledWorkflow(self)
         if REQUEST is not None:
             return self.manage_properties(REQUEST, 'Properties changed.')
 
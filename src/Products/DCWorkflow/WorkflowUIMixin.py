@@ -25,6 +25,7 @@ from Products.PageTemplates.PageTemplateFile import PageTemplateFile
 from Products.CMFCore.permissions import ManagePortal
 
 from .Guard import Guard
+from .history import HISTORY_FORMATS
 from .utils import _dtmldir
 
 
@@ -42,12 +43,20 @@ class WorkflowUIMixin:
     @security.protected(ManagePortal)
     @postonly
     def setProperties(self, title, manager_bypass=0, props=None,
-                      REQUEST=None, description=''):
+                      REQUEST=None, description='', history_format=None,
+                      keep_current_status=None):
         """Sets basic properties.
         """
         self.title = str(title)
         self.description = str(description)
         self.manager_bypass = manager_bypass and 1 or 0
+        if history_format is not None:
+            if history_format not in HISTORY_FORMATS:
+                raise ValueError('Unknown history format: %s'
+                                 % history_format)
+            self.history_format = history_format
+        if keep_current_status is not None:
+            self.keep_current_status = keep_current_status and 1 or 0
         g = Guard()
         if g.changeFromProperties(props or REQUEST):
             self.creation_guard = g
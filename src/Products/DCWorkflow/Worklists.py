@@ -14,31 +14,221 @@
 """
 
 import re
+import threading
+import time
 
+import transaction
 from AccessControl.class_init import InitializeClass
 from AccessControl.SecurityInfo import ClassSecurityInfo
+from AccessControl.SecurityManagement import getSecurityManager
+from Acquisition import aq_base
 from Acquisition import aq_inner
 from Acquisition import aq_parent
 from App.special_dtml import DTMLFile
 from OFS.SimpleItem import SimpleItem
 from Persistence import PersistentMapping
+from zope.component import adapter
 from zope.component import getUtility
+from zope.globalrequest import getRequest
 
 from Products.CMFCore.interfaces import ICatalogTool
 from Products.CMFCore.permissions import ManagePortal
 
+from .compiled import CompiledWorklist
 from .ContainerTab import ContainerTab
 from .Expression import Expression
 from .Expression import StateChangeInfo
 from .Expression import createExprContext
 from .Guard import Guard
+from .interfaces import IAfterTransitionEvent
+from .utils import CompiledSource
 from .utils import _dtmldir
+from .utils import invalidateCompiledWorkflow
 
 
 tales_re = re.compile(r'(\w+:)?(.*)')
 
 
-class WorklistDefinition(SimpleItem):
+def _freeze(value):
+    # Return a hashable equivalent of a catalog query value.
+    if isinstance(value, (list, tuple)):
+        return tuple([_freeze(v) for v in value])
+    if isinstance(value, dict):
+        return tuple(sorted([(k, _freeze(v)) for k, v in value.items()]))
+    hash(value)
+    return value
+
+
+# Worklist counts shared by all threads, keyed by the catalog, the
+# principals which it filters on and the criteria.  Entries expire after
+# COUNT_CACHE_TTL seconds, or as soon as a transition which changes a
+# catalog variable they refer to is committed.
+COUNT_CACHE_TTL = 60
+_MAX_CACHED_COUNTS = 10000
+_count_cache = {}
+_count_cache_lock = threading.Lock()
+_count_cache_generation = 0
+
+
+class _PendingChangesKey:
+
+    """Key of the uncommitted worklist changes in the transaction's data.
+    """
+
+
+_pending_changes_key = _PendingChangesKey()
+
+
+def _getPendingChanges(create=False):
+    # Return the changes made by transitions in the current transaction.
+    txn = transaction.get()
+    try:
+        return txn.data(_pending_changes_key)
+    except KeyError:
+        if not create:
+            return None
+        changes = []
+        txn.set_data(_pending_changes_key, changes)
+        txn.addAfterCommitHook(_invalidateCounts, (changes,))
+        return changes
+
+
+def _getPrincipals(ctool, user):
+    listAllowed = getattr(ctool, '_listAllowedRolesAndUsers', None)
+    if listAllowed is None:
+        return ('user:%s' % user.getId(),)
+    return tuple(sorted(set(listAllowed(user))))
+
+
+def _getCatalogKey(ctool):
+    # Tell the catalogs of different sites and databases apart.
+    jar = getattr(aq_base(ctool), '_p_jar', None)
+    db_name = jar is not None and jar.db().database_name or None
+    path = None
+    if getattr(aq_base(ctool), 'getPhysicalPath', None) is not None:
+        path = ctool.getPhysicalPath()
+    return (db_name, path)
+
+
+def _affects(criteria, changes):
+    # Tell whether frozen criteria may match objects which changed.
+    for state_var, state_ids, other_vars in changes:
+        for name, value in criteria:
+            if name in other_vars:
+                return True
+            if name == state_var:
+                if not isinstance(value, tuple):
+                    value = (value,)
+                for v in value:
+                    if not isinstance(v, str) or v in state_ids:
+                        return True
+    return False
+
+
+def _invalidateCounts(committed, changes):
+    global _count_cache_generation
+    if not committed:
+        return
+    with _count_cache_lock:
+        _count_cache_generation += 1
+        for key in list(_count_cache):
+            if _affects(key[2], changes):
+                del _count_cache[key]
+
+
+def clearCountCache():
+    """Discards all worklist counts shared between requests.
+    """
+    global _count_cache_generation
+    with _count_cache_lock:
+        _count_cache_generation += 1
+        _count_cache.clear()
+
+
+@adapter(IAfterTransitionEvent)
+def invalidateCountsAfterTransition(event):
+    """Drops the worklist counts affected by a transition.
+
+    The shared counts are dropped once the transaction commits; until
+    then, the current transaction neither uses nor fills them.
+    """
+    wf = event.workflow
+    state_ids = set()
+    for sdef in (event.old_state, event.new_state):
+        if sdef is not None:
+            state_ids.add(sdef.getId())
+    other_vars = set()
+    if getattr(aq_base(wf), '_getCompiled', None) is not None:
+        for id, vdef in wf._getCompiled().variables.items():
+            if vdef.for_catalog:
+                other_vars.add(id)
+    _getPendingChanges(create=True).append(
+        (wf.state_var, state_ids, other_vars))
+    request = getRequest()
+    if request is not None:
+        memo = request.get('_wl_count_cache', None)
+        if memo:
+            memo.clear()
+
+
+def countCatalogResults(criteria):
+    """Return the number of catalog entries matching 'criteria'.
+
+    The brains are not fetched.  Counts are memoized in the current
+    request and shared between requests, see COUNT_CACHE_TTL, keyed by
+    the catalog's database and path, the principals it filters on and
+    the criteria.  Worklists of different workflows with the same
+    criteria thus share one query.
+    """
+    ctool = getUtility(ICatalogTool)
+    try:
+        frozen = _freeze(criteria)
+    except TypeError:
+        # Unhashable criteria.
+        return _countResults(ctool, criteria)
+    key = (_getCatalogKey(ctool),
+           _getPrincipals(ctool, getSecurityManager().getUser()), frozen)
+    request = getRequest()
+    memo = None
+    if request is not None:
+        memo = request.get('_wl_count_cache', None)
+        if memo is None:
+            request['_wl_count_cache'] = memo = {}
+        count = memo.get(key)
+        if count is not None:
+            return count
+    # Counts seen by a transaction with pending transitions are private.
+    shared = _getPendingChanges() is None
+    count = None
+    if shared:
+        with _count_cache_lock:
+            entry = _count_cache.get(key)
+            generation = _count_cache_generation
+        if entry is not None and entry[1] > time.time():
+            count = entry[0]
+    if count is None:
+        count = _countResults(ctool, criteria)
+        if shared:
+            with _count_cache_lock:
+                # Don't store counts which were invalidated meanwhile.
+                if generation == _count_cache_generation:
+                    if len(_count_cache) >= _MAX_CACHED_COUNTS:
+                        _count_cache.clear()
+                    _count_cache[key] = (count, time.time() + COUNT_CACHE_TTL)
+    if memo is not None:
+        memo[key] = count
+    return count
+
+
+def _countResults(ctool, criteria):
+    results = ctool.searchResults(**criteria)
+    count = getattr(results, 'actual_result_count', None)
+    if count is None:
+        count = len(results)
+    return count
+
+
+class WorklistDefinition(CompiledSource, SimpleItem):
 
     """Worklist definiton"""
 
@@ -153,37 +343,69 @@ class WorklistDefinition(SimpleItem):
             self.guard = g
         else:
             self.guard = None
+        invalidateCompiledWorkflow(self)
         if REQUEST is not None:
             return self.manage_properties(REQUEST, 'Properties changed.')
 
-    def search(self, info=None, **kw):
+    def search(self, info=None, count_only=False, limit=None, **kw):
         """ Perform the search corresponding to this worklist
 
         Returns sequence of ZCatalog brains
         - info is a mapping for resolving formatted string variable references
+        - count_only returns the number of matches instead, without
+          creating brains
+        - limit returns at most that many brains; it is passed to the
+          catalog as sort_limit
         - additional keyword/value pairs may be used to restrict the query
         """
-        if not self.var_matches:
+        criteria = self._getCriteria(info, **kw)
+        if criteria is None:
             return
 
-        if info is None:
-            info = {}
+        if count_only:
+            return countCatalogResults(criteria)
 
-        criteria = {}
+        if limit is not None:
+            criteria.setdefault('sort_limit', limit)
+        ctool = getUtility(ICatalogTool)
+        results = ctool.searchResults(**criteria)
+        if limit is not None:
+            results = results[:limit]
+        return results
 
-        for key, values in self.var_matches.items():
-            if isinstance(values, Expression):
-                wf = self.getWorkflow()
-                portal = wf._getPortalRoot()
-                context = createExprContext(StateChangeInfo(portal, wf))
-                criteria[key] = values(context)
-            else:
-                criteria[key] = [x % info for x in values]
+    def _getCriteria(self, info=None, **kw):
+        # Return the catalog query of this worklist, or None.
+        if not self.var_matches:
+            return None
 
-        criteria.update(kw)
+        if info is None:
+            info = {}
 
-        ctool = getUtility(ICatalogTool)
-        return ctool.searchResults(**criteria)
+        criteria = self._getCompiled().getCriteria(info, self._getExprContext)
+        criteria.update(kw)
+        return criteria
+
+    def _getCompiled(self):
+        # Return the criteria template from the workflow's snapshot.
+        wf = self.getWorkflow()
+        if getattr(aq_base(wf), '_getCompiled', None) is not None:
+            compiled = wf._getCompiled().worklists.get(self.getId())
+            if compiled is not None:
+                return compiled
+        return CompiledWorklist(self)
+
+    def _getExprContext(self):
+        wf = self.getWorkflow()
+        portal = wf._getPortalRoot()
+        return createExprContext(StateChangeInfo(portal, wf))
+
+    def countResults(self, info=None, **kw):
+        """ Return the number of catalog entries in this worklist
+
+        Same as search with count_only set.  Returns None if the worklist
+        has no criteria.
+        """
+        return self.search(info, count_only=True, **kw)
 
 
 InitializeClass(WorklistDefinition)
@@ -13,7 +13,8 @@
 """DCWorkflowDefinition browser views.
 """
 
-from xml.dom.minidom import parseString
+import hashlib
+from xml.parsers import expat
 
 from Products.GenericSetup.browser.utils import AddWithPresettingsViewBase
 from Products.GenericSetup.interfaces import IBody
@@ -24,6 +25,67 @@ from zope.component import queryUtility
 from ..DCWorkflow import DCWorkflowDefinition
 
 
+_CHUNK_SIZE = 4096
+
+# (profile id, filename) -> (last modified, digest of body, workflow id)
+_workflow_ids = {}
+
+
+class _RootElementFound(Exception):
+    pass
+
+
+def _readWorkflowId(body):
+    """ Return the 'workflow_id' attribute of the root element of 'body'.
+
+    o Parsing stops at the end of the root element's start tag.
+    """
+    found = []
+
+    def startElement(name, attrs):
+        found.append(attrs.get('workflow_id', ''))
+        raise _RootElementFound
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = startElement
+    try:
+        for i in range(0, len(body), _CHUNK_SIZE):
+            parser.Parse(body[i:i + _CHUNK_SIZE], False)
+        parser.Parse(b'', True)
+    except _RootElementFound:
+        pass
+    return found[0]
+
+
+def _getWorkflowId(context, profile_id, filename):
+    """ Return the workflow id of the definition in 'filename'.
+
+    o Return None if the file does not exist.  The ids are cached, and
+      the file is only read again if it was modified since.
+    """
+    key = (profile_id, filename)
+    cached = _workflow_ids.get(key)
+    mtime = context.getLastModified(filename)
+    if cached is not None and mtime is not None and cached[0] == mtime:
+        return cached[2]
+
+    body = context.readDataFile(filename)
+    if body is None:
+        _workflow_ids.pop(key, None)
+        return None
+
+    if isinstance(body, str):
+        digest = hashlib.sha1(body.encode('utf-8')).hexdigest()
+    else:
+        digest = hashlib.sha1(body).hexdigest()
+    if cached is not None and cached[1] == digest:
+        workflow_id = cached[2]
+    else:
+        workflow_id = _readWorkflowId(body)
+    _workflow_ids[key] = (mtime, digest, workflow_id)
+    return workflow_id
+
+
 class DCWorkflowDefinitionAddView(AddWithPresettingsViewBase):
 
     """Add view for DCWorkflowDefinition.
@@ -43,11 +105,9 @@ class DCWorkflowDefinitionAddView(AddWithPresettingsViewBase):
                 file_ids = context.listDirectory('workflows')
                 for file_id in file_ids or ():
                     filename = 'workflows/%s/definition.xml' % file_id
-                    body = context.readDataFile(filename)
-                    if body is None:
+                    obj_id = _getWorkflowId(context, info['id'], filename)
+                    if obj_id is None:
                         continue
-                    root = parseString(body).documentElement
-                    obj_id = root.getAttribute('workflow_id')
                     obj_ids.append(obj_id)
                 if not obj_ids:
                     continue
@@ -66,12 +126,11 @@ class DCWorkflowDefinitionAddView(AddWithPresettingsViewBase):
         file_ids = context.listDirectory('workflows')
         for file_id in file_ids or ():
             filename = 'workflows/%s/definition.xml' % file_id
-            body = context.readDataFile(filename)
-            if body is None:
+            if _getWorkflowId(context, profile_id, filename) != obj_path[0]:
                 continue
 
-            root = parseString(body).documentElement
-            if not root.getAttribute('workflow_id') == obj_path[0]:
+            body = context.readDataFile(filename)
+            if body is None:
                 continue
 
             importer = queryMultiAdapter((obj, context), IBody)
@@ -0,0 +1,264 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Compiled, read-only snapshot of a workflow definition.
+
+The workflow engine reads states, transitions and variables from this
+snapshot instead of walking the persistent containers on every call.
+A snapshot is built once per ZODB connection and is discarded whenever
+the definition changes (see DCWorkflowDefinition._invalidateCompiled).
+Attributes which are set directly on states, transitions, variables,
+worklists or guards change the definition as well (see
+utils.CompiledSource).
+"""
+
+from Acquisition import aq_base
+
+from .Expression import getCompiledExpression
+from .Guard import checkGuard
+from .Guard import isGuardCacheable
+from .Transitions import TRIGGER_AUTOMATIC
+from .utils import CompiledSource
+
+
+class CompiledGuard:
+
+    """Plain copy of the data of a Guard.
+    """
+
+    __slots__ = ('permissions', 'roles', 'groups', 'expr', 'cacheable')
+
+    def __init__(self, guard):
+        self.permissions = tuple(guard.permissions or ())
+        self.roles = tuple(guard.roles or ())
+        self.groups = tuple(guard.groups or ())
+        self.expr = compileExpression(guard.expr)
+        self.cacheable = isGuardCacheable(guard)
+
+    def check(self, sm, wf_def, ob, **kw):
+        """Checks conditions in this guard.
+        """
+        return checkGuard(self, sm, wf_def, ob, **kw)
+
+
+def compileGuard(guard):
+    """Return a CompiledGuard for 'guard', or None if there is no guard.
+    """
+    if guard is None:
+        return None
+    return CompiledGuard(guard)
+
+
+def compileExpression(expr):
+    """Return the shared CompiledExpression for 'expr', or None.
+    """
+    if expr is None:
+        return None
+    return getCompiledExpression(expr)
+
+
+class CompiledTransition:
+
+    """Plain copy of the data of a TransitionDefinition.
+    """
+
+    __slots__ = ('id', 'new_state_id', 'trigger_type', 'guard',
+                 'actbox_name', 'actbox_url', 'actbox_icon',
+                 'actbox_category', 'var_exprs', 'script_name',
+                 'after_script_name')
+
+    def __init__(self, tdef):
+        self.id = tdef.getId()
+        self.new_state_id = tdef.new_state_id
+        self.trigger_type = tdef.trigger_type
+        self.guard = compileGuard(tdef.guard)
+        self.actbox_name = tdef.actbox_name
+        self.actbox_url = tdef.actbox_url
+        self.actbox_icon = tdef.actbox_icon
+        self.actbox_category = tdef.actbox_category
+        self.var_exprs = {}
+        for id, expr in (tdef.var_exprs or {}).items():
+            self.var_exprs[id] = compileExpression(expr)
+        self.script_name = tdef.script_name
+        self.after_script_name = tdef.after_script_name
+
+
+class CompiledState:
+
+    """Plain copy of the data of a StateDefinition.
+
+    'transitions' holds the CompiledTransition objects of the exit
+    transitions which exist in the workflow, in declared order, while
+    'transition_ids' holds all declared exit transition ids.
+    'automatic_transitions' holds those of 'transitions' which are
+    triggered automatically.
+    """
+
+    __slots__ = ('id', 'transitions', 'transition_ids',
+                 'automatic_transitions', 'permission_roles', 'group_roles',
+                 'var_values')
+
+    def __init__(self, sdef, transitions):
+        self.id = sdef.getId()
+        self.transition_ids = frozenset(sdef.transitions)
+        self.transitions = tuple([transitions[tid]
+                                  for tid in sdef.transitions
+                                  if tid in transitions])
+        self.automatic_transitions = tuple(
+            [t for t in self.transitions
+             if t.trigger_type == TRIGGER_AUTOMATIC])
+        self.permission_roles = dict(sdef.permission_roles or {})
+        self.group_roles = dict(sdef.group_roles or {})
+        self.var_values = dict(sdef.var_values or {})
+
+
+class CompiledVariable:
+
+    """Plain copy of the data of a VariableDefinition.
+    """
+
+    __slots__ = ('id', 'for_catalog', 'for_status', 'update_always',
+                 'default_value', 'default_expr', 'info_guard')
+
+    def __init__(self, id, vdef):
+        self.id = id
+        self.for_catalog = vdef.for_catalog
+        self.for_status = vdef.for_status
+        self.update_always = vdef.update_always
+        self.default_value = vdef.default_value
+        self.default_expr = compileExpression(vdef.default_expr)
+        self.info_guard = compileGuard(vdef.info_guard)
+
+
+def _adopt(ob, workflow):
+    # Tell sources stored before their owner was recorded which
+    # definition they belong to, without writing to them.
+    if ob._compiled_owner is None:
+        ob._v_compiled_owner = aq_base(workflow)
+        for value in list(vars(ob).values()):
+            if isinstance(value, CompiledSource):
+                _adopt(value, workflow)
+
+
+class CompiledWorklist:
+
+    """Catalog criteria template of a WorklistDefinition.
+
+    o 'constants' -- (key, value) pairs of criteria which do not change.
+
+    o 'formatted' -- (key, values) pairs of criteria whose values are
+      formatted with the 'info' mapping of each search.
+
+    o 'expressions' -- (key, CompiledExpression) pairs of criteria which
+      are evaluated for each search.
+    """
+
+    __slots__ = ('id', 'constants', 'formatted', 'expressions')
+
+    def __init__(self, qdef):
+        self.id = qdef.getId()
+        constants = []
+        formatted = []
+        expressions = []
+        for key, values in (qdef.var_matches or {}).items():
+            if isinstance(values, str):
+                # Old version.
+                values = (values,)
+            if isinstance(values, (tuple, list)):
+                values = tuple(values)
+                for value in values:
+                    if '%' in value:
+                        formatted.append((key, values))
+                        break
+                else:
+                    constants.append((key, values))
+                continue
+            expr = getCompiledExpression(values)
+            if expr.is_constant:
+                constants.append((key, expr.value))
+            else:
+                expressions.append((key, expr))
+        self.constants = tuple(constants)
+        self.formatted = tuple(formatted)
+        self.expressions = tuple(expressions)
+
+    def getCriteria(self, info, getExprContext):
+        """Return the criteria for 'info'.
+
+        'getExprContext' is called once, and only if there are criteria
+        which are expressions, to get the expression context they share.
+        """
+        criteria = {}
+        for key, value in self.constants:
+            if isinstance(value, tuple):
+                value = list(value)
+            criteria[key] = value
+        for key, values in self.formatted:
+            criteria[key] = [x % info for x in values]
+        if self.expressions:
+            context = getExprContext()
+            for key, expr in self.expressions:
+                criteria[key] = expr(context)
+        return criteria
+
+
+class CompiledWorkflow:
+
+    """Snapshot of the states, transitions and variables of a workflow.
+
+    o 'serial' -- the value of the workflow's '_compiled_serial' when
+      the snapshot was built.
+
+    o 'states' -- a mapping of state id to CompiledState.
+
+    o 'transitions' -- a mapping of transition id to CompiledTransition.
+
+    o 'variables' -- a mapping of variable id to CompiledVariable, in
+      the order of the workflow's variables container.
+
+    o 'worklists' -- a mapping of worklist id to CompiledWorklist.
+    """
+
+    def __init__(self, workflow):
+        self.serial = workflow._compiled_serial
+        self.transitions = transitions = {}
+        for tid, tdef in workflow.transitions.rawItems():
+            transitions[tid] = CompiledTransition(tdef)
+        self.states = states = {}
+        for sid, sdef in workflow.states.rawItems():
+            states[sid] = CompiledState(sdef, transitions)
+        self.variables = variables = {}
+        for vid, vdef in workflow.variables.rawItems():
+            variables[vid] = CompiledVariable(vid, vdef)
+        self.worklists = worklists = {}
+        for qid, qdef in workflow.worklists.rawItems():
+            worklists[qid] = CompiledWorklist(qdef)
+        for container in (workflow.transitions, workflow.states,
+                          workflow.variables, workflow.worklists):
+            for ob in container.rawValues():
+                _adopt(ob, workflow)
+
+    def hasSameRoleMappings(self, old_state_id, new_state_id):
+        """Tell whether two states have the same role mappings.
+
+        Returns True if the permission and group settings of the states
+        are the same, so that moving an object from one to the other
+        leaves its settings alone.
+        """
+        if old_state_id == new_state_id:
+            return old_state_id in self.states
+        old_sdef = self.states.get(old_state_id, None)
+        new_sdef = self.states.get(new_state_id, None)
+        if old_sdef is None or new_sdef is None:
+            return False
+        return (old_sdef.permission_roles == new_sdef.permission_roles and
+                old_sdef.group_roles == new_sdef.group_roles)
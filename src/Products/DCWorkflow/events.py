@@ -1,6 +1,7 @@
 from zope.interface import implementer
 from zope.interface.interfaces import ObjectEvent
 
+from .interfaces import IAfterBulkTransitionEvent
 from .interfaces import IAfterTransitionEvent
 from .interfaces import IBeforeTransitionEvent
 from .interfaces import ITransitionEvent
@@ -28,3 +29,13 @@ class BeforeTransitionEvent(TransitionEvent):
 @implementer(IAfterTransitionEvent)
 class AfterTransitionEvent(TransitionEvent):
     pass
+
+
+@implementer(IAfterBulkTransitionEvent)
+class AfterBulkTransitionEvent:
+
+    def __init__(self, workflow, transition, objects, kwargs):
+        self.workflow = workflow
+        self.transition = transition
+        self.objects = objects
+        self.kwargs = kwargs
@@ -13,18 +13,26 @@
 """DCWorkflow export / import support.
 """
 
+import hashlib
+import os
+import pickle
 import re
-from xml.dom.minidom import parseString
+import threading
+import weakref
+from io import BytesIO
+from xml.parsers import expat
 
 from AccessControl.class_init import InitializeClass
 from AccessControl.SecurityInfo import ClassSecurityInfo
 from Acquisition import Implicit
+from Acquisition import aq_base
+from Acquisition import aq_inner
+from Acquisition import aq_parent
 from OFS.DTMLMethod import DTMLMethod
 from Persistence import PersistentMapping
 from Products.ExternalMethod.ExternalMethod import ExternalMethod
 from Products.GenericSetup.interfaces import ISetupEnviron
 from Products.GenericSetup.utils import BodyAdapterBase
-from Products.PageTemplates.PageTemplateFile import PageTemplateFile
 from Products.PythonScripts.PythonScript import PythonScript
 from zope.component import adapts
 
@@ -33,8 +41,8 @@ from Products.CMFCore.permissions import ManagePortal
 
 from .DCWorkflow import DCWorkflowDefinition
 from .Guard import Guard
+from .history import HISTORY_FORMATS
 from .interfaces import IDCWorkflowDefinition
-from .utils import _xmldir
 
 
 TRIGGER_TYPES = ('AUTOMATIC', 'USER')
@@ -58,7 +66,18 @@ class DCWorkflowDefinitionBodyAdapter(BodyAdapterBase):
         """Import the object from the file body.
         """
         encoding = 'utf-8'
-        wfdc = WorkflowDefinitionConfigurator(self.context)
+        parsed = None
+
+        if _import_executor is not None:
+            self._parseSiblings(_import_executor)
+            parsed = _popParsedDefinition(body)
+
+        if parsed is None:
+            parsed = self._loadPrecompiled(getattr(self, 'filename', None),
+                                           body)
+
+        if parsed is None:
+            parsed = _parseWorkflowXML(body, encoding)
 
         (_workflow_id,
          title,
@@ -73,8 +92,10 @@ class DCWorkflowDefinitionBodyAdapter(BodyAdapterBase):
          scripts,
          description,
          manager_bypass,
-         creation_guard
-         ) = wfdc.parseWorkflowXML(body, encoding)
+         creation_guard,
+         history_format,
+         keep_current_status
+         ) = parsed
 
         _initDCWorkflow(self.context,
                         title,
@@ -90,7 +111,10 @@ class DCWorkflowDefinitionBodyAdapter(BodyAdapterBase):
                         permissions,
                         groups,
                         scripts,
-                        self.environ)
+                        self.environ,
+                        incremental=True,
+                        history_format=history_format,
+                        keep_current_status=keep_current_status)
 
     body = property(_exportBody, _importBody)
 
@@ -98,6 +122,70 @@ class DCWorkflowDefinitionBodyAdapter(BodyAdapterBase):
 
     suffix = '/definition.xml'
 
+    def _loadPrecompiled(self, filename, body):
+        """ Return the parsed definition from the precompiled file.
+
+        o Return None if there is none or it does not match 'body'.
+        """
+        if not filename or not filename.endswith('.xml'):
+            return None
+        data = self.environ.readDataFile(
+            filename[:-len('.xml')] + PRECOMPILED_SUFFIX)
+        if data is None:
+            return None
+        return loadPrecompiledDefinition(data, body)
+
+    def _parseSiblings(self, executor):
+        """ Parse the definitions of all DC workflows in the tool at once.
+
+        o This happens once per import context, when the first workflow
+          is imported; the others find their result in the cache.
+        """
+        filename = getattr(self, 'filename', None)
+        if not filename or not filename.endswith(self.suffix):
+            return
+
+        global _parsed_context
+        with _parsed_lock:
+            if _parsed_context is not None and \
+                    _parsed_context() is self.environ:
+                return
+            _parsed_context = weakref.ref(self.environ,
+                                          _forgetParsedDefinitions)
+            _parsed_definitions.clear()
+
+        path = filename[:-len(self.suffix)]
+        prefix = '/' in path and path.rsplit('/', 1)[0] + '/' or ''
+        tool = aq_parent(aq_inner(self.context))
+        bodies = []
+
+        for workflow in tool.objectValues():
+            if not IDCWorkflowDefinition.providedBy(workflow):
+                continue
+            sibling = '{}{}{}'.format(
+                prefix, workflow.getId().replace(' ', '_'), self.suffix)
+            body = self.environ.readDataFile(sibling)
+            if body is None:
+                continue
+            parsed = self._loadPrecompiled(sibling, body)
+            if parsed is not None:
+                with _parsed_lock:
+                    _parsed_definitions[_getDigest(body)] = parsed
+            else:
+                bodies.append(body)
+
+        futures = [executor.submit(_parseWorkflowXML, body)
+                   for body in bodies]
+
+        for body, future in zip(bodies, futures):
+            try:
+                parsed = future.result()
+            except Exception:
+                # Reported when the definition itself is imported.
+                continue
+            with _parsed_lock:
+                _parsed_definitions[_getDigest(body)] = parsed
+
 
 class WorkflowDefinitionConfigurator(Implicit):
     """ Synthesize XML description of site's workflows.
@@ -141,8 +229,18 @@ class WorkflowDefinitionConfigurator(Implicit):
     def generateWorkflowXML(self):
         """ Pseudo API.
         """
-        return self._workflowConfig(workflow_id=self._obj.getId())\
-            .encode('utf-8')
+        stream = BytesIO()
+        self.writeWorkflowXML(stream)
+        return stream.getvalue()
+
+    @security.protected(ManagePortal)
+    def writeWorkflowXML(self, stream):
+        """ Write the XML description of the workflow to 'stream'.
+
+        o 'stream' is a binary file-like object.  The output is encoded
+          as UTF-8.
+        """
+        _writeWorkflowXML(self._obj, self._obj.getId(), stream)
 
     @security.protected(ManagePortal)
     def getWorkflowScripts(self):
@@ -151,53 +249,17 @@ class WorkflowDefinitionConfigurator(Implicit):
         return self._extractScripts(self._obj)
 
     @security.protected(ManagePortal)
-    def parseWorkflowXML(self, xml, encoding='utf-8'):
+    def parseWorkflowXML(self, xml, encoding='utf-8', settings=None):
         """ Pseudo API.
+
+        o If 'settings' is a dictionary, it gets updated with the
+          'history_format' and 'keep_current_status' of the workflow.
         """
-        dom = parseString(xml)
-
-        root = dom.getElementsByTagName('dc-workflow')[0]
-
-        workflow_id = _getNodeAttribute(root, 'workflow_id', encoding)
-        title = _getNodeAttribute(root, 'title', encoding)
-        try:
-            description = _getNodeAttribute(root, 'description', encoding)
-        except ValueError:
-            # Don't fail on export files that do not have the description
-            # field!
-            description = ''
-        manager_bypass = _queryNodeAttributeBoolean(root, 'manager_bypass',
-                                                    False)
-        creation_guard = _extractCreationGuard(root, encoding)
-        state_variable = _getNodeAttribute(root, 'state_variable', encoding)
-        initial_state = _getNodeAttribute(root, 'initial_state', encoding)
-
-        states = _extractStateNodes(root, encoding)
-        transitions = _extractTransitionNodes(root, encoding)
-        variables = _extractVariableNodes(root, encoding)
-        worklists = _extractWorklistNodes(root, encoding)
-        permissions = _extractPermissionNodes(root, encoding)
-        groups = _extractGroupNodes(root, encoding)
-        scripts = _extractScriptNodes(root, encoding)
-
-        return (workflow_id,
-                title,
-                state_variable,
-                initial_state,
-                states,
-                transitions,
-                variables,
-                worklists,
-                permissions,
-                groups,
-                scripts,
-                description,
-                manager_bypass,
-                creation_guard)
-
-    security.declarePrivate('_workflowConfig')
-    _workflowConfig = PageTemplateFile('wtcWorkflowExport.xml', _xmldir,
-                                       __name__='workflowConfig')
+        parsed = _parseWorkflowXML(xml, encoding)
+        if settings is not None:
+            settings['history_format'] = parsed[14]
+            settings['keep_current_status'] = parsed[15]
+        return parsed[:14]
 
     @security.private
     def _extractDCWorkflowInfo(self, workflow, workflow_info):
@@ -211,6 +273,12 @@ class WorkflowDefinitionConfigurator(Implicit):
 
           'creation_guard' -- the guard of 'Instance creation conditions'
 
+          'history_format' -- the format of the workflow histories of
+            objects, see 'history.HISTORY_FORMATS'
+
+          'keep_current_status' -- 'True' if the current status of objects
+            is kept apart from their history, else 'False'
+
           'permissions' -- a list of names of permissions managed
             by the workflow
 
@@ -238,6 +306,9 @@ class WorkflowDefinitionConfigurator(Implicit):
             provide added business logic (see '_extractScripts').
         """
         workflow_info['manager_bypass'] = str(bool(workflow.manager_bypass))
+        workflow_info['history_format'] = workflow.history_format
+        workflow_info['keep_current_status'] = str(
+            bool(workflow.keep_current_status))
         workflow_info['creation_guard'] = self._extractCreationGuard(workflow)
         workflow_info['state_variable'] = workflow.state_var
         workflow_info['initial_state'] = workflow.initial_state
@@ -259,7 +330,8 @@ class WorkflowDefinitionConfigurator(Implicit):
             info = {'guard_permissions': guard.permissions,
                     'guard_roles': guard.roles,
                     'guard_groups': guard.groups,
-                    'guard_expr': guard.getExprText()}
+                    'guard_expr': guard.getExprText(),
+                    'guard_cacheable': guard.getCacheableText()}
             return info
 
     @security.private
@@ -314,7 +386,8 @@ class WorkflowDefinitionConfigurator(Implicit):
                     'guard_permissions': guard.permissions,
                     'guard_roles': guard.roles,
                     'guard_groups': guard.groups,
-                    'guard_expr': guard.getExprText()}
+                    'guard_expr': guard.getExprText(),
+                    'guard_cacheable': guard.getCacheableText()}
 
             result.append(info)
 
@@ -500,7 +573,8 @@ class WorkflowDefinitionConfigurator(Implicit):
                     'guard_permissions': guard.permissions,
                     'guard_roles': guard.roles,
                     'guard_groups': guard.groups,
-                    'guard_expr': guard.getExprText()}
+                    'guard_expr': guard.getExprText(),
+                    'guard_cacheable': guard.getCacheableText()}
 
             result.append(info)
 
@@ -564,7 +638,8 @@ class WorkflowDefinitionConfigurator(Implicit):
                     'guard_permissions': guard.permissions,
                     'guard_roles': guard.roles,
                     'guard_groups': guard.groups,
-                    'guard_expr': guard.getExprText()}
+                    'guard_expr': guard.getExprText(),
+                    'guard_cacheable': guard.getCacheableText()}
 
             result.append(info)
 
@@ -632,277 +707,744 @@ def _getScriptFilename(workflow_id, script_id, meta_type):
     return f'workflows/{wf_dir}/scripts/{script_id}.{suffix}'
 
 
-def _extractCreationGuard(root, encoding='utf-8'):
-    icc = root.getElementsByTagName('instance-creation-conditions')
-    assert len(icc) <= 1
-    if icc:
-        parent = icc[0]
-        return _extractGuardNode(parent, encoding)
-    else:
-        return None
+#
+#   Direct exporter
+#
+def _escapeText(value):
+    if value is None:
+        return ''
+    return str(value).replace('&', '&amp;').replace('<', '&lt;') \
+        .replace('>', '&gt;')
 
 
-def _extractStateNodes(root, encoding='utf-8'):
-    result = []
+def _escapeAttribute(value):
+    return _escapeText(value).replace('"', '&quot;')
 
-    for s_node in root.getElementsByTagName('state'):
-        info = {'state_id': _getNodeAttribute(s_node, 'state_id', encoding),
-                'title': _getNodeAttribute(s_node, 'title', encoding),
-                'description': _extractDescriptionNode(s_node, encoding)}
 
-        info['transitions'] = [_getNodeAttribute(x, 'transition_id', encoding)
-                               for x in s_node.getElementsByTagName(
-            'exit-transition')]
+def _startTag(name, attrs, end='>'):
+    """ Return a start tag, leaving out the attributes whose value is None.
+    """
+    parts = ['<', name]
+    for attr_name, value in attrs:
+        if value is not None:
+            parts.append(f' {attr_name}="{_escapeAttribute(value)}"')
+    parts.append(end)
+    return ''.join(parts)
 
-        info['permissions'] = permission_map = {}
 
-        for p_map in s_node.getElementsByTagName('permission-map'):
+def _textElement(indent, name, value, attrs=()):
+    return '\n{}{}{}</{}>'.format(indent, _startTag(name, attrs),
+                                  _escapeText(value), name)
 
-            name = _getNodeAttribute(p_map, 'name', encoding)
-            acquired = _queryNodeAttributeBoolean(p_map, 'acquired', False)
 
-            roles = [_coalesceTextNodeChildren(x, encoding)
-                     for x in p_map.getElementsByTagName('permission-role')]
+def _workflowStatusAttrs(workflow):
+    # Only written if they differ from the defaults.
+    attrs = ()
+    if workflow.history_format:
+        attrs += (('history_format', workflow.history_format),)
+    if workflow.keep_current_status:
+        attrs += (('keep_current_status', 'True'),)
+    return attrs
 
-            if not acquired:
-                roles = tuple(roles)
 
-            permission_map[name] = roles
+def _writeWorkflowXML(workflow, workflow_id, stream):
+    """ Write the 'dc-workflow' document of 'workflow' to 'stream'.
 
-        info['groups'] = group_map = []
+    o The output is encoded as UTF-8 and written one top-level element
+      at a time.
+    """
+    def flush(parts):
+        stream.write(''.join(parts).encode('utf-8'))
+        del parts[:]
+
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n',
+             _startTag('dc-workflow',
+                       (('workflow_id', workflow_id),
+                        ('title', workflow.title_or_id()),
+                        ('description', workflow.description),
+                        ('state_variable', workflow.state_var),
+                        ('initial_state', workflow.initial_state),
+                        ('manager_bypass',
+                         str(bool(workflow.manager_bypass)))) +
+                       _workflowStatusAttrs(workflow))]
+    add = parts.append
+
+    guard = workflow.creation_guard
+    if guard is not None:
+        add('\n <instance-creation-conditions>\n   ' + _guardTag(guard))
+        _addGuardItems(add, guard, '    ')
+        add('\n   </guard>\n </instance-creation-conditions>')
+
+    for group in workflow.groups or ():
+        add(_textElement(' ', 'group', group))
+
+    for permission in workflow.permissions or ():
+        add(_textElement(' ', 'permission', permission))
+    flush(parts)
+
+    for state_id, state in sorted(workflow.states.objectItems()):
+        _addState(add, state_id, state)
+        flush(parts)
+
+    for transition_id, tdef in sorted(workflow.transitions.objectItems()):
+        _addTransition(add, transition_id, tdef)
+        flush(parts)
+
+    for worklist_id, qdef in sorted(workflow.worklists.objectItems()):
+        _addWorklist(add, worklist_id, qdef)
+        flush(parts)
+
+    for variable_id, vdef in sorted(workflow.variables.objectItems()):
+        _addVariable(add, variable_id, vdef)
+        flush(parts)
+
+    for script_id, script in sorted(workflow.scripts.objectItems()):
+        module = ''
+        function = ''
+
+        if script.meta_type == 'External Method':
+            module = script.module()
+            function = script.function()
+
+        add('\n ' + _startTag('script',
+                              (('script_id', script_id),
+                               ('type', script.meta_type),
+                               ('filename',
+                                _getScriptFilename(workflow_id, script_id,
+                                                   script.meta_type)),
+                               ('module', module),
+                               ('function', function)),
+                              end='/>'))
+
+    add('\n</dc-workflow>\n')
+    flush(parts)
+
+
+def _guardTag(guard):
+    cacheable = guard.getCacheableText() or None
+    return _startTag('guard', (('cacheable', cacheable),))
+
+
+def _addGuardItems(add, guard, indent):
+    for name, values in (('guard-permission', guard.permissions),
+                         ('guard-role', guard.roles),
+                         ('guard-group', guard.groups)):
+        for value in values or ():
+            add(_textElement(indent, name, value))
+
+    expr = guard.getExprText()
+    if expr:
+        add(_textElement(indent, 'guard-expression', expr))
+
+
+def _addDescription(add, description):
+    if description:
+        add(_textElement('  ', 'description', description))
+
+
+def _addAction(add, actbox_name, actbox_url, actbox_category, actbox_icon):
+    add('\n  ')
+    if actbox_name:
+        add(_startTag('action', (('url', actbox_url),
+                                 ('category', actbox_category),
+                                 ('icon', actbox_icon))))
+        add(_escapeText(actbox_name))
+        add('</action>')
+
+
+def _addState(add, state_id, state):
+    add('\n ' + _startTag('state', (('state_id', state_id),
+                                    ('title', state.title))))
+    _addDescription(add, state.description)
+
+    for transition_id in state.transitions or ():
+        add('\n  ' + _startTag('exit-transition',
+                               (('transition_id', transition_id),),
+                               end='/>'))
+
+    if state.permission_roles:
+        for name, roles in sorted(state.permission_roles.items()):
+            acquired = str(not isinstance(roles, tuple))
+            add('\n  ' + _startTag('permission-map',
+                                   (('name', name), ('acquired', acquired))))
+            for role in roles or ():
+                add(_textElement('   ', 'permission-role', role))
+            add('\n  </permission-map>')
+
+    groups = state.group_roles and list(state.group_roles.items()) or []
+    for name, roles in sorted(x for x in groups if x[1]):
+        add('\n  ' + _startTag('group-map', (('name', name),)))
+        for role in roles:
+            add(_textElement('   ', 'group-role', role))
+        add('\n  </group-map>')
+
+    for name, value in sorted(state.getVariableValues()):
+        add(_textElement('  ', 'assignment', value,
+                         (('name', name),
+                          ('type', _guessVariableType(value)))))
+
+    add('\n </state>')
+
+
+def _addTransition(add, transition_id, tdef):
+    add('\n ' + _startTag('transition',
+                          (('transition_id', transition_id),
+                           ('title', tdef.title),
+                           ('new_state', tdef.new_state_id),
+                           ('trigger', TRIGGER_TYPES[tdef.trigger_type]),
+                           ('before_script', tdef.script_name),
+                           ('after_script', tdef.after_script_name))))
+    _addDescription(add, tdef.description)
+    _addAction(add, tdef.actbox_name, tdef.actbox_url, tdef.actbox_category,
+               tdef.actbox_icon)
+    guard = tdef.getGuard()
+    add('\n  ' + _guardTag(guard))
+    _addGuardItems(add, guard, '   ')
+    add('\n  </guard>')
+
+    for name, expr in tdef.getVariableExprs():
+        add(_textElement('  ', 'assignment', expr, (('name', name),)))
+
+    add('\n </transition>')
+
+
+def _addWorklist(add, worklist_id, qdef):
+    add('\n ' + _startTag('worklist', (('worklist_id', worklist_id),
+                                       ('title', qdef.title))))
+    _addDescription(add, qdef.description)
+    _addAction(add, qdef.actbox_name, qdef.actbox_url, qdef.actbox_category,
+               qdef.actbox_icon)
+    guard = qdef.getGuard()
+    add('\n  ' + _guardTag(guard))
+    _addGuardItems(add, guard, '   ')
+    add('\n  </guard>')
+
+    # The indentation is written even if there are no matches.
+    add('\n  ' + '\n  '.join(
+        [_startTag('match',
+                   (('name', key), ('values', qdef.getVarMatchText(key))),
+                   end='/>')
+         for key in qdef.getVarMatchKeys()]))
+
+    add('\n </worklist>')
+
+
+def _addVariable(add, variable_id, vdef):
+    add('\n ' + _startTag('variable',
+                          (('variable_id', variable_id),
+                           ('for_catalog', str(bool(vdef.for_catalog))),
+                           ('for_status', str(bool(vdef.for_status))),
+                           ('update_always',
+                            str(bool(vdef.update_always))))))
+    _addDescription(add, vdef.description)
+    add('\n  <default>\n   ')
+    if vdef.default_value:
+        add(_startTag('value',
+                      (('type', _guessVariableType(vdef.default_value)),)))
+        add(_escapeText(vdef.default_value))
+        add('</value>')
+    add('\n   ')
+    expr = vdef.getDefaultExprText()
+    if expr:
+        add(_startTag('expression', ()) + _escapeText(expr) + '</expression>')
+    add('\n  </default>')
+    guard = vdef.getInfoGuard()
+    add('\n  ' + _guardTag(guard))
+    _addGuardItems(add, guard, '   ')
+    add('\n  </guard>')
+    add('\n </variable>')
 
-        for g_map in s_node.getElementsByTagName('group-map'):
 
-            name = _getNodeAttribute(g_map, 'name', encoding)
+#
+#   Streaming parser
+#
+class _Element:
 
-            roles = [_coalesceTextNodeChildren(x, encoding)
-                     for x in g_map.getElementsByTagName('group-role')]
+    """ Element of a 'dc-workflow' document, below the root element.
 
-            group_map.append((name, tuple(roles)))
+    o 'fragments' holds the element's own character data, leaving out
+      CDATA sections, as '_coalesceTextNodeChildren' does.
+    """
 
-        info['variables'] = var_map = {}
+    __slots__ = ('tag', 'attrs', 'children', 'fragments')
 
-        for assignment in s_node.getElementsByTagName('assignment'):
+    def __init__(self, tag, attrs):
+        self.tag = tag
+        self.attrs = attrs
+        self.children = []
+        self.fragments = []
 
-            name = _getNodeAttribute(assignment, 'name', encoding)
-            type_id = _getNodeAttribute(assignment, 'type', encoding)
-            value = _coalesceTextNodeChildren(assignment, encoding)
+    def iter(self, tag):
+        """ Yield the descendants named 'tag' in document order.
+        """
+        for child in self.children:
+            if child.tag == tag:
+                yield child
+            yield from child.iter(tag)
 
-            var_map[name] = {'name': name, 'type': type_id, 'value': value}
+    def getAttribute(self, attr_name):
+        value = self.attrs.get(attr_name)
 
-        result.append(info)
+        if value is None:
+            raise ValueError('Invalid attribute: %s' % attr_name)
 
-    return result
+        return value
 
+    def queryAttributeBoolean(self, attr_name, default):
+        value = self.attrs.get(attr_name)
 
-def _extractTransitionNodes(root, encoding='utf-8'):
-    result = []
+        if value is None:
+            return default
 
-    for t_node in root.getElementsByTagName('transition'):
+        return value.lower() in ('true', 'yes', '1')
 
-        info = {'transition_id': _getNodeAttribute(t_node, 'transition_id',
-                                                   encoding),
-                'title': _getNodeAttribute(t_node, 'title', encoding),
-                'description': _extractDescriptionNode(t_node, encoding),
-                'new_state': _getNodeAttribute(t_node, 'new_state', encoding),
-                'trigger': _getNodeAttribute(t_node, 'trigger', encoding),
-                'before_script': _getNodeAttribute(t_node, 'before_script',
-                                                   encoding),
-                'after_script': _getNodeAttribute(t_node, 'after_script',
-                                                  encoding),
-                'action': _extractActionNode(t_node, encoding),
-                'guard': _extractGuardNode(t_node, encoding)}
+    def getText(self):
+        joined = ''.join(self.fragments)
 
-        info['variables'] = var_map = {}
+        return ''.join([line.lstrip()
+                        for line in joined.splitlines(True)]).rstrip()
 
-        for assignment in t_node.getElementsByTagName('assignment'):
+    def findOne(self, tag):
+        nodes = list(self.iter(tag))
+        assert len(nodes) <= 1, nodes
 
-            name = _getNodeAttribute(assignment, 'name', encoding)
-            expr = _coalesceTextNodeChildren(assignment, encoding)
-            var_map[name] = expr
+        return nodes and nodes[0] or None
 
-        result.append(info)
 
-    return result
+class _WorkflowXMLParser:
 
+    """ Single pass parser for 'dc-workflow' documents.
 
-def _extractVariableNodes(root, encoding='utf-8'):
-    result = []
+    Each child of the root element is converted as soon as its end tag
+    has been read and is dropped then, so memory use does not grow with
+    the number of states, transitions or worklists.
+    """
 
-    for v_node in root.getElementsByTagName('variable'):
+    def __init__(self):
+        self.attributes = None
+        self.states = []
+        self.transitions = []
+        self.variables = []
+        self.worklists = []
+        self.permissions = []
+        self.groups = []
+        self.scripts = []
+        self.creation_guards = []
+        self._handlers = {
+            'state': (self.states, _convertState),
+            'transition': (self.transitions, _convertTransition),
+            'variable': (self.variables, _convertVariable),
+            'worklist': (self.worklists, _convertWorklist),
+            'permission': (self.permissions, _Element.getText),
+            'group': (self.groups, _Element.getText),
+            'script': (self.scripts, _convertScript),
+            'instance-creation-conditions': (self.creation_guards,
+                                             _convertGuard)}
+        self._depth = 0
+        self._root_depth = None
+        self._closed = False
+        self._stack = []
+        self._in_cdata = False
+
+    def parse(self, xml):
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self._startElement
+        parser.EndElementHandler = self._endElement
+        parser.CharacterDataHandler = self._characterData
+        parser.StartCdataSectionHandler = self._startCdataSection
+        parser.EndCdataSectionHandler = self._endCdataSection
+
+        if hasattr(xml, 'read'):
+            parser.ParseFile(xml)
+        else:
+            parser.Parse(xml, True)
 
-        info = {'variable_id': _getNodeAttribute(v_node, 'variable_id',
-                                                 encoding),
-                'description': _extractDescriptionNode(v_node, encoding),
-                'for_catalog': _queryNodeAttributeBoolean(v_node,
-                                                          'for_catalog',
-                                                          False),
-                'for_status': _queryNodeAttributeBoolean(v_node, 'for_status',
-                                                         False),
-                'update_always': _queryNodeAttributeBoolean(v_node,
-                                                            'update_always',
-                                                            False),
-                'default': _extractDefaultNode(v_node, encoding),
-                'guard': _extractGuardNode(v_node, encoding)}
+        if self.attributes is None:
+            raise ValueError('No dc-workflow element found')
 
-        result.append(info)
+    def _startElement(self, tag, attrs):
+        self._depth += 1
 
-    return result
+        if self._root_depth is None:
+            if tag == 'dc-workflow':
+                self.attributes = attrs
+                self._root_depth = self._depth
+            return
 
+        if self._closed:
+            return
 
-def _extractWorklistNodes(root, encoding='utf-8'):
-    result = []
+        element = _Element(tag, attrs)
+        if self._stack:
+            self._stack[-1].children.append(element)
+        self._stack.append(element)
 
-    for w_node in root.getElementsByTagName('worklist'):
+    def _endElement(self, tag):
+        if self._stack:
+            element = self._stack.pop()
+            if not self._stack:
+                handler = self._handlers.get(element.tag)
+                if handler is not None:
+                    result, convert = handler
+                    result.append(convert(element))
+        elif self._depth == self._root_depth:
+            self._closed = True
+        self._depth -= 1
 
-        info = {'worklist_id': _getNodeAttribute(w_node, 'worklist_id',
-                                                 encoding),
-                'title': _getNodeAttribute(w_node, 'title', encoding),
-                'description': _extractDescriptionNode(w_node, encoding),
-                'match': _extractMatchNode(w_node, encoding),
-                'action': _extractActionNode(w_node, encoding),
-                'guard': _extractGuardNode(w_node, encoding)}
+    def _characterData(self, data):
+        if self._stack and not self._in_cdata:
+            self._stack[-1].fragments.append(data)
 
-        result.append(info)
+    def _startCdataSection(self):
+        self._in_cdata = True
 
-    return result
+    def _endCdataSection(self):
+        self._in_cdata = False
 
 
-def _extractScriptNodes(root, encoding='utf-8'):
-    result = []
+def _parseWorkflowXML(xml, encoding='utf-8'):
+    """ Parse a 'dc-workflow' document in a single pass.
 
-    for s_node in root.getElementsByTagName('script'):
+    o 'xml' is a string, bytes or a file-like object.
 
-        try:
-            function = _getNodeAttribute(s_node, 'function')
-        except ValueError:
-            function = ''
+    o Return the tuple of 'parseWorkflowXML', followed by the
+      'history_format' and 'keep_current_status' settings.
+    """
+    parser = _WorkflowXMLParser()
+    parser.parse(xml)
 
-        try:
-            module = _getNodeAttribute(s_node, 'module')
-        except ValueError:
-            module = ''
+    root = _Element('dc-workflow', parser.attributes)
+    workflow_id = root.getAttribute('workflow_id')
+    title = root.getAttribute('title')
+    # Don't fail on export files that do not have the description field!
+    description = root.attrs.get('description', '')
+    manager_bypass = root.queryAttributeBoolean('manager_bypass', False)
+    history_format = root.attrs.get('history_format', '')
+    keep_current_status = root.queryAttributeBoolean('keep_current_status',
+                                                     False)
+    assert len(parser.creation_guards) <= 1
+    creation_guard = parser.creation_guards and parser.creation_guards[0] \
+        or None
+    state_variable = root.getAttribute('state_variable')
+    initial_state = root.getAttribute('initial_state')
 
-        info = {'script_id': _getNodeAttribute(s_node, 'script_id'),
-                'meta_type': _getNodeAttribute(s_node, 'type', encoding),
-                'function': function,
-                'module': module}
+    return (workflow_id,
+            title,
+            state_variable,
+            initial_state,
+            parser.states,
+            parser.transitions,
+            parser.variables,
+            parser.worklists,
+            parser.permissions,
+            parser.groups,
+            parser.scripts,
+            description,
+            manager_bypass,
+            creation_guard,
+            history_format,
+            keep_current_status)
 
-        filename = _queryNodeAttribute(s_node, 'filename', None, encoding)
 
-        if filename is not None:
-            info['filename'] = filename
+def _convertDescription(parent):
+    for node in parent.iter('description'):
+        return node.getText()
+    return ''
 
-        result.append(info)
 
-    return result
+def _convertState(s_node):
+    info = {'state_id': s_node.getAttribute('state_id'),
+            'title': s_node.getAttribute('title'),
+            'description': _convertDescription(s_node)}
 
+    info['transitions'] = [x.getAttribute('transition_id')
+                           for x in s_node.iter('exit-transition')]
 
-def _extractPermissionNodes(root, encoding='utf-8'):
-    result = []
+    info['permissions'] = permission_map = {}
 
-    for p_node in root.getElementsByTagName('permission'):
+    for p_map in s_node.iter('permission-map'):
 
-        result.append(_coalesceTextNodeChildren(p_node, encoding))
+        name = p_map.getAttribute('name')
+        acquired = p_map.queryAttributeBoolean('acquired', False)
 
-    return result
+        roles = [x.getText() for x in p_map.iter('permission-role')]
 
+        if not acquired:
+            roles = tuple(roles)
 
-def _extractGroupNodes(root, encoding='utf-8'):
-    result = []
+        permission_map[name] = roles
 
-    for p_node in root.getElementsByTagName('group'):
+    info['groups'] = group_map = []
 
-        result.append(_coalesceTextNodeChildren(p_node, encoding))
+    for g_map in s_node.iter('group-map'):
 
-    return result
+        name = g_map.getAttribute('name')
+        roles = [x.getText() for x in g_map.iter('group-role')]
+        group_map.append((name, tuple(roles)))
 
+    info['variables'] = var_map = {}
 
-def _extractActionNode(parent, encoding='utf-8'):
-    nodes = parent.getElementsByTagName('action')
-    assert len(nodes) <= 1, nodes
+    for assignment in s_node.iter('assignment'):
 
-    if len(nodes) < 1:
-        return {'name': '', 'url': '', 'category': '', 'icon': ''}
+        name = assignment.getAttribute('name')
+        type_id = assignment.getAttribute('type')
+        value = assignment.getText()
 
-    node = nodes[0]
+        var_map[name] = {'name': name, 'type': type_id, 'value': value}
 
-    return {'name': _coalesceTextNodeChildren(node, encoding),
-            'url': _getNodeAttribute(node, 'url', encoding),
-            'category': _getNodeAttribute(node, 'category', encoding),
-            'icon': _queryNodeAttribute(node, 'icon', '', encoding)}
+    return info
 
 
-def _extractGuardNode(parent, encoding='utf-8'):
-    nodes = parent.getElementsByTagName('guard')
-    assert len(nodes) <= 1, nodes
+def _convertTransition(t_node):
+    info = {'transition_id': t_node.getAttribute('transition_id'),
+            'title': t_node.getAttribute('title'),
+            'description': _convertDescription(t_node),
+            'new_state': t_node.getAttribute('new_state'),
+            'trigger': t_node.getAttribute('trigger'),
+            'before_script': t_node.getAttribute('before_script'),
+            'after_script': t_node.getAttribute('after_script'),
+            'action': _convertAction(t_node),
+            'guard': _convertGuard(t_node)}
 
-    if len(nodes) < 1:
-        return {'permissions': (), 'roles': (), 'groups': (), 'expr': ''}
+    info['variables'] = var_map = {}
 
-    node = nodes[0]
+    for assignment in t_node.iter('assignment'):
+        var_map[assignment.getAttribute('name')] = assignment.getText()
 
-    expr_nodes = node.getElementsByTagName('guard-expression')
-    assert len(expr_nodes) <= 1
+    return info
 
-    expr_text = expr_nodes and _coalesceTextNodeChildren(expr_nodes[0],
-                                                         encoding) or ''
 
-    return {'permissions': [_coalesceTextNodeChildren(x, encoding)
-                            for x in node.getElementsByTagName(
-        'guard-permission')],
-        'roles': [_coalesceTextNodeChildren(x, encoding)
-                  for x in node.getElementsByTagName('guard-role')],
-        'groups': [_coalesceTextNodeChildren(x, encoding)
-                   for x in node.getElementsByTagName('guard-group')],
-        'expression': expr_text}
+def _convertVariable(v_node):
+    return {'variable_id': v_node.getAttribute('variable_id'),
+            'description': _convertDescription(v_node),
+            'for_catalog': v_node.queryAttributeBoolean('for_catalog',
+                                                        False),
+            'for_status': v_node.queryAttributeBoolean('for_status', False),
+            'update_always': v_node.queryAttributeBoolean('update_always',
+                                                          False),
+            'default': _convertDefault(v_node),
+            'guard': _convertGuard(v_node)}
 
 
-def _extractDefaultNode(parent, encoding='utf-8'):
-    nodes = parent.getElementsByTagName('default')
-    assert len(nodes) <= 1, nodes
+def _convertWorklist(w_node):
+    return {'worklist_id': w_node.getAttribute('worklist_id'),
+            'title': w_node.getAttribute('title'),
+            'description': _convertDescription(w_node),
+            'match': _convertMatch(w_node),
+            'action': _convertAction(w_node),
+            'guard': _convertGuard(w_node)}
 
-    if len(nodes) < 1:
-        return {'value': '', 'expression': '', 'type': 'n/a'}
 
-    node = nodes[0]
+def _convertScript(s_node):
+    info = {'script_id': s_node.getAttribute('script_id'),
+            'meta_type': s_node.getAttribute('type'),
+            'function': s_node.attrs.get('function', ''),
+            'module': s_node.attrs.get('module', '')}
 
-    value_nodes = node.getElementsByTagName('value')
-    assert len(value_nodes) <= 1
+    filename = s_node.attrs.get('filename')
 
-    value_type = 'n/a'
-    if value_nodes:
-        value_type = value_nodes[0].getAttribute('type') or 'n/a'
+    if filename is not None:
+        info['filename'] = filename
 
-    value_text = value_nodes and _coalesceTextNodeChildren(value_nodes[0],
-                                                           encoding) or ''
+    return info
 
-    expr_nodes = node.getElementsByTagName('expression')
-    assert len(expr_nodes) <= 1
 
-    expr_text = expr_nodes and _coalesceTextNodeChildren(expr_nodes[0],
-                                                         encoding) or ''
+def _convertAction(parent):
+    node = parent.findOne('action')
 
-    return {'value': value_text, 'type': value_type, 'expression': expr_text}
+    if node is None:
+        return {'name': '', 'url': '', 'category': '', 'icon': ''}
 
+    return {'name': node.getText(),
+            'url': node.getAttribute('url'),
+            'category': node.getAttribute('category'),
+            'icon': node.attrs.get('icon', '')}
 
-_SEMICOLON_LIST_SPLITTER = re.compile(r';[ ]*')
+
+def _convertGuard(parent):
+    node = parent.findOne('guard')
+
+    if node is None:
+        return {'permissions': (), 'roles': (), 'groups': (), 'expr': '',
+                'cacheable': ''}
+
+    expr_node = node.findOne('guard-expression')
+
+    return {'permissions': [x.getText()
+                            for x in node.iter('guard-permission')],
+            'roles': [x.getText() for x in node.iter('guard-role')],
+            'groups': [x.getText() for x in node.iter('guard-group')],
+            'expression': expr_node and expr_node.getText() or '',
+            'cacheable': node.attrs.get('cacheable', '')}
 
 
-def _extractMatchNode(parent, encoding='utf-8'):
-    nodes = parent.getElementsByTagName('match')
+def _convertDefault(parent):
+    node = parent.findOne('default')
 
+    if node is None:
+        return {'value': '', 'expression': '', 'type': 'n/a'}
+
+    value_node = node.findOne('value')
+    expr_node = node.findOne('expression')
+
+    value_type = 'n/a'
+    value_text = ''
+    if value_node is not None:
+        value_type = value_node.attrs.get('type') or 'n/a'
+        value_text = value_node.getText()
+
+    return {'value': value_text,
+            'type': value_type,
+            'expression': expr_node and expr_node.getText() or ''}
+
+
+_SEMICOLON_LIST_SPLITTER = re.compile(r';[ ]*')
+
+
+def _convertMatch(parent):
     result = {}
 
-    for node in nodes:
+    for node in parent.iter('match'):
 
-        name = _getNodeAttribute(node, 'name', encoding)
-        values = _getNodeAttribute(node, 'values', encoding)
+        name = node.getAttribute('name')
+        values = node.getAttribute('values')
         result[name] = _SEMICOLON_LIST_SPLITTER.split(values)
 
     return result
 
 
+#
+#   Concurrent parsing
+#
+_import_executor = None
+_parsed_lock = threading.RLock()
+_parsed_definitions = {}  # digest of body -> result of '_parseWorkflowXML'
+_parsed_context = None  # weak reference to the import context parsed last
+
+
+def setImportExecutor(executor):
+    """ Parse the workflow definitions of an import with 'executor'.
+
+    o 'executor' is a 'concurrent.futures.Executor'.  When the first DC
+      workflow of an import context is imported, the definitions of all
+      DC workflows in the tool are submitted to it.  Only applying them
+      to the workflows is serialized.
+
+    o Pass None to parse each definition when it is imported, which is
+      the default.
+    """
+    global _import_executor
+    _import_executor = executor
+
+
+def parseWorkflowDefinitions(bodies, executor=None):
+    """ Parse the 'dc-workflow' documents in 'bodies'.
+
+    o If 'executor' is given, the documents are parsed concurrently.
+      The results contain only builtin types, so a process pool can be
+      used.
+
+    o Return the results of 'parseWorkflowXML' in the order of 'bodies'.
+    """
+    if executor is None:
+        return [_parseWorkflowXML(body) for body in bodies]
+    return list(executor.map(_parseWorkflowXML, bodies))
+
+
+def _getDigest(body):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return hashlib.sha1(body).hexdigest()
+
+
+def _forgetParsedDefinitions(ref):
+    # Drop the results nobody imported once their context is gone.
+    global _parsed_context
+    with _parsed_lock:
+        if _parsed_context is ref:
+            _parsed_context = None
+            _parsed_definitions.clear()
+
+
+def _popParsedDefinition(body):
+    with _parsed_lock:
+        return _parsed_definitions.pop(_getDigest(body), None)
+
+
+#
+#   Precompiled definitions
+#
+PRECOMPILED_SUFFIX = '.pickle'
+PRECOMPILED_VERSION = 3  # bump when the result of '_parseWorkflowXML' changes
+_PRECOMPILED_MAGIC = b'DCWF'
+
+
+class _DefinitionUnpickler(pickle.Unpickler):
+
+    """ Unpickler which refuses everything but builtin containers.
+    """
+
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(
+            'global %s.%s is not allowed' % (module, name))
+
+
+def precompileDefinition(body):
+    """ Return the precompiled form of the 'dc-workflow' document 'body'.
+
+    o The result is stored next to 'definition.xml' as 'definition.pickle'.
+      It is used on import as long as the XML it was made from is
+      unchanged.
+    """
+    parsed = _parseWorkflowXML(body)
+    return _PRECOMPILED_MAGIC + pickle.dumps(
+        (PRECOMPILED_VERSION, _getDigest(body), parsed), protocol=2)
+
+
+def loadPrecompiledDefinition(data, body):
+    """ Return the parsed definition stored in 'data'.
+
+    o Return None if 'data' was not made from 'body' by this version of
+      'precompileDefinition' or cannot be read.
+    """
+    if not data.startswith(_PRECOMPILED_MAGIC):
+        return None
+    try:
+        version, digest, parsed = _DefinitionUnpickler(
+            BytesIO(data[len(_PRECOMPILED_MAGIC):])).load()
+    except Exception:
+        return None
+    if version != PRECOMPILED_VERSION or digest != _getDigest(body):
+        return None
+    return parsed
+
+
+def precompileDefinitions(path):
+    """ Precompile the workflow definitions of the profile at 'path'.
+
+    o Write 'definition.pickle' next to each 'definition.xml' below
+      'path' unless it is up to date.
+
+    o Return the paths of the files written.
+    """
+    written = []
+    for dirpath, _dirnames, filenames in os.walk(path):
+        if 'definition.xml' not in filenames:
+            continue
+        with open(os.path.join(dirpath, 'definition.xml'), 'rb') as f:
+            body = f.read()
+        target = os.path.join(dirpath, 'definition' + PRECOMPILED_SUFFIX)
+        if os.path.exists(target):
+            with open(target, 'rb') as f:
+                if loadPrecompiledDefinition(f.read(), body) is not None:
+                    continue
+        with open(target, 'wb') as f:
+            f.write(precompileDefinition(body))
+        written.append(target)
+    return written
+
+
 def _guessVariableType(value):
     from DateTime.DateTime import DateTime
 
@@ -976,181 +1518,285 @@ def _initDCWorkflow(workflow,
                     permissions,
                     groups,
                     scripts,
-                    context):
+                    context,
+                    incremental=False,
+                    history_format='',
+                    keep_current_status=False):
     """ Initialize a DC Workflow using values parsed from XML.
+
+    o If 'incremental' is true, only the attributes and scripts which
+      differ from the parsed values are written, so importing an
+      unchanged definition again does not change any persistent object.
+      Scripts whose type and source are unchanged are kept as they are.
     """
-    workflow.title = title
-    workflow.description = description
-    workflow.manager_bypass = manager_bypass and 1 or 0
-    workflow.state_var = state_variable
-    workflow.initial_state = initial_state
-    workflow.groups = groups
+    if history_format not in HISTORY_FORMATS:
+        raise ValueError('Unknown history format: %s' % history_format)
 
+    keep_current_status = keep_current_status and 1 or 0
     permissions = permissions[:]
     permissions.sort()
-    workflow.permissions = tuple(permissions)
 
-    _initDCWorkflowCreationGuard(workflow, creation_guard)
-    _initDCWorkflowVariables(workflow, variables)
-    _initDCWorkflowStates(workflow, states)
-    _initDCWorkflowTransitions(workflow, transitions)
-    _initDCWorkflowWorklists(workflow, worklists)
-    _initDCWorkflowScripts(workflow, scripts, context)
+    changed = _setAttributes(workflow, incremental,
+                             title=title,
+                             description=description,
+                             manager_bypass=manager_bypass and 1 or 0,
+                             history_format=history_format,
+                             keep_current_status=keep_current_status,
+                             state_var=state_variable,
+                             initial_state=initial_state,
+                             groups=groups,
+                             permissions=tuple(permissions))
+
+    changed = _initDCWorkflowCreationGuard(workflow, creation_guard,
+                                           incremental) or changed
+    changed = _initDCWorkflowVariables(workflow, variables,
+                                       incremental) or changed
+    changed = _initDCWorkflowStates(workflow, states, incremental) or changed
+    changed = _initDCWorkflowTransitions(workflow, transitions,
+                                         incremental) or changed
+    changed = _initDCWorkflowWorklists(workflow, worklists,
+                                       incremental) or changed
+    changed = _initDCWorkflowScripts(workflow, scripts, context,
+                                     incremental) or changed
+    if changed:
+        workflow._invalidateCompiled()
+
+
+def _setAttributes(ob, incremental, **attrs):
+    """ Set attributes of 'ob', only those which differ if 'incremental'.
+
+    o Return whether any attribute was set.
+    """
+    changed = False
 
+    for name, value in attrs.items():
+        if incremental and _sameValue(getattr(aq_base(ob), name, _marker),
+                                      value):
+            continue
+        setattr(ob, name, value)
+        changed = True
 
-def _initDCWorkflowCreationGuard(workflow, guard):
+    return changed
+
+
+def _sameValue(old, new):
+    """ Compare attribute values of workflow definition objects.
+    """
+    if isinstance(new, Guard):
+        return (isinstance(old, Guard)
+                and old.permissions == new.permissions
+                and old.roles == new.roles
+                and old.groups == new.groups
+                and old.getExprText() == new.getExprText()
+                and old.cacheable == new.cacheable)
+
+    if isinstance(new, Expression):
+        return type(old) is type(new) and old.text == new.text
+
+    if isinstance(new, PersistentMapping):
+        if not isinstance(old, PersistentMapping) or \
+                sorted(old.keys()) != sorted(new.keys()):
+            return False
+        for key, value in new.items():
+            if not _sameValue(old[key], value):
+                return False
+        return True
+
+    return type(old) is type(new) and old == new
+
+
+def _makeGuard(guard_info):
+    """ Return a Guard for the parsed 'guard_info', or None if it is empty.
+    """
+    props = {'guard_roles': ';'.join(guard_info['roles']),
+             'guard_permissions': ';'.join(guard_info['permissions']),
+             'guard_groups': ';'.join(guard_info['groups']),
+             'guard_expr': guard_info['expression'],
+             'guard_cacheable': guard_info.get('cacheable', '')}
+    g = Guard()
+    if g.changeFromProperties(props):
+        return g
+    return None
+
+
+def _initDCWorkflowCreationGuard(workflow, guard, incremental=False):
     """Initialize Instance creation conditions guard
     """
     if guard is None:
-        workflow.creation_guard = None
+        g = None
     else:
-        props = {'guard_roles': ';'.join(guard['roles']),
-                 'guard_permissions': ';'.join(guard['permissions']),
-                 'guard_groups': ';'.join(guard['groups']),
-                 'guard_expr': guard['expression']}
-        g = Guard()
-        g.changeFromProperties(props)
-        workflow.creation_guard = g
+        g = _makeGuard(guard) or Guard()
 
+    return _setAttributes(workflow, incremental, creation_guard=g)
 
-def _initDCWorkflowVariables(workflow, variables):
+
+def _initDCWorkflowVariables(workflow, variables, incremental=False):
     """ Initialize DCWorkflow variables
     """
     from .Variables import VariableDefinition
 
+    changed = False
+
     for v_info in variables:
         id = v_info['variable_id']
         if id not in workflow.variables:
             v = VariableDefinition(id)
             workflow.variables._setObject(id, v)
+            changed = True
         v = workflow.variables._getOb(id)
 
-        guard = v_info['guard']
-        props = {'guard_roles': ';'.join(guard['roles']),
-                 'guard_permissions': ';'.join(guard['permissions']),
-                 'guard_groups': ';'.join(guard['groups']),
-                 'guard_expr': guard['expression']}
-
         default = v_info['default']
         default_value = _convertVariableValue(default['value'],
                                               default['type'])
+        default_expr = default['expression']
 
-        v.setProperties(description=v_info['description'],
-                        default_value=default_value,
-                        default_expr=default['expression'],
-                        for_catalog=v_info['for_catalog'],
-                        for_status=v_info['for_status'],
-                        update_always=v_info['update_always'],
-                        props=props)
+        changed = _setAttributes(
+            v, incremental,
+            description=str(v_info['description']),
+            default_value=str(default_value),
+            default_expr=default_expr and Expression(default_expr) or None,
+            info_guard=_makeGuard(v_info['guard']),
+            for_catalog=bool(v_info['for_catalog']),
+            for_status=bool(v_info['for_status']),
+            update_always=bool(v_info['update_always'])) or changed
 
+    return changed
 
-def _initDCWorkflowStates(workflow, states):
+
+def _initDCWorkflowStates(workflow, states, incremental=False):
     """ Initialize DCWorkflow states
     """
     from .States import StateDefinition
 
+    changed = False
+
     for s_info in states:
         id = s_info['state_id']
 
         if id not in workflow.states:
             s = StateDefinition(id)
             workflow.states._setObject(id, s)
+            changed = True
         s = workflow.states._getOb(id)
 
-        s.setProperties(title=s_info['title'],
-                        description=s_info['description'],
-                        transitions=s_info['transitions'])
-
-        for k, v in s_info['permissions'].items():
-            s.setPermission(k, isinstance(v, list), v)
-
-        gmap = s.group_roles = PersistentMapping()
+        gmap = PersistentMapping()
 
         for group_id, roles in s_info['groups']:
             gmap[group_id] = roles
 
-        vmap = s.var_values = PersistentMapping()
+        vmap = PersistentMapping()
 
         for name, v_info in s_info['variables'].items():
             value = _convertVariableValue(v_info['value'], v_info['type'])
             vmap[name] = value
 
+        changed = _setAttributes(
+            s, incremental,
+            title=str(s_info['title']),
+            description=str(s_info['description']),
+            transitions=tuple(str(t) for t in s_info['transitions']),
+            group_roles=gmap,
+            var_values=vmap) or changed
 
-def _initDCWorkflowTransitions(workflow, transitions):
+        # Permissions which are not in the profile are kept.
+        for k, v in s_info['permissions'].items():
+            if isinstance(v, list):
+                roles = list(v)
+            else:
+                roles = tuple(v)
+            pr = s.permission_roles
+            if incremental and pr is not None and k in pr and \
+                    _sameValue(pr[k], roles):
+                continue
+            if pr is None:
+                s.permission_roles = pr = PersistentMapping()
+            pr[k] = roles
+            changed = True
+
+    return changed
+
+
+def _initDCWorkflowTransitions(workflow, transitions, incremental=False):
     """ Initialize DCWorkflow transitions
     """
     from .Transitions import TransitionDefinition
 
+    changed = False
+
     for t_info in transitions:
 
         id = str(t_info['transition_id'])  # no unicode!
         if id not in workflow.transitions:
             t = TransitionDefinition(id)
             workflow.transitions._setObject(id, t)
+            changed = True
         t = workflow.transitions._getOb(id)
 
         trigger_type = list(TRIGGER_TYPES).index(t_info['trigger'])
 
         action = t_info['action']
 
-        guard = t_info['guard']
-        props = {'guard_roles': ';'.join(guard['roles']),
-                 'guard_permissions': ';'.join(guard['permissions']),
-                 'guard_groups': ';'.join(guard['groups']),
-                 'guard_expr': guard['expression']}
-
-        t.setProperties(title=t_info['title'],
-                        description=t_info['description'],
-                        new_state_id=t_info['new_state'],
-                        trigger_type=trigger_type,
-                        script_name=t_info['before_script'],
-                        after_script_name=t_info['after_script'],
-                        actbox_name=action['name'],
-                        actbox_url=action['url'],
-                        actbox_category=action['category'],
-                        actbox_icon=action.get('icon', ''),
-                        props=props)
         var_mapping = [(name, Expression(text))
                        for name, text in t_info['variables'].items()]
-        t.var_exprs = PersistentMapping(var_mapping)
 
-
-def _initDCWorkflowWorklists(workflow, worklists):
+        changed = _setAttributes(
+            t, incremental,
+            title=str(t_info['title']),
+            description=str(t_info['description']),
+            new_state_id=str(t_info['new_state']),
+            trigger_type=trigger_type,
+            script_name=str(t_info['before_script']),
+            after_script_name=str(t_info['after_script']),
+            guard=_makeGuard(t_info['guard']),
+            actbox_name=str(action['name']),
+            actbox_url=str(action['url']),
+            actbox_icon=str(action.get('icon', '')),
+            actbox_category=str(action['category']),
+            var_exprs=PersistentMapping(var_mapping)) or changed
+
+    return changed
+
+
+def _initDCWorkflowWorklists(workflow, worklists, incremental=False):
     """ Initialize DCWorkflow worklists
     """
     from .Worklists import WorklistDefinition
 
+    changed = False
+
     for w_info in worklists:
 
         id = str(w_info['worklist_id'])  # no unicode!
         if id not in workflow.worklists:
             w = WorklistDefinition(id)
             workflow.worklists._setObject(id, w)
+            changed = True
         w = workflow.worklists._getOb(id)
 
         action = w_info['action']
 
-        guard = w_info['guard']
-        props = {'guard_roles': ';'.join(guard['roles']),
-                 'guard_permissions': ';'.join(guard['permissions']),
-                 'guard_groups': ';'.join(guard['groups']),
-                 'guard_expr': guard['expression']}
+        var_matches = PersistentMapping()
+        for k, v in w_info['match'].items():
+            var_matches[str(k)] = tuple([str(x) for x in v])
 
-        w.setProperties(description=w_info['description'],
-                        actbox_name=action['name'],
-                        actbox_url=action['url'],
-                        actbox_category=action['category'],
-                        actbox_icon=action.get('icon', ''),
-                        props=props)
+        changed = _setAttributes(
+            w, incremental,
+            description=str(w_info['description']),
+            actbox_name=str(action['name']),
+            actbox_url=str(action['url']),
+            actbox_category=str(action['category']),
+            actbox_icon=str(action.get('icon', '')),
+            guard=_makeGuard(w_info['guard']),
+            var_matches=var_matches) or changed
 
-        w.var_matches = PersistentMapping()
-        for k, v in w_info['match'].items():
-            w.var_matches[str(k)] = tuple([str(x) for x in v])
+    return changed
 
 
-def _initDCWorkflowScripts(workflow, scripts, context):
+def _initDCWorkflowScripts(workflow, scripts, context, incremental=False):
     """ Initialize DCWorkflow scripts
     """
+    changed = False
+
     for s_info in scripts:
 
         id = str(s_info['script_id'])  # no unicode!
@@ -1187,8 +1833,31 @@ def _initDCWorkflowScripts(workflow, scripts, context):
                 raise ValueError('Invalid type: %s' % meta_type)
 
         if id in workflow.scripts:
+            if incremental and _sameScript(workflow.scripts._getOb(id),
+                                           script):
+                continue
             workflow.scripts._delObject(id)
         workflow.scripts._setObject(id, script)
+        changed = True
+
+    return changed
+
+
+def _sameScript(old, new):
+    """ Return whether script 'old' has the type and source of 'new'.
+    """
+    if aq_base(old).__class__ is not new.__class__ or \
+            old.meta_type != new.meta_type:
+        return False
+
+    if new.meta_type == ExternalMethod.meta_type:
+        return (old.module() == new.module()
+                and old.function() == new.function())
+
+    if hasattr(aq_base(new), 'read'):
+        return old.read() == new.read()
+
+    return False
 
 
 #
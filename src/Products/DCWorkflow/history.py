@@ -0,0 +1,253 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Compact storage of workflow histories.
+
+By default each entry of an object's workflow history is a dict holding
+all status variables.  A workflow whose 'history_format' is 'compact'
+stores the entries as tuples of values instead, following a key schema
+kept once per history.  With 'delta', an entry only holds the values
+which changed since the entry before it.  Entries are decoded into dicts
+when they are read.
+
+A workflow with 'keep_current_status' set also keeps its current status
+in the object's 'workflow_status' attribute, a dict mapping workflow ids
+to statuses.  The current status is then read from there, without
+loading the history.  Code which deletes or rewrites 'workflow_history'
+directly must delete 'workflow_status' as well.
+"""
+
+from Acquisition import aq_base
+from Persistence import Persistent
+from Persistence import PersistentMapping
+from zope.component import adapter
+from zope.interface import implementer
+from zope.lifecycleevent.interfaces import IObjectCopiedEvent
+
+from Products.CMFCore.interfaces import IContentish
+from Products.CMFCore.interfaces import IWorkflowAware
+from Products.CMFCore.interfaces import IWorkflowStatus
+from Products.CMFCore.WorkflowTool import DefaultWorkflowStatus
+
+from .interfaces import IDCWorkflowDefinition
+
+
+HISTORY_FORMATS = ('', 'compact', 'delta')
+
+# With delta encoding, every KEYFRAME_INTERVAL-th entry is stored whole,
+# so decoding an entry never has to start further back.
+KEYFRAME_INTERVAL = 32
+
+
+class CompactHistory(Persistent):
+
+    """ A workflow history which stores its entries as tuples.
+
+    o It is a read-only sequence of status dicts, as far as its readers
+      are concerned; each entry is decoded when it is accessed.
+
+    o A full entry is (mask, value, ...), a delta entry is (mask, changed,
+      value, ...).  Bit i of 'mask' tells whether the status holds the
+      i-th key of the schema, bit i of 'changed' whether its value is
+      stored in the entry rather than taken from the entry before it.
+    """
+
+    def __init__(self, keys=(), entries=(), delta=False):
+        self._keys = tuple(keys)
+        self._entries = []
+        self.delta = bool(delta)
+        for status in entries:
+            self.append(status)
+
+    def getKeySchema(self):
+        """ Return the keys the entries are encoded with.
+        """
+        return self._keys
+
+    def append(self, status):
+        """ Add 'status' as the last entry.
+        """
+        keys = self._keys
+        new_keys = [key for key in status if key not in keys]
+        if new_keys:
+            keys = self._keys = keys + tuple(new_keys)
+
+        entries = self._entries
+        previous = None
+        if self.delta and len(entries) % KEYFRAME_INTERVAL:
+            previous = self._decode(len(entries) - 1)
+
+        mask = changed = 0
+        values = []
+        for i, key in enumerate(keys):
+            if key not in status:
+                continue
+            value = status[key]
+            mask |= 1 << i
+            if previous is not None:
+                if key in previous and _same(previous[key], value):
+                    continue
+                changed |= 1 << i
+            values.append(value)
+
+        if previous is None:
+            entries.append((mask,) + tuple(values))
+        else:
+            entries.append((mask, changed) + tuple(values))
+        self._p_changed = True
+        self._v_last = (len(entries) - 1, dict(status))
+
+    def _isKeyframe(self, index):
+        return not self.delta or index % KEYFRAME_INTERVAL == 0
+
+    def _decode(self, index):
+        last = getattr(self, '_v_last', None)
+        if last is not None and last[0] == index:
+            return last[1]
+
+        keys = self._keys
+        start = index
+        if not self._isKeyframe(index):
+            start = index - index % KEYFRAME_INTERVAL
+            if last is not None and start < last[0] < index:
+                start = last[0]
+
+        status = None
+        for i in range(start, index + 1):
+            entry = self._entries[i]
+            mask = entry[0]
+            if status is None and last is not None and last[0] == i:
+                status = last[1]
+                continue
+            if self._isKeyframe(i):
+                values = iter(entry[1:])
+                status = {key: next(values)
+                          for bit, key in enumerate(keys) if mask >> bit & 1}
+            else:
+                changed = entry[1]
+                values = iter(entry[2:])
+                previous = status
+                status = {}
+                for bit, key in enumerate(keys):
+                    if not mask >> bit & 1:
+                        continue
+                    if changed >> bit & 1:
+                        status[key] = next(values)
+                    else:
+                        status[key] = previous[key]
+        self._v_last = (index, status)
+        return status
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self[i]
+                         for i in range(*index.indices(len(self._entries))))
+        length = len(self._entries)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError('history index out of range')
+        return dict(self._decode(index))
+
+    def __iter__(self):
+        for index in range(len(self._entries)):
+            yield dict(self._decode(index))
+
+    def __repr__(self):
+        return '<%s with %d entries>' % (self.__class__.__name__,
+                                         len(self._entries))
+
+
+def _same(old, new):
+    # 1 == True, but they are not interchangeable in a status.
+    return type(old) is type(new) and old == new
+
+
+def getStatusKeys(workflow):
+    """ Return the keys of the statuses 'workflow' stores.
+    """
+    compiled = workflow._getCompiled()
+    keys = [vid for vid, vdef in sorted(compiled.variables.items())
+            if vdef.for_status]
+    if workflow.state_var not in keys:
+        keys.append(workflow.state_var)
+    return keys
+
+
+@adapter(IWorkflowAware, IDCWorkflowDefinition)
+@implementer(IWorkflowStatus)
+class DCWorkflowStatus(DefaultWorkflowStatus):
+
+    """ Workflow status which honors the workflow's 'history_format' and
+    'keep_current_status'.
+
+    o A history in another format is converted when the next status is
+      set.
+    """
+
+    def __init__(self, context, workflow):
+        DefaultWorkflowStatus.__init__(self, context, workflow)
+        self.workflow = workflow
+        self.history_format = getattr(workflow, 'history_format', '')
+        self.keep_current_status = getattr(workflow, 'keep_current_status',
+                                           0)
+
+    def get(self):
+        if self.keep_current_status:
+            current = getattr(self.context, 'workflow_status', None)
+            if current and self.wf_id in current:
+                return current[self.wf_id]
+        return DefaultWorkflowStatus.get(self)
+
+    def set(self, status):
+        self._setCurrent(status)
+        if not self.history_format:
+            return DefaultWorkflowStatus.set(self, status)
+
+        history = getattr(self.context, 'workflow_history', None)
+        if history is None:
+            history = self.context.workflow_history = PersistentMapping()
+        wfh = history.get(self.wf_id)
+        delta = self.history_format == 'delta'
+        if not isinstance(wfh, CompactHistory) or wfh.delta != delta:
+            wfh = CompactHistory(getStatusKeys(self.workflow), wfh or (),
+                                 delta)
+            history[self.wf_id] = wfh
+        wfh.append(status)
+
+    def _setCurrent(self, status):
+        current = getattr(self.context, 'workflow_status', None)
+        if self.keep_current_status:
+            current = dict(current or ())
+            current[self.wf_id] = dict(status)
+        elif current and self.wf_id in current:
+            # Don't leave a stale status behind.
+            current = dict(current)
+            del current[self.wf_id]
+        else:
+            return
+        # A plain dict is stored with the object itself.
+        self.context.workflow_status = current
+
+
+@adapter(IContentish, IObjectCopiedEvent)
+def dropCurrentStatus(ob, event):
+    """ Drop the current status of a copy along with its history.
+
+    o CMF deletes the 'workflow_history' of copies, so that they start
+      their lifecycle afresh.
+    """
+    if hasattr(aq_base(ob), 'workflow_status'):
+        del ob.workflow_status
@@ -52,3 +52,17 @@ class IAfterTransitionEvent(ITransitionEvent):
 
     """An event that's fired after a workflow transition.
     """
+
+
+class IAfterBulkTransitionEvent(Interface):
+
+    """An event fired once after doActionForMany() has processed a batch.
+
+    The usual transition events are fired for every object of the batch
+    as well.
+    """
+
+    workflow = Attribute("The workflow definition triggering the transitions")
+    transition = Attribute("The transition definition which took place")
+    objects = Attribute("The objects which were transitioned successfully")
+    kwargs = Attribute("Any keyword arguments passed to doActionForMany()")
@@ -0,0 +1,133 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Bulk update of the role mappings of a workflow's objects.
+
+WorkflowTool.updateRoleMappings walks the whole site, one object at a
+time.  updateRoleMappingsInBulk asks the catalog for the objects in the
+affected states only, computes each state's permission settings once
+and saves its work in batches.
+"""
+
+import logging
+import time
+
+import transaction
+from Acquisition import aq_base
+from Acquisition import aq_inner
+from Acquisition import aq_parent
+from zope.component import getUtility
+
+from Products.CMFCore.interfaces import ICatalogTool
+
+from .Guard import clearGuardCache
+from .utils import modifyRolesForPermission
+
+
+logger = logging.getLogger('Products.DCWorkflow')
+
+
+def updateRoleMappingsInBulk(workflow, state_ids=None, batch_size=1000,
+                             commit=False, reindex=True):
+    """Update the role mappings of the objects governed by workflow.
+
+    o 'state_ids' -- the states whose objects are updated, e.g. those
+      whose permission map was changed.  Defaults to all states.
+
+    o 'batch_size' -- the number of objects after which the work is
+      saved, using a savepoint or, if 'commit' is true, by committing
+      the transaction.  The ZODB cache is garbage collected then.
+
+    o 'reindex' -- whether to reindex the 'allowedRolesAndUsers' index
+      of the objects which were changed.
+
+    The catalog is searched by the workflow's state variable, which must
+    be indexed.  The chain of each object found is looked up, so that
+    placeful chains are honoured, and objects which are governed by
+    other workflows are skipped.  Objects found in a state other than
+    the one recorded in the catalog get a full update.
+    Returns the number of objects which were changed.
+    """
+    ctool = getUtility(ICatalogTool)
+    state_var = workflow.state_var
+    if state_var not in ctool.indexes():
+        raise ValueError('The catalog has no index for the state '
+                         'variable %r.' % state_var)
+    compiled = workflow._getCompiled()
+    if state_ids is None:
+        state_ids = list(compiled.states)
+    wtool = aq_parent(aq_inner(workflow))
+    wf_id = workflow.getId()
+    jar = getattr(aq_base(workflow), '_p_jar', None)
+    processed = changed_count = 0
+    started = time.time()
+    for state_id in state_ids:
+        sdef = compiled.states[state_id]
+        # The target permission settings, computed once per state.
+        targets = []
+        for p in workflow.permissions:
+            roles = sdef.permission_roles.get(p, None)
+            if roles is None:
+                roles = []
+            targets.append((p, roles))
+        brains = ctool.unrestrictedSearchResults(**{state_var: state_id})
+        for brain in brains:
+            ob = brain._unrestrictedGetObject()
+            if wf_id not in wtool.getChainFor(ob):
+                # The catalog matched the state of another workflow.
+                continue
+            if workflow._getWorkflowStateOf(ob, 1) != state_id:
+                # The catalog is out of date.
+                changed = workflow.updateRoleMappingsFor(ob)
+            else:
+                changed = 0
+                for p, roles in targets:
+                    if isinstance(roles, list):
+                        # Don't share the snapshot's list with the object.
+                        roles = list(roles)
+                    if modifyRolesForPermission(ob, p, roles):
+                        changed = 1
+                if workflow._updateGroupRolesFor(ob, sdef):
+                    changed = 1
+            if changed:
+                changed_count += 1
+                if reindex and hasattr(aq_base(ob), 'reindexObject'):
+                    try:
+                        ob.reindexObject(idxs=['allowedRolesAndUsers'])
+                    except TypeError:
+                        # Catch attempts to reindex portal_catalog.
+                        pass
+            processed += 1
+            if batch_size and processed % batch_size == 0:
+                _saveBatch(jar, commit)
+                _logProgress(workflow, processed, changed_count, started)
+    if changed_count:
+        clearGuardCache()
+    _logProgress(workflow, processed, changed_count, started)
+    return changed_count
+
+
+def _saveBatch(jar, commit):
+    if commit:
+        transaction.commit()
+    else:
+        transaction.savepoint(optimistic=True)
+    if jar is not None:
+        jar.cacheGC()
+
+
+def _logProgress(workflow, processed, changed, started):
+    elapsed = time.time() - started
+    rate = elapsed and processed / elapsed or 0.0
+    logger.info('%s: updated role mappings of %d of %d objects '
+                '(%.1f objects/s)', workflow.getId(), changed, processed,
+                rate)
@@ -15,11 +15,13 @@
 
 import transaction
 from AccessControl.SecurityManagement import newSecurityManager
+from AccessControl.unauthorized import Unauthorized
 from zope.component import adapter
 from zope.component import getSiteManager
 from zope.component import provideHandler
 from zope.interface.verify import verifyClass
 
+from Products.CMFCore.interfaces import ICatalogTool
 from Products.CMFCore.interfaces import ITypesTool
 from Products.CMFCore.interfaces import IWorkflowTool
 from Products.CMFCore.testing import TraversingEventZCMLLayer
@@ -30,8 +32,47 @@ from Products.CMFCore.tests.base.security import OmnipotentUser
 from Products.CMFCore.tests.base.testcase import SecurityTest
 from Products.CMFCore.WorkflowTool import WorkflowTool
 
+from ..interfaces import IAfterBulkTransitionEvent
 from ..interfaces import IAfterTransitionEvent
 from ..interfaces import IBeforeTransitionEvent
+from ..Worklists import clearCountCache
+
+
+class DummyBrain:
+
+    def __init__(self, ob):
+        self._ob = ob
+
+    def _unrestrictedGetObject(self):
+        return self._ob
+
+
+class DummyCatalog:
+
+    def __init__(self, objects, wf):
+        self._objects = objects
+        self._wf = wf
+        self.queries = []
+        self.reindexed = []
+
+    def indexes(self):
+        return ['portal_type', 'state']
+
+    def unrestrictedSearchResults(self, **kw):
+        self.queries.append(kw)
+        states = kw.get('state')
+        if states is None:
+            # E.g. a search by path when reindexing security.
+            return []
+        if isinstance(states, str):
+            states = [states]
+        return [DummyBrain(ob) for ob in self._objects
+                if self._wf._getWorkflowStateOf(ob, 1) in states]
+
+    searchResults = unrestrictedSearchResults
+
+    def reindexObject(self, ob, idxs=[], update_metadata=1, uid=None):
+        self.reindexed.append((ob.getId(), idxs))
 
 
 class DCWorkflowDefinitionTests(SecurityTest):
@@ -49,6 +90,11 @@ class DCWorkflowDefinitionTests(SecurityTest):
         sm = getSiteManager()
         sm.registerUtility(self.wtool, IWorkflowTool)
         sm.registerUtility(DummyTool(), ITypesTool)
+        clearCountCache()
+
+    def tearDown(self):
+        clearCountCache()
+        SecurityTest.tearDown(self)
 
     def test_interfaces(self):
         from Products.CMFCore.interfaces import IWorkflowDefinition
@@ -59,6 +105,7 @@ class DCWorkflowDefinitionTests(SecurityTest):
 
     def _constructDummyWorkflow(self):
         from ..DCWorkflow import DCWorkflowDefinition
+        from ..Transitions import TRIGGER_AUTOMATIC
 
         wtool = self.wtool
         wtool._setObject('wf', DCWorkflowDefinition('wf'))
@@ -76,6 +123,13 @@ class DCWorkflowDefinitionTests(SecurityTest):
         tdef = wf.transitions['publish']
         tdef.setProperties(title='', new_state_id='published', actbox_name='')
 
+        # Not reachable unless a test makes 'published' exit through it.
+        wf.states.addState('archived')
+        wf.transitions.addTransition('archive')
+        tdef = wf.transitions['archive']
+        tdef.setProperties(title='', new_state_id='archived',
+                           trigger_type=TRIGGER_AUTOMATIC)
+
         wf.variables.addVariable('comments')
         vdef = wf.variables['comments']
         default_expression = "python:state_change.kwargs.get('comment', '')"
@@ -101,6 +155,187 @@ class DCWorkflowDefinitionTests(SecurityTest):
 
         # XXX more
 
+    def test_doActionForMany(self):
+        events = []
+
+        @adapter(IAfterBulkTransitionEvent)
+        def _handleBulk(event):
+            events.append(event)
+        provideHandler(_handleBulk)
+
+        wtool = self.wtool
+        wf = self._getDummyWorkflow()
+        foo = self.site._setObject('foo', DummyContent('foo'))
+        bar = self.site._setObject('bar', DummyContent('bar'))
+        baz = self.site._setObject('baz', DummyContent('baz'))
+        for ob in (foo, bar, baz):
+            wtool.notifyCreated(ob)
+        wf.doActionFor(bar, 'publish')
+
+        results = wf.doActionForMany([foo, bar, baz], 'publish',
+                                     comment='bulk')
+        self.assertEqual([ob for ob, exc in results], [foo, bar, baz])
+        self.assertIsNone(results[0][1])
+        self.assertIsInstance(results[1][1], Unauthorized)
+        self.assertIsNone(results[2][1])
+        self.assertEqual(wf._getStatusOf(foo),
+                         {'state': 'published', 'comments': 'bulk'})
+        self.assertEqual(wf._getStatusOf(baz),
+                         {'state': 'published', 'comments': 'bulk'})
+
+        self.assertEqual(1, len(events))
+        evt = events[0]
+        self.assertIs(evt.workflow, wf)
+        self.assertEqual('publish', evt.transition.id)
+        self.assertEqual([foo, baz], evt.objects)
+        self.assertEqual({'comment': 'bulk'}, evt.kwargs)
+
+    def test_doActionForMany_notifies_tool(self):
+        from Products.CMFCore.interfaces import IActionSucceededEvent
+        from Products.CMFCore.WorkflowCore import ObjectMoved
+
+        wtool = self.wtool
+        wf = self._getDummyWorkflow()
+        foo = self.site._setObject('foo', DummyContent('foo'))
+        bar = self.site._setObject('bar', DummyContent('bar'))
+        moved = self.site._setObject('moved', DummyContent('moved'))
+        for ob in (foo, bar):
+            wtool.notifyCreated(ob)
+        catalog = DummyCatalog([foo, bar, moved], wf)
+        sm = getSiteManager()
+        sm.registerUtility(catalog, ICatalogTool)
+
+        succeeded = []
+
+        @adapter(IActionSucceededEvent)
+        def _handleSucceeded(event):
+            succeeded.append((event.object.getId(), event.action))
+
+        @adapter(IAfterTransitionEvent)
+        def _moveBar(event):
+            if event.object.getId() == 'bar':
+                raise ObjectMoved(moved, None)
+
+        for handler in (_handleSucceeded, _moveBar):
+            sm.registerHandler(handler)
+            self.addCleanup(sm.unregisterHandler, handler)
+
+        results = wf.doActionForMany([foo, bar], 'publish')
+        self.assertEqual(results, [(foo, None), (moved, None)])
+        self.assertEqual(succeeded, [('foo', 'publish'),
+                                     ('moved', 'publish')])
+        # The catalog is brought up to date, for the moved object too.
+        self.assertEqual([ob_id for ob_id, idxs in catalog.reindexed],
+                         ['foo', 'moved'])
+        self.assertIn('state', catalog.reindexed[0][1])
+
+    def test_stateChangeInfo(self):
+        from ..Expression import SafeMapping
+        from ..Expression import StateChangeInfo
+
+        wtool = self.wtool
+        wf = self._getDummyWorkflow()
+        dummy = self.site._setObject('dummy', DummyContent())
+        wtool.notifyCreated(dummy)
+
+        sci = StateChangeInfo(dummy, wf, kwargs={'comment': 'foo'})
+        self.assertFalse(hasattr(sci, '__dict__'))
+        self.assertIsInstance(sci.status, SafeMapping)
+        self.assertEqual(sci.status['state'], 'private')
+        self.assertIs(sci.status, sci.status)
+        self.assertEqual(sci['kwargs']['comment'], 'foo')
+        date = sci.getDateTime()
+
+        sci._reset(dummy, wf, {})
+        self.assertEqual(sci.status, {})
+        self.assertEqual(sci.kwargs, {})
+        self.assertIsNot(sci.getDateTime(), date)
+
+    def test_stateChangeInfo_getHistory(self):
+        from ..Expression import StateChangeInfo
+
+        wf = self._getDummyWorkflow()
+        dummy = self.site._setObject('dummy', DummyContent())
+        sci = StateChangeInfo(dummy, wf)
+        dummy.workflow_history = {}
+        self.assertFalse(sci.getHistory())
+        self.assertEqual(list(sci.getHistory()), [])
+
+        entries = ({'action': None, 'state': 'private'},
+                   {'action': 'publish', 'state': 'published'},
+                   {'action': 'retract', 'state': 'private'},
+                   {'action': 'publish', 'state': 'published'})
+        dummy.workflow_history = {'wf': entries}
+        history = sci.getHistory()
+        self.assertEqual(len(history), 4)
+        self.assertEqual(list(history), list(entries))
+        self.assertEqual(history[-1], entries[-1])
+        self.assertEqual(history[1:3], list(entries[1:3]))
+        self.assertEqual(list(reversed(history)), list(reversed(entries)))
+        self.assertEqual(history.last(2), list(entries[2:]))
+        self.assertEqual(history.last(10), list(entries))
+        self.assertEqual(history.last(0), [])
+        self.assertEqual([d['state'] for d in history.filter('retract')],
+                         ['private'])
+        published = history.filter('publish', reverse=True)
+        self.assertEqual(next(published), entries[3])
+
+        # Entries are copies.
+        history[-1]['state'] = 'changed'
+        for d in history.last(1):
+            d['state'] = 'changed'
+        self.assertEqual(entries[-1]['state'], 'published')
+
+    def test_stateChangeInfo_getHistory_restricted(self):
+        from AccessControl.ImplPython import ZopeSecurityPolicy
+        from AccessControl.SecurityManagement import newSecurityManager
+        from AccessControl.SecurityManager import setSecurityPolicy
+        from AccessControl.SpecialUsers import nobody
+        from Products.PythonScripts.PythonScript import PythonScript
+
+        from ..Expression import HistoryView
+
+        history = HistoryView(({'action': None, 'state': 'private'},
+                               {'action': 'publish', 'state': 'published'}))
+        script = PythonScript('history_script')
+        script.ZPythonScript_edit('history', '''\
+published = [d['state'] for d in history.filter('publish')]
+retracted = any(history.filter('retract'))
+newest = [d for d in history.filter('publish', reverse=True)][0]
+actions = [d['action'] for d in history]
+return published, retracted, newest['state'], actions, history[-1]['state']
+''')
+        old_policy = setSecurityPolicy(ZopeSecurityPolicy())
+        self.addCleanup(setSecurityPolicy, old_policy)
+        newSecurityManager(None, nobody)
+        self.assertEqual(script.__of__(self.site)(history),
+                         (['published'], False, 'published',
+                          [None, 'publish'], 'published'))
+
+    def test_automaticTransitions(self):
+        from ..DCWorkflow import getAutomaticChainStats
+        from ..DCWorkflow import resetAutomaticChainStats
+
+        wtool = self.wtool
+        wf = self._getDummyWorkflow()
+        wf.states['published'].setProperties(transitions=('archive',))
+        compiled = wf._getCompiled()
+        self.assertEqual(compiled.states['private'].automatic_transitions, ())
+        self.assertEqual(
+            [t.id for t in compiled.states['published'].automatic_transitions],
+            ['archive'])
+
+        resetAutomaticChainStats()
+        dummy = self.site._setObject('dummy', DummyContent())
+        wtool.notifyCreated(dummy)
+        self.assertEqual(getAutomaticChainStats()['chains'], 0)
+        wf.doActionFor(dummy, 'publish')
+        self.assertEqual(wf._getStatusOf(dummy)['state'], 'archived')
+        stats = getAutomaticChainStats()
+        self.assertEqual(stats['chains'], 1)
+        self.assertEqual(stats['transitions'], 1)
+        self.assertGreaterEqual(stats['seconds'], 0.0)
+
     def test_events(self):
         events = []
 
@@ -201,6 +436,411 @@ class DCWorkflowDefinitionTests(SecurityTest):
                             wf.worklists._getOb('published_documents_new',
                                                 None))
 
+    def test_migrateToBTrees(self):
+        from BTrees.OOBTree import OOBTree
+
+        wf = self._getDummyWorkflow()
+        dummy = self.site._setObject('dummy', DummyContent())
+        self.wtool.notifyCreated(dummy)
+        self.assertFalse(wf.states.isBTreeBased())
+        state_ids = sorted(wf.states.objectIds())
+
+        self.assertEqual(wf.migrateToBTrees(),
+                         ['states', 'transitions', 'variables', 'worklists',
+                          'scripts'])
+        self.assertEqual(wf.migrateToBTrees(), [])
+        self.assertIsInstance(wf.states._mapping, OOBTree)
+        self.assertEqual(list(wf.states.objectIds()), state_ids)
+        self.assertEqual(wf.states['private'].getId(), 'private')
+
+        wf.doActionFor(dummy, 'publish')
+        self.assertEqual(wf._getStatusOf(dummy)['state'], 'published')
+
+        wf.states.manage_renameObject('archived', 'retired')
+        wf.transitions['archive'].setProperties(title='',
+                                                new_state_id='retired')
+        wf.states['published'].setProperties(transitions=('archive',))
+        self.assertEqual(wf._getCompiled().states['published'].transition_ids,
+                         frozenset(['archive']))
+        wf.doActionFor(dummy, 'archive')
+        self.assertEqual(wf._getStatusOf(dummy)['state'], 'retired')
+
+        wf.worklists._delOb('published_documents')
+        self.assertEqual(list(wf.worklists.objectIds()), [])
+        self.assertEqual(list(wf._getCompiled().worklists), [])
+
+    def test_btree_snapshot_stays_lazy(self):
+        from ZODB.DB import DB
+        from ZODB.MappingStorage import MappingStorage
+
+        from ..DCWorkflow import DCWorkflowDefinition
+        from ..States import StateDefinition
+
+        db = DB(MappingStorage())
+        self.addCleanup(db.close)
+        tm = transaction.TransactionManager()
+        conn = db.open(tm)
+        self.addCleanup(conn.close)
+        self.addCleanup(tm.abort)
+        wf = conn.root()['wf'] = DCWorkflowDefinition('wf', btree=True)
+        for i in range(50):
+            state_id = 'state_%d' % i
+            wf.states._setOb(state_id, StateDefinition(state_id))
+        tm.commit()
+
+        compiled = wf._getCompiled()
+        items = list(wf.states.rawValues())
+        for sdef in items:
+            sdef._p_deactivate()
+        wf.states._mapping._p_deactivate()
+
+        # A current snapshot is reused without loading the items.
+        tm.begin()
+        self.assertIs(wf._getCompiled(), compiled)
+        self.assertIsNone(wf.states._mapping._p_changed)
+        for sdef in items:
+            self.assertIsNone(sdef._p_changed)
+
+    def test_rawItems(self):
+        from Acquisition import aq_base
+
+        wf = self._getDummyWorkflow()
+        raw = dict(wf.states.rawItems())
+        self.assertEqual(sorted(raw), sorted(wf.states.objectIds()))
+        for state_id, sdef in wf.states.items():
+            self.assertIs(raw[state_id], aq_base(sdef))
+            self.assertIs(aq_base(raw[state_id]), raw[state_id])
+        self.assertEqual(set(map(id, wf.states.rawValues())),
+                         set(map(id, raw.values())))
+
+    def test_compact_history(self):
+        import pickle
+
+        from ..history import KEYFRAME_INTERVAL
+        from ..history import CompactHistory
+        from ..history import DCWorkflowStatus
+
+        sm = getSiteManager()
+        sm.registerAdapter(DCWorkflowStatus)
+        self.addCleanup(sm.unregisterAdapter, DCWorkflowStatus)
+        wtool = self.wtool
+        wf = self._getDummyWorkflow()
+        self.assertRaises(ValueError, wf.setProperties, '',
+                          history_format='tuples')
+
+        dummy = self.site._setObject('dummy', DummyContent())
+        wtool.notifyCreated(dummy)
+        wf.setProperties('', history_format='delta')
+        wf.doActionFor(dummy, 'publish', comment='foo')
+        history = dummy.workflow_history['wf']
+        self.assertIsInstance(history, CompactHistory)
+        self.assertEqual(list(history.getKeySchema()), ['comments', 'state'])
+        expected = [{'state': 'private', 'comments': ''},
+                    {'state': 'published', 'comments': 'foo'}]
+        self.assertEqual(list(wtool.getHistoryOf('wf', dummy)), expected)
+        self.assertEqual(wf._getStatusOf(dummy), expected[-1])
+
+        # Back to dicts.
+        wf.setProperties('', history_format='')
+        wf.states['published'].setProperties(transitions=('archive',))
+        wf.transitions['archive'].setProperties(title='',
+                                                new_state_id='archived')
+        wf.doActionFor(dummy, 'archive')
+        expected.append({'state': 'archived', 'comments': ''})
+        self.assertEqual(dummy.workflow_history['wf'], tuple(expected))
+
+        # Entries are decoded in any order, also after a round trip.
+        statuses = [{'state': 'private', 'count': i // 3, 'flag': i % 2 == 0}
+                    for i in range(KEYFRAME_INTERVAL * 2 + 5)]
+        statuses[40]['extra'] = 1
+        del statuses[41]['state']
+        for delta in (False, True):
+            history = CompactHistory(['state'], statuses, delta)
+            self.assertEqual(list(history), statuses)
+            history = pickle.loads(pickle.dumps(history))
+            self.assertEqual(history[41], statuses[41])
+            self.assertEqual(history[-1], statuses[-1])
+            self.assertEqual(history[40:43], tuple(statuses[40:43]))
+            self.assertEqual(history[40], statuses[40])
+            self.assertEqual(list(history), statuses)
+            self.assertRaises(IndexError, history.__getitem__, len(statuses))
+        self.assertIs(history[1]['flag'], False)
+
+    def test_keep_current_status(self):
+        from ..history import DCWorkflowStatus
+
+        sm = getSiteManager()
+        sm.registerAdapter(DCWorkflowStatus)
+        self.addCleanup(sm.unregisterAdapter, DCWorkflowStatus)
+        wtool = self.wtool
+        wf = self._getDummyWorkflow()
+        wf.setProperties('', keep_current_status=1)
+
+        dummy = self.site._setObject('dummy', DummyContent())
+        wtool.notifyCreated(dummy)
+        wf.doActionFor(dummy, 'publish', comment='foo')
+        current = {'state': 'published', 'comments': 'foo'}
+        self.assertEqual(dummy.workflow_status, {'wf': current})
+        self.assertEqual(len(dummy.workflow_history['wf']), 2)
+
+        # The history is not needed to find the current status.
+        del dummy.workflow_history
+        self.assertEqual(wtool.getStatusOf('wf', dummy), current)
+        self.assertEqual(wf._getWorkflowStateOf(dummy, 1), 'published')
+        self.assertEqual(wf.getInfoFor(dummy, 'comments', None), 'foo')
+
+        # Without the option the attribute is not kept up to date.
+        wf.setProperties('', keep_current_status=0)
+        wtool.setStatusOf('wf', dummy, {'state': 'private'})
+        self.assertEqual(dummy.workflow_status, {})
+        self.assertEqual(wtool.getStatusOf('wf', dummy), {'state': 'private'})
+
+    def test_keep_current_status_copy(self):
+        from zope.event import notify
+        from zope.lifecycleevent import ObjectCopiedEvent
+
+        from ..history import DCWorkflowStatus
+        from ..history import dropCurrentStatus
+
+        sm = getSiteManager()
+        sm.registerAdapter(DCWorkflowStatus)
+        self.addCleanup(sm.unregisterAdapter, DCWorkflowStatus)
+        sm.registerHandler(dropCurrentStatus)
+        self.addCleanup(sm.unregisterHandler, dropCurrentStatus)
+        wf = self._getDummyWorkflow()
+        wf.setProperties('', keep_current_status=1)
+
+        dummy = self.site._setObject('dummy', DummyContent())
+        wf.doActionFor(dummy, 'publish')
+        self.assertEqual(wf._getWorkflowStateOf(dummy, 1), 'published')
+
+        # A copy starts its lifecycle afresh, as if it were pasted.
+        copy = dummy._getCopy(self.site)
+        copy._setId('copy')
+        notify(ObjectCopiedEvent(copy, dummy))
+        self.assertFalse(hasattr(copy, 'workflow_history'))
+        self.assertFalse(hasattr(copy, 'workflow_status'))
+        copy = self.site._setObject('copy', copy)
+        self.assertEqual(wf._getWorkflowStateOf(copy, 1), 'private')
+        self.assertEqual(wf._getWorkflowStateOf(dummy, 1), 'published')
+
+    def test_compiled_snapshot(self):
+        wf = self._getDummyWorkflow()
+        compiled = wf._getCompiled()
+        self.assertIs(wf._getCompiled(), compiled)
+        self.assertEqual(compiled.states['private'].transition_ids,
+                         frozenset(['publish']))
+        self.assertEqual(
+            [t.id for t in compiled.states['private'].transitions],
+            ['publish'])
+        self.assertEqual(compiled.transitions['publish'].new_state_id,
+                         'published')
+        self.assertEqual(list(compiled.variables), ['comments'])
+
+        # Changing the definition discards the snapshot.
+        wf.states['published'].setProperties(transitions=('publish',))
+        wf.transitions['publish'].setProperties(title='',
+                                                new_state_id='private')
+        compiled = wf._getCompiled()
+        self.assertEqual(compiled.states['published'].transition_ids,
+                         frozenset(['publish']))
+        self.assertEqual(compiled.transitions['publish'].new_state_id,
+                         'private')
+
+    def test_compiled_snapshot_direct_writes(self):
+        from ..Guard import Guard
+
+        wf = self._getDummyWorkflow()
+        compiled = wf._getCompiled()
+
+        # Attributes set directly, as importers do, are noticed too.
+        wf.states['private'].var_values = {'comments': 'new'}
+        compiled = wf._getCompiled()
+        self.assertEqual(compiled.states['private'].var_values,
+                         {'comments': 'new'})
+        self.assertIs(wf._getCompiled(), compiled)
+
+        guard = wf.transitions['publish'].guard = Guard()
+        self.assertEqual(wf._getCompiled().transitions['publish'].guard.roles,
+                         ())
+        guard.roles = ('Manager',)
+        self.assertEqual(wf._getCompiled().transitions['publish'].guard.roles,
+                         ('Manager',))
+
+        # Items stored before their workflow was recorded.
+        sdef = wf.states['published']
+        del sdef._compiled_owner
+        wf._invalidateCompiled()
+        wf._getCompiled()
+        sdef.var_values = {'comments': 'old'}
+        self.assertEqual(wf._getCompiled().states['published'].var_values,
+                         {'comments': 'old'})
+
+    def test_compiled_snapshot_other_connection(self):
+        from ZODB.DB import DB
+        from ZODB.MappingStorage import MappingStorage
+
+        from ..DCWorkflow import DCWorkflowDefinition
+        from ..States import StateDefinition
+
+        db = DB(MappingStorage())
+        self.addCleanup(db.close)
+        tm1 = transaction.TransactionManager()
+        tm2 = transaction.TransactionManager()
+        conn1 = db.open(tm1)
+        conn2 = db.open(tm2)
+        wf = conn1.root()['wf'] = DCWorkflowDefinition('wf')
+        wf.states._setOb('private', StateDefinition('private'))
+        tm1.commit()
+
+        sdef = wf.states._getOb('private')
+        sdef.var_values = {'comments': 'new'}
+
+        tm2.begin()
+        wf2 = conn2.root()['wf']
+        self.assertEqual(wf2._getCompiled().states['private'].var_values, {})
+        tm1.commit()
+
+        # Seen once the other connection starts a new transaction.
+        tm2.begin()
+        compiled = wf2._getCompiled()
+        self.assertEqual(compiled.states['private'].var_values,
+                         {'comments': 'new'})
+
+        # Checking whether the snapshot is current loads nothing.
+        sdef2 = wf2.states._getOb('private')
+        sdef2._p_deactivate()
+        tm2.begin()
+        self.assertIs(wf2._getCompiled(), compiled)
+        self.assertIsNone(sdef2._p_changed)
+
+        # An aborted write leaves no stale snapshot behind.
+        sdef.var_values = {'comments': 'aborted'}
+        self.assertEqual(wf._getCompiled().states['private'].var_values,
+                         {'comments': 'aborted'})
+        tm1.abort()
+        self.assertEqual(wf._getCompiled().states['private'].var_values,
+                         {'comments': 'new'})
+        tm1.abort()
+        tm2.abort()
+        conn1.close()
+        conn2.close()
+
+    def test_transition_role_mappings(self):
+        from ..Transitions import TRIGGER_USER_ACTION
+
+        wtool = self.wtool
+        wf = self._getDummyWorkflow()
+        wf.permissions = ('View', 'Modify portal content')
+        private = wf.states['private']
+        private.setPermission('View', 0, ('Owner',))
+        private.setPermission('Modify portal content', 0, ('Owner',))
+        published = wf.states['published']
+        published.setPermission('View', 1, ('Anonymous',))
+        published.setPermission('Modify portal content', 0, ('Owner',))
+
+        dummy = self.site._setObject('dummy', DummyContent())
+        wtool.notifyCreated(dummy)
+        self.assertEqual(dummy._View_Permission, ('Owner',))
+        self.assertEqual(dummy._Modify_portal_content_Permission, ('Owner',))
+
+        # Settings which drifted from the old state don't survive a
+        # transition, even if both states agree on them.
+        dummy._Modify_portal_content_Permission = ('Manager',)
+        wf.doActionFor(dummy, 'publish')
+        self.assertEqual(dummy._View_Permission, ['Anonymous'])
+        self.assertEqual(dummy._Modify_portal_content_Permission, ('Owner',))
+
+        # Settings already in place are left alone.
+        self.assertFalse(wf.updateRoleMappingsFor(dummy))
+
+        # Nothing is applied when the object stays in the same state or
+        # moves to a state with the same settings.
+        archive = wf.transitions['archive']
+        archive.setProperties(title='', new_state_id='',
+                              trigger_type=TRIGGER_USER_ACTION)
+        wf.states['published'].setProperties(transitions=('archive',))
+        archived = wf.states['archived']
+        archived.setPermission('View', 1, ('Anonymous',))
+        archived.setPermission('Modify portal content', 0, ('Owner',))
+        dummy._Modify_portal_content_Permission = ('Manager',)
+        wf.doActionFor(dummy, 'archive')
+        self.assertEqual(wf._getStatusOf(dummy)['state'], 'published')
+        self.assertEqual(dummy._Modify_portal_content_Permission,
+                         ('Manager',))
+        archive.setProperties(title='', new_state_id='archived',
+                              trigger_type=TRIGGER_USER_ACTION)
+        wf.doActionFor(dummy, 'archive')
+        self.assertEqual(wf._getStatusOf(dummy)['state'], 'archived')
+        self.assertEqual(dummy._Modify_portal_content_Permission,
+                         ('Manager',))
+
+        # An explicit update resets them.
+        self.assertTrue(wf.updateRoleMappingsFor(dummy))
+        self.assertEqual(dummy._Modify_portal_content_Permission, ('Owner',))
+
+    def test_updateRoleMappingsInBulk(self):
+        from ..rolemappings import updateRoleMappingsInBulk
+
+        wtool = self.wtool
+        wf = self._getDummyWorkflow()
+        wf.permissions = ('View',)
+        wf.states['private'].setPermission('View', 0, ('Owner',))
+        foo = self.site._setObject('foo', DummyContent('foo'))
+        bar = self.site._setObject('bar', DummyContent('bar'))
+        for ob in (foo, bar):
+            wtool.notifyCreated(ob)
+        wf.doActionFor(bar, 'publish')
+        # Not governed by the workflow, but found in its initial state.
+        baz = self.site._setObject('baz', DummyContent('baz'))
+        baz.portal_type = 'Other Content'
+        wtool.setChainForPortalTypes(('Other Content',), (), verify=False)
+        catalog = DummyCatalog([foo, bar, baz], wf)
+        getSiteManager().registerUtility(catalog, ICatalogTool)
+
+        wf.states['private'].setPermission('View', 0, ('Owner', 'Editor'))
+        self.assertEqual(updateRoleMappingsInBulk(wf, ['private'],
+                                                  batch_size=1), 1)
+        self.assertEqual(catalog.queries, [{'state': 'private'}])
+        self.assertEqual(foo._View_Permission, ('Owner', 'Editor'))
+        self.assertEqual(catalog.reindexed,
+                         [('foo', ['allowedRolesAndUsers'])])
+        self.assertFalse(hasattr(bar, '_View_Permission'))
+        self.assertEqual(baz._View_Permission, ('Owner',))
+        self.assertEqual(updateRoleMappingsInBulk(wf, ['private']), 0)
+
+    def test_updateRoleMappingsInBulk_placeful(self):
+        from ..rolemappings import updateRoleMappingsInBulk
+
+        wtool = self.wtool
+        wf = self._getDummyWorkflow()
+        wf.permissions = ('View',)
+        wf.states['private'].setPermission('View', 0, ('Owner',))
+        foo = self.site._setObject('foo', DummyContent('foo'))
+        bar = self.site._setObject('bar', DummyContent('bar'))
+        wtool.setChainForPortalTypes(('Dummy Content',), (), verify=False)
+
+        # Emulate placeful chains, which override the chain of the type.
+        placeful = {'foo': ('wf',), 'bar': ()}
+        getChainFor = wtool.getChainFor
+
+        def _getChainFor(ob):
+            if isinstance(ob, str):
+                return getChainFor(ob)
+            return placeful.get(ob.getId(), getChainFor(ob))
+        wtool.getChainFor = _getChainFor
+        for ob in (foo, bar):
+            wf.notifyCreated(ob)
+        catalog = DummyCatalog([foo, bar], wf)
+        getSiteManager().registerUtility(catalog, ICatalogTool)
+
+        wf.states['private'].setPermission('View', 0, ('Owner', 'Editor'))
+        self.assertEqual(updateRoleMappingsInBulk(wf, ['private']), 1)
+        self.assertEqual(foo._View_Permission, ('Owner', 'Editor'))
+        self.assertEqual(bar._View_Permission, ('Owner',))
+        self.assertEqual(catalog.reindexed,
+                         [('foo', ['allowedRolesAndUsers'])])
+
     def test_worklists(self):
         wf = self._getDummyWorkflow()
         worklist = wf.worklists._getOb('published_documents')
@@ -211,4 +851,130 @@ class DCWorkflowDefinitionTests(SecurityTest):
         # check ZMI
         wf.worklists.manage_main(self.REQUEST)
 
+    def test_listGlobalActions(self):
+        from zope.globalrequest import clearRequest
+        from zope.globalrequest import setRequest
+
+        wtool = self.wtool
+        wf = self._getDummyWorkflow()
+        worklist = wf.worklists._getOb('published_documents')
+        worklist.setProperties('', actbox_name='Published (%(count)d)',
+                               props={'var_match_state': 'published'})
+        foo = self.site._setObject('foo', DummyContent('foo'))
+        bar = self.site._setObject('bar', DummyContent('bar'))
+        for ob in (foo, bar):
+            wtool.notifyCreated(ob)
+            wf.doActionFor(ob, 'publish')
+        catalog = DummyCatalog([foo, bar], wf)
+        getSiteManager().registerUtility(catalog, ICatalogTool)
+
+        setRequest(self.REQUEST)
+        try:
+            actions = wf.listGlobalActions({})
+            self.assertEqual([a['name'] for a in actions], ['Published (2)'])
+            self.assertEqual(worklist.countResults(), 2)
+        finally:
+            clearRequest()
+        # Counts are shared for the rest of the request.
+        self.assertEqual(catalog.queries, [{'state': ['published']}])
+
+        # Worklists without entries are not listed.
+        worklist.setProperties('', actbox_name='Private (%(count)d)',
+                               props={'var_match_state': 'private'})
+        self.assertEqual(wf.listGlobalActions({}), [])
+
+    def test_worklistSearch(self):
+        wtool = self.wtool
+        wf = self._getDummyWorkflow()
+        worklist = wf.worklists._getOb('published_documents')
+        worklist.setProperties('', props={'var_match_state': 'private'})
+        foo = self.site._setObject('foo', DummyContent('foo'))
+        bar = self.site._setObject('bar', DummyContent('bar'))
+        for ob in (foo, bar):
+            wtool.notifyCreated(ob)
+        catalog = DummyCatalog([foo, bar], wf)
+        getSiteManager().registerUtility(catalog, ICatalogTool)
+
+        self.assertEqual(len(worklist.search()), 2)
+        self.assertEqual(worklist.search(count_only=True), 2)
+        results = worklist.search(limit=1, sort_on='id')
+        self.assertEqual(len(results), 1)
+        self.assertEqual(catalog.queries[-1],
+                         {'state': ['private'], 'sort_on': 'id',
+                          'sort_limit': 1})
+
+    def test_worklistCriteria(self):
+        from ..Expression import Expression
+
+        wf = self._getDummyWorkflow()
+        worklist = wf.worklists._getOb('published_documents')
+        worklist.var_matches = {
+            'state': ('published',),
+            'owner': ('%(user_id)s',),
+            'portal_type': Expression('string:Document'),
+            'id': Expression('python:workflow.getId()'),
+        }
+        compiled = worklist._getCompiled()
+        self.assertIs(compiled, wf._getCompiled().worklists[worklist.getId()])
+        self.assertEqual(sorted(key for key, value in compiled.constants),
+                         ['portal_type', 'state'])
+        self.assertEqual([key for key, values in compiled.formatted],
+                         ['owner'])
+        self.assertEqual([key for key, expr in compiled.expressions], ['id'])
+
+        criteria = worklist._getCriteria({'user_id': 'bob'}, sort_on='id')
+        self.assertEqual(criteria,
+                         {'state': ['published'], 'owner': ['bob'],
+                          'portal_type': 'Document',
+                          'id': 'wf', 'sort_on': 'id'})
+        # The template is not shared with the callers.
+        criteria['state'].append('private')
+        self.assertEqual(worklist._getCriteria({'user_id': 'bob'})['state'],
+                         ['published'])
+
+    def test_worklistCountCache(self):
+        from .. import Worklists
+
+        wtool = self.wtool
+        wf = self._getDummyWorkflow()
+        worklist = wf.worklists._getOb('published_documents')
+        worklist.setProperties('', props={'var_match_state': 'published'})
+        foo = self.site._setObject('foo', DummyContent('foo'))
+        wtool.notifyCreated(foo)
+        catalog = DummyCatalog([foo], wf)
+        getSiteManager().registerUtility(catalog, ICatalogTool)
+        provideHandler(Worklists.invalidateCountsAfterTransition)
+
+        self.assertEqual(worklist.countResults(), 0)
+        self.assertEqual(worklist.countResults(), 0)
+        self.assertEqual(len(catalog.queries), 1)
+        self.assertEqual(len(Worklists._count_cache), 1)
+
+        # Catalogs of other sites have counts of their own.
+        other = DummyCatalog([foo], wf)
+        other.getPhysicalPath = lambda: ('', 'other', 'portal_catalog')
+        getSiteManager().registerUtility(other, ICatalogTool)
+        self.assertEqual(worklist.countResults(), 0)
+        self.assertEqual(len(other.queries), 1)
+        self.assertEqual(len(Worklists._count_cache), 2)
+        getSiteManager().registerUtility(catalog, ICatalogTool)
+        Worklists.clearCountCache()
+        self.assertEqual(worklist.countResults(), 0)
+        self.assertEqual(len(catalog.queries), 2)
+        self.assertEqual(len(Worklists._count_cache), 1)
+
+        # Pending transitions bypass the shared counts.
+        wf.doActionFor(foo, 'publish')
+        self.assertEqual(worklist.countResults(), 1)
+        self.assertEqual(len(catalog.queries), 3)
+
+        # Committing drops the affected counts.
+        hooks = list(transaction.get().getAfterCommitHooks())
+        self.assertEqual(len(hooks), 1)
+        hook, args, kws = hooks[0]
+        hook(False, *args, **kws)
+        self.assertEqual(len(Worklists._count_cache), 1)
+        hook(True, *args, **kws)
+        self.assertEqual(len(Worklists._count_cache), 0)
+
     # XXX more tests...
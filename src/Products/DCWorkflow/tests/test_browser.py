@@ -0,0 +1,133 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Browser view tests.
+"""
+
+import unittest
+
+
+_BODY = b"""\
+<?xml version="1.0"?>
+<dc-workflow workflow_id="%s" title="Test" state_variable="review_state"
+             initial_state="private">
+ <state state_id="private" title="Private"/>
+</dc-workflow>
+"""
+
+_FILENAME = 'workflows/wf/definition.xml'
+
+
+class DummyContext:
+
+    def __init__(self, files, mtime=None):
+        self._files = files
+        self.mtime = mtime
+        self.reads = 0
+
+    def getLastModified(self, path):
+        if path not in self._files:
+            return None
+        return self.mtime
+
+    def readDataFile(self, filename, subdir=None):
+        self.reads += 1
+        return self._files.get(filename)
+
+
+class WorkflowIdTests(unittest.TestCase):
+
+    def setUp(self):
+        from ..browser import workflow
+        workflow._workflow_ids.clear()
+        self.addCleanup(workflow._workflow_ids.clear)
+
+    def _getWorkflowId(self, context, profile_id='profile-test'):
+        from ..browser.workflow import _getWorkflowId
+        return _getWorkflowId(context, profile_id, _FILENAME)
+
+    def test_readWorkflowId(self):
+        from ..browser.workflow import _readWorkflowId
+
+        self.assertEqual(_readWorkflowId(_BODY % b'wf'), 'wf')
+        self.assertEqual(_readWorkflowId(b'<dc-workflow/>'), '')
+
+    def test_readWorkflowId_stops_at_root(self):
+        from ..browser.workflow import _CHUNK_SIZE
+        from ..browser.workflow import _readWorkflowId
+
+        # Parsing the whole body would fail on the garbage.
+        body = b'<dc-workflow workflow_id="wf">' + b'<<&' * _CHUNK_SIZE
+        self.assertEqual(_readWorkflowId(body), 'wf')
+
+    def test_mtime_hit(self):
+        context = DummyContext({_FILENAME: _BODY % b'wf'}, mtime=1)
+        self.assertEqual(self._getWorkflowId(context), 'wf')
+        self.assertEqual(context.reads, 1)
+
+        # The file is not read again while it is not modified.
+        context._files[_FILENAME] = _BODY % b'other'
+        self.assertEqual(self._getWorkflowId(context), 'wf')
+        self.assertEqual(context.reads, 1)
+
+        context.mtime = 2
+        self.assertEqual(self._getWorkflowId(context), 'other')
+        self.assertEqual(context.reads, 2)
+
+        # Other profiles have entries of their own.
+        self.assertEqual(self._getWorkflowId(context, 'profile-other'),
+                         'other')
+        self.assertEqual(context.reads, 3)
+
+    def test_digest_fallback(self):
+        from ..browser import workflow
+
+        context = DummyContext({_FILENAME: _BODY % b'wf'})
+        self.assertEqual(self._getWorkflowId(context), 'wf')
+
+        # Without a modification time, the body is read every time, but
+        # only parsed again if it changed.
+        parsed = []
+
+        def _readWorkflowId(body):
+            parsed.append(body)
+            return original(body)
+
+        original = workflow._readWorkflowId
+        workflow._readWorkflowId = _readWorkflowId
+        self.addCleanup(setattr, workflow, '_readWorkflowId', original)
+
+        self.assertEqual(self._getWorkflowId(context), 'wf')
+        self.assertEqual(context.reads, 2)
+        self.assertEqual(parsed, [])
+
+        context._files[_FILENAME] = _BODY % b'other'
+        self.assertEqual(self._getWorkflowId(context), 'other')
+        self.assertEqual(context.reads, 3)
+        self.assertEqual(len(parsed), 1)
+
+    def test_missing_file(self):
+        from ..browser import workflow
+
+        context = DummyContext({_FILENAME: _BODY % b'wf'}, mtime=1)
+        self.assertEqual(self._getWorkflowId(context), 'wf')
+        self.assertEqual(len(workflow._workflow_ids), 1)
+
+        del context._files[_FILENAME]
+        self.assertIsNone(self._getWorkflowId(context))
+        self.assertEqual(workflow._workflow_ids, {})
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.defaultTestLoader.loadTestsFromTestCase(WorkflowIdTests),
+    ))
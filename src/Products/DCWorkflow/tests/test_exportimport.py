@@ -498,6 +498,48 @@ class WorkflowDefinitionConfiguratorTests(_WorkflowSetup, _GuardChecker):
                             'initial_state': WF_INITIAL_STATE,
                             'workflow_filename': WF_ID.replace(' ', '_')})
 
+    def test_writeWorkflowXML(self):
+        from io import BytesIO
+
+        site, wtool = self._initSite()
+        dcworkflow = self._initDCWorkflow(wtool, 'normal')
+        dcworkflow.title = 'Normal & <DCWorkflow>'
+        dcworkflow.description = 'Normal "Workflow"\n'
+        dcworkflow.initial_state = 'closed'
+        dcworkflow.permissions = _WF_PERMISSIONS
+        self._initVariables(dcworkflow)
+        self._initStates(dcworkflow)
+        self._initTransitions(dcworkflow)
+        self._initWorklists(dcworkflow)
+        self._initScripts(dcworkflow)
+        self._initCreationGuard(dcworkflow)
+        dcworkflow.worklists.addWorklist('no_matches')
+        dcworkflow.transitions.open.actbox_icon = None
+        dcworkflow.transitions.open.getGuard().cacheable = False
+        dcworkflow.creation_guard.cacheable = True
+        dcworkflow.history_format = 'delta'
+        dcworkflow.keep_current_status = 1
+
+        configurator = self._makeOne(dcworkflow).__of__(site)
+
+        expected = configurator.generateWorkflowXML()
+        self.assertIn(b' title="Normal &amp; &lt;DCWorkflow&gt;"', expected)
+        self.assertIn(b' history_format="delta" keep_current_status="True"',
+                      expected)
+        self.assertIn(b'<guard cacheable="False">', expected)
+
+        # The document parses back to the workflow's settings.
+        settings = {}
+        parsed = configurator.parseWorkflowXML(expected, settings=settings)
+        self.assertEqual(parsed[:4], ('normal', 'Normal & <DCWorkflow>',
+                                      'state', 'closed'))
+        self.assertEqual(settings, {'history_format': 'delta',
+                                    'keep_current_status': True})
+
+        stream = BytesIO()
+        configurator.writeWorkflowXML(stream)
+        self.assertEqual(stream.getvalue(), expected)
+
     def test_generateWorkflowXML_multiple(self):
         WF_ID_1 = 'dc1'
         WF_TITLE_1 = 'Normal DCWorkflow #1'
@@ -2499,6 +2541,22 @@ _CREATION_GUARD_WORKFLOW_EXPORT = """\
 </dc-workflow>
 """
 
+# Character data in CDATA sections is not part of an element's text.
+_CDATA_WORKFLOW_EXPORT = """\
+<?xml version="1.0"?>
+<dc-workflow
+    workflow_id="cdata"
+    title="CDATA"
+    state_variable="state"
+    initial_state="private">
+ <permission>View<!-- comment --> content</permission>
+ <state state_id="private" title="Private">
+  <description><![CDATA[ignored]]>Not published</description>
+  <exit-transition transition_id="publish"/>
+ </state>
+</dc-workflow>
+"""
+
 
 class Test_exportWorkflow(_WorkflowSetup, _GuardChecker):
 
@@ -2846,6 +2904,215 @@ class Test_importWorkflow(_WorkflowSetup, _GuardChecker):
         self.assertEqual(len(workflow.worklists.objectItems()),
                          len(_WF_WORKLISTS))
 
+    def test_import_twice_unchanged(self):
+        from Acquisition import aq_base
+
+        from Products.CMFCore.exportimport.workflow import importWorkflowTool
+
+        WF_ID = 'dcworkflow_unchanged'
+        WF_TITLE = 'DC Workflow testing reimport'
+        WF_DESCRIPTION = 'Test Reimport'
+        WF_INITIAL_STATE = 'closed'
+
+        site, context = self._prepareImportNormalWorkflow(
+            WF_ID, WF_TITLE, WF_DESCRIPTION, WF_INITIAL_STATE)
+        importWorkflowTool(context)
+        workflow = self.wtool._getOb(WF_ID)
+        serial = workflow._compiled_serial
+        group_roles = workflow.states.opened.group_roles
+        guard = aq_base(workflow.transitions.close.guard)
+        script = aq_base(workflow.scripts.after_close)
+
+        # Nothing is written if the definition did not change.
+        site, context = self._prepareImportNormalWorkflow(
+            WF_ID, WF_TITLE, WF_DESCRIPTION, WF_INITIAL_STATE,
+            site=site, purge=False)
+        importWorkflowTool(context)
+        self.assertEqual(workflow._compiled_serial, serial)
+        self.assertIs(workflow.states.opened.group_roles, group_roles)
+        self.assertIs(aq_base(workflow.transitions.close.guard), guard)
+        self.assertIs(aq_base(workflow.scripts.after_close), script)
+
+        site, context = self._prepareImportNormalWorkflow(
+            WF_ID, 'Changed', WF_DESCRIPTION, WF_INITIAL_STATE,
+            site=site, purge=False)
+        importWorkflowTool(context)
+        self.assertEqual(self.wtool._getOb(WF_ID).title, 'Changed')
+        self.assertNotEqual(workflow._compiled_serial, serial)
+        self.assertIs(aq_base(workflow.transitions.close.guard), guard)
+
+    def test_import_guard_cacheable(self):
+        from Products.CMFCore.exportimport.workflow import importWorkflowTool
+
+        from .. import exportimport
+        from ..exportimport import WorkflowDefinitionConfigurator
+
+        WF_ID = 'dcworkflow_cacheable'
+        site, context = self._prepareImportNormalWorkflow(
+            WF_ID, 'DC Workflow', 'Cacheable', 'closed')
+        importWorkflowTool(context)
+        workflow = self.wtool._getOb(WF_ID)
+        self.assertIsNone(workflow.transitions.close.guard.cacheable)
+
+        workflow.transitions.close.guard.cacheable = False
+        configurator = WorkflowDefinitionConfigurator(workflow).__of__(site)
+        body = configurator.generateWorkflowXML()
+        self.assertIn(b'<guard cacheable="False">', body)
+        parsed = exportimport._parseWorkflowXML(body)
+        close = [t for t in parsed[5] if t['transition_id'] == 'close'][0]
+        self.assertEqual(close['guard']['cacheable'], 'False')
+
+        # Importing the unchanged definition resets the flag.
+        importWorkflowTool(context)
+        workflow = self.wtool._getOb(WF_ID)
+        self.assertIsNone(workflow.transitions.close.guard.cacheable)
+
+        context._files['workflows/%s/definition.xml' % WF_ID] = body
+        importWorkflowTool(context)
+        workflow = self.wtool._getOb(WF_ID)
+        self.assertIs(workflow.transitions.close.guard.cacheable, False)
+
+    def test_import_history_settings(self):
+        from Products.CMFCore.exportimport.workflow import importWorkflowTool
+
+        from ..exportimport import WorkflowDefinitionConfigurator
+
+        WF_ID = 'dcworkflow_history'
+        site, context = self._prepareImportNormalWorkflow(
+            WF_ID, 'DC Workflow', 'History', 'closed')
+        importWorkflowTool(context)
+        workflow = self.wtool._getOb(WF_ID)
+        self.assertEqual(workflow.history_format, '')
+        self.assertEqual(workflow.keep_current_status, 0)
+
+        workflow.setProperties('', history_format='compact',
+                               keep_current_status=1)
+        configurator = WorkflowDefinitionConfigurator(workflow).__of__(site)
+        body = configurator.generateWorkflowXML()
+        settings = {}
+        self.assertEqual(len(configurator.parseWorkflowXML(body,
+                                                           settings=settings)),
+                         14)
+        self.assertEqual(settings, {'history_format': 'compact',
+                                    'keep_current_status': True})
+
+        # Importing the unchanged definition resets the settings.
+        importWorkflowTool(context)
+        workflow = self.wtool._getOb(WF_ID)
+        self.assertEqual(workflow.history_format, '')
+        self.assertEqual(workflow.keep_current_status, 0)
+
+        context._files['workflows/%s/definition.xml' % WF_ID] = body
+        importWorkflowTool(context)
+        workflow = self.wtool._getOb(WF_ID)
+        self.assertEqual(workflow.history_format, 'compact')
+        self.assertEqual(workflow.keep_current_status, 1)
+
+        context._files['workflows/%s/definition.xml' % WF_ID] = body.replace(
+            b'history_format="compact"', b'history_format="tuples"')
+        self.assertRaises(ValueError, importWorkflowTool, context)
+
+    def test_import_with_executor(self):
+        import gc
+        import pickle
+        from concurrent.futures import ThreadPoolExecutor
+
+        from Products.CMFCore.exportimport.workflow import importWorkflowTool
+
+        from .. import exportimport
+
+        class RecordingExecutor(ThreadPoolExecutor):
+
+            submitted = 0
+
+            def submit(self, fn, *args, **kw):
+                self.submitted += 1
+                return super().submit(fn, *args, **kw)
+
+        executor = RecordingExecutor(2)
+        self.addCleanup(executor.shutdown)
+        exportimport.setImportExecutor(executor)
+        self.addCleanup(exportimport.setImportExecutor, None)
+
+        site, context = self._prepareImportNormalWorkflow(
+            'dcworkflow_executor', 'DC Workflow', 'Executor', 'closed')
+        importWorkflowTool(context)
+        workflow = self.wtool._getOb('dcworkflow_executor')
+
+        self.assertEqual(executor.submitted, 1)
+        self.assertEqual(exportimport._parsed_definitions, {})
+        self.assertEqual(workflow.title, 'DC Workflow')
+        self.assertEqual(len(workflow.states.objectIds()), len(_WF_STATES))
+
+        body = context.readDataFile(
+            'workflows/dcworkflow_executor/definition.xml')
+        parsed = exportimport.parseWorkflowDefinitions([body, body],
+                                                       executor)
+        self.assertEqual(parsed, [exportimport._parseWorkflowXML(body)] * 2)
+        self.assertEqual(pickle.loads(pickle.dumps(parsed)), parsed)
+
+        # Results left over are dropped along with their context.
+        self.assertIs(exportimport._parsed_context(), context)
+        exportimport._parsed_definitions['unused'] = parsed[0]
+        del context
+        gc.collect()
+        self.assertIsNone(exportimport._parsed_context)
+        self.assertEqual(exportimport._parsed_definitions, {})
+
+    def test_import_precompiled(self):
+        import os
+        import pickle
+        import shutil
+        import tempfile
+
+        from Products.CMFCore.exportimport.workflow import importWorkflowTool
+
+        from .. import exportimport
+
+        WF_ID = 'dcworkflow_precompiled'
+        filename = 'workflows/%s/definition' % WF_ID
+        site, context = self._prepareImportNormalWorkflow(
+            WF_ID, 'DC Workflow', 'Precompiled', 'closed')
+        body = context._files[filename + '.xml'].encode('utf-8')
+        data = exportimport.precompileDefinition(body)
+        self.assertEqual(exportimport.loadPrecompiledDefinition(data, body),
+                         exportimport._parseWorkflowXML(body))
+        self.assertIsNone(
+            exportimport.loadPrecompiledDefinition(data, body + b'\n'))
+        self.assertIsNone(
+            exportimport.loadPrecompiledDefinition(data[:-5], body))
+        self.assertIsNone(exportimport.loadPrecompiledDefinition(
+            b'DCWF' + pickle.dumps(exportimport.Guard), body))
+
+        # A fresh precompiled definition is used instead of the XML.
+        parsed = list(exportimport._parseWorkflowXML(body))
+        parsed[1] = 'Precompiled Title'
+        context._files[filename + '.pickle'] = (
+            b'DCWF' + pickle.dumps((exportimport.PRECOMPILED_VERSION,
+                                    exportimport._getDigest(body),
+                                    tuple(parsed))))
+        importWorkflowTool(context)
+        workflow = self.wtool._getOb(WF_ID)
+        self.assertEqual(workflow.title, 'Precompiled Title')
+        self.assertEqual(len(workflow.states.objectIds()), len(_WF_STATES))
+
+        # A stale one is ignored.
+        context._files[filename + '.xml'] = body.replace(
+            b'title="DC Workflow"', b'title="Changed"')
+        importWorkflowTool(context)
+        self.assertEqual(self.wtool._getOb(WF_ID).title, 'Changed')
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        os.makedirs(os.path.join(tmpdir, 'workflows', WF_ID))
+        with open(os.path.join(tmpdir, filename + '.xml'), 'wb') as f:
+            f.write(body)
+        written = exportimport.precompileDefinitions(tmpdir)
+        self.assertEqual(written, [os.path.join(tmpdir, filename + '.pickle')])
+        self.assertEqual(exportimport.precompileDefinitions(tmpdir), [])
+        with open(written[0], 'rb') as f:
+            self.assertEqual(f.read(), data)
+
     def test_from_empty_dcworkflow_top_level(self):
         WF_ID = 'dcworkflow_tool'
         WF_TITLE = 'DC Workflow testing tool'
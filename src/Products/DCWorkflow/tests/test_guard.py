@@ -21,13 +21,16 @@ from zope.testing.cleanup import cleanUp
 
 from Products.CMFCore.interfaces import ITypesTool
 from Products.CMFCore.interfaces import IWorkflowTool
+from Products.CMFCore.permissions import View
 from Products.CMFCore.tests.base.dummy import DummyContent
 from Products.CMFCore.tests.base.dummy import DummySite
 from Products.CMFCore.tests.base.dummy import DummyTool
 from Products.CMFCore.WorkflowTool import WorkflowTool
 
 from ..DCWorkflow import DCWorkflowDefinition
+from ..Expression import getCompiledExpression
 from ..Guard import Guard
+from ..Guard import clearGuardCache
 
 
 class TestGuard(unittest.TestCase):
@@ -266,6 +269,151 @@ class TestGuard(unittest.TestCase):
 
         # XXX more tests with permissions and roles
 
+    def test_checkCachesResults(self):
+        guard = Guard()
+        sm = getSecurityManager()
+        self.site._setObject('dummy', DummyContent('dummy'))
+        ob = self.site.dummy
+        ob.manage_permission(View, ['Anonymous'])
+        wf_def = self._getDummyWorkflow()
+        guard.changeFromProperties({'guard_expr':
+                                    "python:here.Title() == 'changed'"})
+        self.assertIsNone(guard.cacheable)
+        self.assertEqual(guard.getCacheableText(), '')
+
+        # Guards with an expression are not cached by default.
+        self.assertFalse(guard.check(sm, wf_def, ob))
+        ob.title = 'changed'
+        self.assertTrue(guard.check(sm, wf_def, ob))
+
+        # Guards can opt in; the result is then cached for the rest of
+        # the transaction.
+        guard.changeFromProperties({'guard_cacheable': 'True'})
+        self.assertIs(guard.cacheable, True)
+        self.assertEqual(guard.getCacheableText(), 'True')
+        ob.title = ''
+        self.assertFalse(guard.check(sm, wf_def, ob))
+        ob.title = 'changed'
+        self.assertFalse(guard.check(sm, wf_def, ob))
+        self.assertTrue(guard.check(sm, wf_def, ob, arg1=1))
+
+        clearGuardCache()
+        self.assertTrue(guard.check(sm, wf_def, ob))
+
+        # Unhashable keyword arguments bypass the cache.
+        self.assertTrue(guard.check(sm, wf_def, ob, arg1=[]))
+
+        # And out again.
+        guard.changeFromProperties({'guard_cacheable': 'False'})
+        self.assertIs(guard.cacheable, False)
+        ob.title = ''
+        self.assertFalse(guard.check(sm, wf_def, ob))
+
+        # Guards without an expression are cached by default.
+        guard = Guard()
+        guard.changeFromProperties({'guard_roles': 'Anonymous'})
+        self.assertTrue(guard.check(sm, wf_def, ob))
+        guard.roles = ('Manager',)
+        self.assertTrue(guard.check(sm, wf_def, ob))
+
+    def test_checkCacheKeyedOnRoles(self):
+        from AccessControl.SecurityManagement import newSecurityManager
+        from AccessControl.SecurityManagement import noSecurityManager
+        from AccessControl.users import SimpleUser
+
+        self.addCleanup(noSecurityManager)
+        self.site._setObject('dummy', DummyContent('dummy'))
+        ob = self.site.dummy
+        wf_def = self._getDummyWorkflow()
+        guard = Guard()
+        guard.changeFromProperties({'guard_roles': 'Manager'})
+
+        user = SimpleUser('bob', '', ['Member'], [])
+        newSecurityManager(None, user)
+        self.assertFalse(guard.check(getSecurityManager(), wf_def, ob))
+
+        # Another user object with the same id.
+        newSecurityManager(None, SimpleUser('bob', '', ['Manager'], []))
+        self.assertTrue(guard.check(getSecurityManager(), wf_def, ob))
+
+        # The same user object gaining a role.
+        newSecurityManager(None, user)
+        sm = getSecurityManager()
+        self.assertFalse(guard.check(sm, wf_def, ob))
+        user.roles = ['Member', 'Manager']
+        self.assertTrue(guard.check(sm, wf_def, ob))
+        user.roles = ['Member']
+        self.assertFalse(guard.check(sm, wf_def, ob))
+
+    def test_compiledGuardCacheable(self):
+        wf_def = self._getDummyWorkflow()
+        wf_def.transitions.addTransition('publish')
+        tdef = wf_def.transitions['publish']
+        tdef.guard = guard = Guard()
+        guard.changeFromProperties({'guard_expr': 'python:1'})
+        compiled = wf_def._getCompiled().transitions['publish'].guard
+        self.assertFalse(compiled.cacheable)
+        tdef.guard.cacheable = True
+        compiled = wf_def._getCompiled().transitions['publish'].guard
+        self.assertTrue(compiled.cacheable)
+
+    def test_compiledExpressions(self):
+        from Products.CMFCore.Expression import Expression
+
+        compiled = getCompiledExpression(Expression('python:True'))
+        self.assertIs(getCompiledExpression('python:True'), compiled)
+        self.assertIs(getCompiledExpression(compiled), compiled)
+
+        for text, value in (('python:True', True),
+                            ('python: 0', 0),
+                            ("python:'foo'", 'foo'),
+                            ('string:100% foo', '100% foo'),
+                            ('nothing', None),
+                            ('', '')):
+            compiled = getCompiledExpression(text)
+            self.assertTrue(compiled.is_constant, text)
+            self.assertEqual(compiled(None), value)
+
+        for text in ('python:[]', 'string:${here/id}', 'here/title',
+                     'python:here'):
+            self.assertFalse(getCompiledExpression(text).is_constant, text)
+
+        # Other expressions are evaluated by the TALES engine.
+        guard = Guard()
+        guard.changeFromProperties({'guard_expr': 'python:1 + 1 == 2'})
+        self.site._setObject('dummy', DummyContent('dummy'))
+        self.assertTrue(guard.check(getSecurityManager(),
+                                    self._getDummyWorkflow(),
+                                    self.site.dummy))
+
+    def test_lazyExprContext(self):
+        from ..Expression import StateChangeInfo
+        from ..Expression import createExprContext
+
+        class RootCountingContent(DummyContent):
+            root_calls = 0
+
+            def getPhysicalRoot(self):
+                self.root_calls += 1
+                return self
+
+        self.site._setObject('dummy', RootCountingContent('dummy'))
+        ob = self.site.dummy
+        wf = self._getDummyWorkflow()
+        econtext = createExprContext(StateChangeInfo(ob, wf, status={}))
+        compiled = getCompiledExpression('python:here is object')
+        self.assertTrue(compiled(econtext))
+        self.assertEqual(ob.root_calls, 0)
+
+        compiled = getCompiledExpression('python:container is not None')
+        self.assertTrue(compiled(econtext))
+        compiled = getCompiledExpression('python:root is here')
+        self.assertTrue(compiled(econtext))
+        self.assertTrue(compiled(econtext))
+        self.assertEqual(ob.root_calls, 1)
+        self.assertIn('user', econtext.vars)
+        self.assertEqual(econtext.vars.get('scripts').getId(), 'scripts')
+
 
 def test_suite():
     return unittest.TestSuite((
@@ -15,9 +15,13 @@
 
 import unittest
 
+from AccessControl import Permission
+from AccessControl.Permission import addPermission
 from OFS.Application import Application
 from OFS.Folder import Folder
 
+from ..utils import clearPermissionCache
+from ..utils import getPermissionTable
 from ..utils import modifyRolesForGroup
 from ..utils import modifyRolesForPermission
 
@@ -60,6 +64,34 @@ class RoleMapTests(unittest.TestCase):
         self.assertEqual(
             self.ob._View_management_screens_Permission, ['Member'])
 
+    def testGetPermissionTable(self):
+        clearPermissionCache()
+        table = getPermissionTable(self.ob)
+        self.assertIs(getPermissionTable(Folder()), table)
+        self.assertIn('View management screens', table)
+        self.assertNotIn('DCWorkflow test permission', table)
+
+        # Registering a permission invalidates the table.
+        self.addCleanup(self._restorePermissions, Permission._ac_permissions)
+        addPermission('DCWorkflow test permission', ('Owner',))
+        table = getPermissionTable(self.ob)
+        self.assertEqual(table['DCWorkflow test permission'],
+                         ((), ('Owner',)))
+
+        clearPermissionCache()
+        self.assertIsNot(getPermissionTable(self.ob), table)
+
+    def _restorePermissions(self, registered):
+        # Don't leak the test permission into the global registry.
+        Permission._ac_permissions = registered
+        Permission._registeredPermissions.pop('DCWorkflow test permission',
+                                              None)
+        mangled = Permission.getPermissionIdentifier(
+            'DCWorkflow test permission')
+        if mangled in Permission.ApplicationDefaultPermissions.__dict__:
+            delattr(Permission.ApplicationDefaultPermissions, mangled)
+        clearPermissionCache()
+
 
 def test_suite():
     return unittest.TestSuite((
@@ -16,8 +16,11 @@
 import os
 
 from AccessControl.Permission import Permission
+from AccessControl.Permission import getPermissions
 from AccessControl.rolemanager import gather_permissions
 from AccessControl.SecurityInfo import ModuleSecurityInfo
+from Acquisition import aq_base
+from Acquisition import aq_chain
 from App.Common import package_home
 from zope.i18nmessageid import MessageFactory
 
@@ -25,7 +28,6 @@ from zope.i18nmessageid import MessageFactory
 security = ModuleSecurityInfo('Products.DCWorkflow.utils')
 
 _dtmldir = os.path.join(package_home(globals()), 'dtml')
-_xmldir = os.path.join(package_home(globals()), 'xml')
 
 
 def ac_inherited_permissions(ob, all=0):
@@ -48,18 +50,65 @@ def ac_inherited_permissions(ob, all=0):
     return r
 
 
+# Maps a class to (fingerprint, permission table); see getPermissionTable.
+_permission_tables = {}
+
+
+def getPermissionTable(ob):
+    """Return a mapping of permission name to (data, default roles).
+
+    'data' is what ac_inherited_permissions(ob, 1) reports for the
+    permission, i.e. the names of the attributes it protects, and
+    'default roles' the roles it is granted to by default.  The table
+    is cached per class and is rebuilt when the object's
+    '__ac_permissions__', its '_subobject_permissions()' or the set of
+    registered permissions are no longer the very same sequences.  Call
+    clearPermissionCache() after changing permission declarations of a
+    class at runtime.
+    """
+    registered = getPermissions()
+    perms = getattr(ob, '__ac_permissions__', ())
+    subobject_permissions = getattr(ob, '_subobject_permissions', None)
+    if subobject_permissions is not None:
+        subobject_permissions = subobject_permissions()
+    fingerprint = (registered, perms, subobject_permissions)
+    klass = ob.__class__
+    entry = _permission_tables.get(klass)
+    if entry is not None:
+        former = entry[0]
+        if former[0] is registered and former[1] is perms and \
+                former[2] is subobject_permissions:
+            return entry[1]
+    defaults = {}
+    for p in registered:
+        defaults[p[0]] = tuple(p[2])
+    table = {}
+    for p in ac_inherited_permissions(ob, 1):
+        name = p[0]
+        if name in table:
+            continue
+        if len(p) > 2:
+            default_roles = tuple(p[2])
+        else:
+            default_roles = defaults.get(name, ('Manager',))
+        table[name] = (p[1], default_roles)
+    _permission_tables[klass] = (fingerprint, table)
+    return table
+
+
+def clearPermissionCache():
+    """Discards all cached permission tables.
+    """
+    _permission_tables.clear()
+
+
 def modifyRolesForPermission(ob, pname, roles):
     '''
     Modifies multiple role to permission mappings.  roles is a list to
     acquire, a tuple to not acquire.
     '''
     # This mimics what AccessControl/Role.py does.
-    data = ()
-    for perm in ac_inherited_permissions(ob, 1):
-        name, value = perm[:2]
-        if name == pname:
-            data = value
-            break
+    data = getPermissionTable(ob).get(pname, ((), None))[0]
     p = Permission(pname, data, ob)
     if p.getRoles() != roles:
         p.setRoles(roles)
@@ -104,5 +153,64 @@ def modifyRolesForGroup(ob, group, grant_roles, managed_roles):
     return changed
 
 
+def invalidateCompiledWorkflow(ob):
+    """Discards the compiled snapshot of the workflow containing ob.
+
+    ob may be the workflow definition itself or any object acquired
+    from it, e.g. a state, a transition or a guard.  Nothing happens if
+    ob is not wrapped in the context of a workflow definition.
+    """
+    for parent in aq_chain(ob, 1):
+        invalidate = getattr(aq_base(parent), '_invalidateCompiled', None)
+        if invalidate is not None:
+            invalidate()
+            return
+
+
+class CompiledSource:
+
+    """Mixin for the objects a compiled snapshot is built from.
+
+    Setting or deleting an attribute of such an object, even directly
+    rather than through its mutator methods, invalidates the snapshot
+    of the workflow definition it belongs to.  The definition is
+    recorded when the object is added to one of its containers.
+    """
+
+    _compiled_owner = None  # The workflow definition, unwrapped.
+
+    def _setCompiledOwner(self, workflow):
+        # Record 'workflow' here and in the sources held, e.g. guards.
+        if self._compiled_owner is not workflow:
+            self._compiled_owner = workflow
+        for value in list(self.__dict__.values()):
+            if isinstance(value, CompiledSource):
+                value._setCompiledOwner(workflow)
+
+    def _getCompiledOwner(self):
+        owner = self._compiled_owner
+        if owner is None:
+            # Stored before owners were recorded; the snapshot tells us.
+            owner = getattr(self, '_v_compiled_owner', None)
+        return owner
+
+    def _sourceChanged(self, name, value=None):
+        if name[:3] in ('_v_', '_p_') or name == '_compiled_owner':
+            return
+        owner = self._getCompiledOwner()
+        if owner is not None:
+            if isinstance(value, CompiledSource):
+                value._setCompiledOwner(owner)
+            owner._invalidateCompiled()
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        self._sourceChanged(name, value)
+
+    def __delattr__(self, name):
+        super().__delattr__(name)
+        self._sourceChanged(name)
+
+
 security.declarePublic('Message')
 Message = _ = MessageFactory('cmf_default')